@@ -0,0 +1,203 @@
+# admission.py
+import os
+import math
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Admission Control Constants ---
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "8"))  # searches running at once
+ADMISSION_MAX_WAITING = int(os.getenv("ADMISSION_MAX_WAITING", "16"))     # requests allowed to wait for a slot
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "2"))          # seconds a request may wait before it is shed
+RETRY_AFTER_MAX = 30             # cap on the Retry-After hint, in seconds
+SERVICE_TIME_SMOOTHING = 0.2     # weight of the newest search in the service time average
+
+
+class AdmissionRejected(Exception):
+    """A request was shed; retry_after is the suggested wait in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the searches in flight. A request gets a slot at once if one is free, else waits in
+    a short queue (at most max_waiting requests, each for at most max_wait seconds); beyond
+    that it is rejected straight away with AdmissionRejected, so a spike is shed quickly
+    instead of every request queueing behind slow LLM calls and timing out. Time spent
+    waiting for a slot and time spent holding it (service time) are measured separately.
+    Coroutines share the same slots and queue through an AsyncAdmissionController.
+    """
+
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_waiting=ADMISSION_MAX_WAITING, max_wait=ADMISSION_MAX_WAIT):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._in_flight = 0
+        self._waiting = 0
+        self._service_time_avg = None  # seconds, exponentially weighted
+        self._condition = threading.Condition()
+        self._async_waiters = []  # (event loop, future) of coroutines waiting for a slot
+        self._stats = {"admitted": 0, "waited": 0, "rejected_queue_full": 0, "rejected_timeout": 0,
+                       "wait_ms_total": 0.0, "wait_ms_max": 0.0, "service_ms_total": 0.0, "service_ms_max": 0.0}
+
+    def _retry_after(self):
+        # Hold _condition. Roughly the time for the queue ahead to drain through the slots.
+        service_time = self._service_time_avg or 1.0
+        return min(RETRY_AFTER_MAX, max(1, math.ceil(service_time * (self._waiting + 1) / self.max_in_flight)))
+
+    def acquire(self):
+        """Take a slot, waiting up to max_wait. Returns the seconds waited; raises AdmissionRejected."""
+        started = time.monotonic()
+        with self._condition:
+            if self._in_flight >= self.max_in_flight:
+                if self._waiting >= self.max_waiting:
+                    self._stats["rejected_queue_full"] += 1
+                    raise AdmissionRejected("queue_full", self._retry_after())
+                self._waiting += 1
+                self._stats["waited"] += 1
+                try:
+                    deadline = started + self.max_wait
+                    while self._in_flight >= self.max_in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats["rejected_timeout"] += 1
+                            raise AdmissionRejected("timeout", self._retry_after())
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            waited = time.monotonic() - started
+            self._admitted(waited)
+        return waited
+
+    def _admitted(self, waited):
+        # Hold _condition
+        self._in_flight += 1
+        self._stats["admitted"] += 1
+        self._stats["wait_ms_total"] += waited * 1000
+        self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited * 1000)
+
+    def _record_release(self, service_time):
+        # Hold _condition
+        self._in_flight -= 1
+        self._stats["service_ms_total"] += service_time * 1000
+        self._stats["service_ms_max"] = max(self._stats["service_ms_max"], service_time * 1000)
+        if self._service_time_avg is None:
+            self._service_time_avg = service_time
+        else:
+            self._service_time_avg += SERVICE_TIME_SMOOTHING * (service_time - self._service_time_avg)
+
+    def release(self, service_time):
+        with self._condition:
+            self._record_release(service_time)
+            self._condition.notify()
+            # Waiting coroutines re-check for the free slot on their own loops; the losers wait again
+            for loop, wakeup in self._async_waiters:
+                loop.call_soon_threadsafe(_wake, wakeup)
+            self._async_waiters = []
+
+    @contextmanager
+    def admit(self):
+        """with controller.admit(): ... runs the block holding a slot (raises AdmissionRejected if shed)."""
+        self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["in_flight"] = self._in_flight
+            stats["waiting"] = self._waiting
+            stats["max_in_flight"] = self.max_in_flight
+            stats["max_waiting"] = self.max_waiting
+        admitted = stats["admitted"]
+        stats["wait_ms_avg"] = round(stats.pop("wait_ms_total") / admitted, 1) if admitted else None
+        completed = admitted - stats["in_flight"]
+        stats["service_ms_avg"] = round(stats.pop("service_ms_total") / completed, 1) if completed else None
+        stats["wait_ms_max"] = round(stats["wait_ms_max"], 1)
+        stats["service_ms_max"] = round(stats["service_ms_max"], 1)
+        return stats
+
+
+def _wake(wakeup):
+    if not wakeup.done():
+        wakeup.set_result(None)
+
+
+class AsyncAdmissionController:
+    """
+    Front end of an AdmissionController for coroutines (the native ASGI routes): the same
+    slots, queue and stats, so threads and coroutines together stay within max_in_flight,
+    but a waiting request awaits a future on its event loop instead of blocking a thread.
+    acquire() is a coroutine and admit() an async context manager.
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    async def acquire(self):
+        """Take a slot, waiting up to max_wait. Returns the seconds waited; raises AdmissionRejected."""
+        controller = self.controller
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with controller._condition:
+            if controller._in_flight < controller.max_in_flight:
+                controller._admitted(0.0)
+                return 0.0
+            if controller._waiting >= controller.max_waiting:
+                controller._stats["rejected_queue_full"] += 1
+                raise AdmissionRejected("queue_full", controller._retry_after())
+            controller._waiting += 1
+            controller._stats["waited"] += 1
+        try:
+            deadline = started + controller.max_wait
+            while True:
+                with controller._condition:
+                    if controller._in_flight < controller.max_in_flight:
+                        waited = time.monotonic() - started
+                        controller._admitted(waited)
+                        return waited
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        controller._stats["rejected_timeout"] += 1
+                        raise AdmissionRejected("timeout", controller._retry_after())
+                    wakeup = loop.create_future()
+                    controller._async_waiters.append((loop, wakeup))
+                try:
+                    await asyncio.wait_for(wakeup, remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with controller._condition:
+                        if (loop, wakeup) in controller._async_waiters:
+                            controller._async_waiters.remove((loop, wakeup))
+        finally:
+            with controller._condition:
+                controller._waiting -= 1
+
+    def release(self, service_time):
+        self.controller.release(service_time)
+
+    @asynccontextmanager
+    async def admit(self):
+        """async with controller.admit(): ... runs the block holding a slot (raises AdmissionRejected if shed)."""
+        await self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self):
+        return self.controller.stats()
@@ -0,0 +1,471 @@
+# ann_index.py
+import time
+import heapq
+import argparse
+
+import numpy as np
+
+# --- Approximate nearest-neighbour indexes over L2-normalized float32 vectors ---
+# All indexes score by inner product (== cosine similarity for unit vectors) and
+# return (positions, scores) where positions index rows of the vectors passed to build().
+# The indexes keep no copy of those float vectors: search() takes the same matrix (or one
+# with extra rows appended after them), so the caller's array is the only one in memory.
+
+DEFAULT_NLIST = 256
+DEFAULT_NPROBE = 8
+DEFAULT_M = 16
+DEFAULT_EF_CONSTRUCTION = 100
+DEFAULT_EF_SEARCH = 50
+DEFAULT_PQ_M = 16
+DEFAULT_PQ_TRAIN_SIZE = 65536
+PQ_CODEBOOK_SIZE = 256  # one uint8 code per subspace
+
+
+def exact_search_scores(scores, k):
+    """Top-k of a precomputed score vector. Returns (positions, scores), best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return top, scores[top]
+
+
+def exact_search(vectors, query, k=10):
+    """Brute-force inner-product search. Returns (positions, scores), best first."""
+    return exact_search_scores(vectors @ np.asarray(query, dtype=np.float32), k)
+
+
+def spherical_kmeans(vectors, n_clusters, n_iter=20, seed=0, batch_size=65536):
+    """
+    K-means on the unit sphere: points are assigned to the centroid with the highest
+    inner product and centroids are re-normalized after every update.
+    Returns (centroids, assignments).
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    assignments = np.zeros(len(vectors), dtype=np.int64)
+    for _ in range(n_iter):
+        for start in range(0, len(vectors), batch_size):
+            chunk = vectors[start:start + batch_size]
+            assignments[start:start + batch_size] = np.argmax(chunk @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # Re-seed empty clusters from random points so every list stays usable
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids, assignments
+
+
+class IVFIndex:
+    """Inverted-file index: k-means coarse centroids and the row positions belonging to each list."""
+    kind = "ivf"
+
+    def __init__(self, nlist=DEFAULT_NLIST, nprobe=DEFAULT_NPROBE, n_iter=20, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        self.list_offsets = None    # (nlist + 1,) start of each list in list_positions
+        self.list_positions = None  # row positions grouped by list
+
+    def __len__(self):
+        return 0 if self.list_positions is None else len(self.list_positions)
+
+    def build(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.centroids, _ = spherical_kmeans(vectors, self.nlist, self.n_iter, self.seed)
+        self.nlist = len(self.centroids)
+        rebuilt = self.rebuild(vectors)
+        self.list_offsets, self.list_positions = rebuilt.list_offsets, rebuilt.list_positions
+        return self
+
+    def rebuild(self, vectors):
+        """New index over `vectors` that keeps these centroids and only regroups the lists."""
+        index = IVFIndex(nlist=self.nlist, nprobe=self.nprobe, n_iter=self.n_iter, seed=self.seed)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        index.centroids = self.centroids
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1) if len(vectors) else np.zeros(0, dtype=np.int64)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=self.nlist)
+        index.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        index.list_positions = order.astype(np.int64)
+        return index
+
+    def search(self, query, vectors, k=10, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        query = np.asarray(query, dtype=np.float32)
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        ranges = [(self.list_offsets[c], self.list_offsets[c + 1]) for c in probe]
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges if end > start] or [np.zeros(0, dtype=np.int64)])
+        if not len(rows):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        positions = self.list_positions[rows]
+        top, scores = exact_search(vectors[positions], query, k)
+        return positions[top], scores
+
+    def to_arrays(self):
+        return {
+            "centroids": self.centroids, "list_offsets": self.list_offsets,
+            "list_positions": self.list_positions,
+            "params": np.array([self.nlist, self.nprobe], dtype=np.int64),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        nlist, nprobe = (int(v) for v in arrays["params"])
+        index = cls(nlist=nlist, nprobe=nprobe)
+        index.centroids = arrays["centroids"]
+        index.list_offsets = arrays["list_offsets"]
+        index.list_positions = arrays["list_positions"]
+        return index
+
+
+class HNSWIndex:
+    """
+    Hierarchical navigable small-world graph. Built with Python adjacency lists, then
+    frozen into padded int32 arrays (-1 = empty slot) which are what search() reads.
+    """
+    kind = "hnsw"
+
+    def __init__(self, M=DEFAULT_M, ef_construction=DEFAULT_EF_CONSTRUCTION, ef_search=DEFAULT_EF_SEARCH, seed=0):
+        self.M = M
+        self.max_m0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.seed = seed
+        self.levels = None
+        self.entry_point = -1
+        self.max_level = -1
+        self.neighbors0 = None        # (n, 2M) level-0 adjacency
+        self.upper_neighbors = None   # (rows, M) adjacency for every (level >= 1, node) pair
+        self.upper_keys = None        # (rows, 2) the (level, node) of each upper_neighbors row
+        self._upper_rows = {}
+        self._graph = None            # build-time adjacency lists, dropped after freezing
+
+    def __len__(self):
+        return 0 if self.neighbors0 is None else len(self.neighbors0)
+
+    def build(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        rng = np.random.default_rng(self.seed)
+        ml = 1.0 / np.log(self.M)
+        self.levels = np.floor(-np.log(1.0 - rng.random(len(vectors))) * ml).astype(np.int64)
+        self._graph = [dict() for _ in range(int(self.levels.max(initial=0)) + 1)]
+        self.entry_point, self.max_level = -1, -1
+        for node in range(len(vectors)):
+            self._insert(vectors, node)
+        self._freeze()
+        return self
+
+    def rebuild(self, vectors):
+        """New graph with the same parameters over `vectors` (HNSW has no cheap partial rebuild)."""
+        return HNSWIndex(M=self.M, ef_construction=self.ef_construction, ef_search=self.ef_search, seed=self.seed).build(vectors)
+
+    def _neighbors(self, level, node):
+        if self._graph is not None:
+            return self._graph[level][node]
+        if level == 0:
+            row = self.neighbors0[node]
+        else:
+            row = self.upper_neighbors[self._upper_rows[(level, node)]]
+        return row[row >= 0]
+
+    def _insert(self, vectors, node):
+        query = vectors[node]
+        level = int(self.levels[node])
+        for lvl in range(level + 1):
+            self._graph[lvl][node] = []
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return
+        entry = self.entry_point
+        for lvl in range(self.max_level, level, -1):
+            entry = self._search_layer(vectors, query, [entry], 1, lvl)[0][1]
+        entries = [entry]
+        for lvl in range(min(level, self.max_level), -1, -1):
+            candidates = self._search_layer(vectors, query, entries, self.ef_construction, lvl)
+            m_max = self.max_m0 if lvl == 0 else self.M
+            neighbors = [cand for _, cand in candidates[:self.M]]
+            self._graph[lvl][node] = neighbors
+            for neighbor in neighbors:
+                neighbor_list = self._graph[lvl][neighbor]
+                neighbor_list.append(node)
+                if len(neighbor_list) > m_max:
+                    dists = 1.0 - vectors[neighbor_list] @ vectors[neighbor]
+                    keep = np.argsort(dists, kind="stable")[:m_max]
+                    self._graph[lvl][neighbor] = [neighbor_list[i] for i in keep]
+            entries = [cand for _, cand in candidates]
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def _search_layer(self, vectors, query, entries, ef, level):
+        """Beam search on one layer. Returns [(distance, node)] sorted nearest first."""
+        visited = set(entries)
+        dists = (1.0 - vectors[entries] @ query).tolist()
+        candidates = list(zip(dists, entries))
+        heapq.heapify(candidates)
+        results = [(-dist, node) for dist, node in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        while candidates:
+            dist, current = heapq.heappop(candidates)
+            if len(results) >= ef and dist > -results[0][0]:
+                break
+            fresh = [n for n in np.asarray(self._neighbors(level, current)).tolist() if n not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            fresh_dists = (1.0 - vectors[fresh] @ query).tolist()
+            for fresh_dist, fresh_node in zip(fresh_dists, fresh):
+                if len(results) < ef or fresh_dist < -results[0][0]:
+                    heapq.heappush(candidates, (fresh_dist, fresh_node))
+                    heapq.heappush(results, (-fresh_dist, fresh_node))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-neg_dist, node) for neg_dist, node in results)
+
+    def _freeze(self):
+        n = len(self.levels)
+        self.neighbors0 = np.full((n, self.max_m0), -1, dtype=np.int32)
+        for node, neighbors in self._graph[0].items():
+            self.neighbors0[node, :len(neighbors)] = neighbors
+        keys = [(lvl, node) for lvl in range(1, len(self._graph)) for node in sorted(self._graph[lvl])]
+        self.upper_keys = np.array(keys, dtype=np.int64).reshape(-1, 2)
+        self.upper_neighbors = np.full((len(keys), self.M), -1, dtype=np.int32)
+        for row, (lvl, node) in enumerate(keys):
+            neighbors = self._graph[lvl][node]
+            self.upper_neighbors[row, :len(neighbors)] = neighbors
+        self._upper_rows = {(int(lvl), int(node)): row for row, (lvl, node) in enumerate(keys)}
+        self._graph = None
+
+    def search(self, query, vectors, k=10, ef=None):
+        if self.entry_point < 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        ef = max(ef or self.ef_search, k)
+        query = np.asarray(query, dtype=np.float32)
+        entry = self.entry_point
+        for lvl in range(self.max_level, 0, -1):
+            entry = self._search_layer(vectors, query, [entry], 1, lvl)[0][1]
+        found = self._search_layer(vectors, query, [entry], ef, 0)[:k]
+        positions = np.array([node for _, node in found], dtype=np.int64)
+        scores = np.array([1.0 - dist for dist, _ in found], dtype=np.float32)
+        return positions, scores
+
+    def to_arrays(self):
+        return {
+            "neighbors0": self.neighbors0,
+            "upper_neighbors": self.upper_neighbors, "upper_keys": self.upper_keys,
+            "params": np.array([self.M, self.ef_construction, self.ef_search,
+                                self.entry_point, self.max_level], dtype=np.int64),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        M, ef_construction, ef_search, entry_point, max_level = (int(v) for v in arrays["params"])
+        index = cls(M=M, ef_construction=ef_construction, ef_search=ef_search)
+        index.neighbors0 = arrays["neighbors0"]
+        index.upper_neighbors = arrays["upper_neighbors"]
+        index.upper_keys = arrays["upper_keys"]
+        index.entry_point, index.max_level = entry_point, max_level
+        index._upper_rows = {(int(lvl), int(node)): row for row, (lvl, node) in enumerate(np.asarray(index.upper_keys).tolist())}
+        return index
+
+
+def euclidean_kmeans(vectors, n_clusters, n_iter=20, seed=0):
+    """Plain Lloyd k-means (squared L2). Returns (centroids, assignments)."""
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    vector_norms = (vectors ** 2).sum(axis=1, keepdims=True)
+    for _ in range(n_iter):
+        dists = vector_norms - 2.0 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)
+        assignments = np.argmin(dists, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids.astype(np.float32), assignments
+
+
+class PQIndex:
+    """
+    Product quantization: each vector is split into m subvectors and every subvector is
+    replaced by the uint8 id of its nearest codebook centroid (dim * 4 bytes -> m bytes).
+    Search scores all codes with asymmetric distance computation (per-query lookup tables)
+    and optionally re-ranks the best `rerank` candidates exactly against the float vectors
+    passed to search(), which can be a read-only np.load(..., mmap_mode='r') array on disk.
+    """
+    kind = "pq"
+
+    def __init__(self, m=DEFAULT_PQ_M, rerank=0, n_iter=20, train_size=DEFAULT_PQ_TRAIN_SIZE, seed=0):
+        self.m = m
+        self.rerank = rerank
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.codebooks = None      # (m, 256, dim // m)
+        self.codes = None          # (n, m) uint8
+
+    def __len__(self):
+        return 0 if self.codes is None else len(self.codes)
+
+    def _split(self, vectors):
+        n, dim = vectors.shape
+        if dim % self.m:
+            raise ValueError(f"Vector dimension {dim} is not divisible by m={self.m}.")
+        return vectors.reshape(n, self.m, dim // self.m)
+
+    def train(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > self.train_size:
+            vectors = vectors[rng.choice(len(vectors), self.train_size, replace=False)]
+        subvectors = self._split(vectors)
+        self.codebooks = np.stack([
+            euclidean_kmeans(np.ascontiguousarray(subvectors[:, j]), PQ_CODEBOOK_SIZE, self.n_iter, self.seed + j)[0]
+            for j in range(self.m)
+        ])
+        return self
+
+    def encode(self, vectors, batch_size=65536):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        codebook_norms = (self.codebooks ** 2).sum(axis=2)
+        for start in range(0, len(vectors), batch_size):
+            subvectors = self._split(vectors[start:start + batch_size])
+            for j in range(self.m):
+                dists = codebook_norms[j] - 2.0 * subvectors[:, j] @ self.codebooks[j].T
+                codes[start:start + batch_size, j] = np.argmin(dists, axis=1)
+        return codes
+
+    def decode(self, codes):
+        return self.codebooks[np.arange(self.m), codes].reshape(len(codes), -1)
+
+    def build(self, vectors):
+        self.train(vectors)
+        self.codes = self.encode(vectors)
+        return self
+
+    def rebuild(self, vectors):
+        """New index over `vectors` that re-encodes with these codebooks instead of retraining."""
+        index = PQIndex(m=self.m, rerank=self.rerank, n_iter=self.n_iter, train_size=self.train_size, seed=self.seed)
+        index.codebooks = self.codebooks
+        index.codes = index.encode(vectors)
+        return index
+
+    def distance_tables(self, query):
+        """(m, 256) inner products between each query subvector and its codebook."""
+        subquery = self._split(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        return np.einsum("jd,jcd->jc", subquery, self.codebooks)
+
+    def search(self, query, vectors=None, k=10, rerank=None):
+        """Without `vectors` only the codes are scored and `rerank` is ignored."""
+        rerank = self.rerank if rerank is None else rerank
+        if not len(self):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        tables = self.distance_tables(query)
+        scores = tables[np.arange(self.m), self.codes].sum(axis=1)
+        if not rerank or vectors is None:
+            return exact_search_scores(scores, k)
+        candidates, _ = exact_search_scores(scores, max(rerank, k))
+        candidates = np.sort(candidates)  # sorted row reads are friendlier to mmap'd vectors
+        top, exact_scores = exact_search(np.asarray(vectors[candidates]), query, k)
+        return candidates[top], exact_scores
+
+    def to_arrays(self):
+        return {
+            "codebooks": self.codebooks, "codes": self.codes,
+            "params": np.array([self.m, self.rerank], dtype=np.int64),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        m, rerank = (int(v) for v in arrays["params"])
+        index = cls(m=m, rerank=rerank)
+        index.codebooks = arrays["codebooks"]
+        index.codes = arrays["codes"]
+        return index
+
+
+ANN_INDEX_TYPES = {IVFIndex.kind: IVFIndex, HNSWIndex.kind: HNSWIndex, PQIndex.kind: PQIndex}
+
+
+def save_ann_index(index, path):
+    np.savez(path, kind=np.array(index.kind), **index.to_arrays())
+    print(f"Saved {index.kind.upper()} index with {len(index)} vectors to '{path}'.")
+
+
+def load_ann_index(path):
+    """Load an index saved by save_ann_index. Its search() takes the vectors it was built over."""
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    return ANN_INDEX_TYPES[str(arrays.pop("kind"))].from_arrays(arrays)
+
+
+# --- Benchmark: recall@10 against exact search and QPS per nprobe / ef / rerank setting ---
+def _synthetic_vectors(n, dim, n_clusters=64, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    data = centers[rng.integers(0, n_clusters, n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+
+def _benchmark(index, vectors, queries, truth, k, setting_name, settings):
+    for setting in settings:
+        start_time = time.time()
+        hits = 0
+        for query, expected in zip(queries, truth):
+            positions, _ = index.search(query, vectors, k=k, **{setting_name: setting})
+            hits += len(set(positions.tolist()) & expected)
+        elapsed = time.time() - start_time
+        print(f"  {setting_name}={setting:<4d} recall@{k}={hits / (k * len(queries)):.3f}  QPS={len(queries) / elapsed:8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark IVF and HNSW against exact search.")
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    data = _synthetic_vectors(args.n + args.queries, args.dim)
+    vectors, queries = data[:args.n], data[args.n:]
+
+    start_time = time.time()
+    truth = [set(exact_search(vectors, query, args.k)[0].tolist()) for query in queries]
+    print(f"Exact search: QPS={len(queries) / (time.time() - start_time):8.1f}")
+
+    start_time = time.time()
+    ivf = IVFIndex(nlist=int(np.sqrt(args.n))).build(vectors)
+    print(f"IVF build ({ivf.nlist} lists): {time.time() - start_time:.2f}s")
+    _benchmark(ivf, vectors, queries, truth, args.k, "nprobe", [1, 2, 4, 8, 16, 32])
+
+    start_time = time.time()
+    hnsw = HNSWIndex().build(vectors)
+    print(f"HNSW build (M={hnsw.M}): {time.time() - start_time:.2f}s")
+    _benchmark(hnsw, vectors, queries, truth, args.k, "ef", [10, 20, 40, 80, 160])
+
+    print(f"Float32 vectors: {vectors.nbytes / 1e6:.2f} MB")
+    for m in [8, 16, 32]:
+        if args.dim % m:
+            continue
+        start_time = time.time()
+        pq = PQIndex(m=m).build(vectors)
+        pq_bytes = pq.codes.nbytes + pq.codebooks.nbytes
+        print(f"PQ build (m={m}): {time.time() - start_time:.2f}s, codes+codebooks {pq_bytes / 1e6:.2f} MB "
+              f"({vectors.nbytes / pq_bytes:.1f}x smaller)")
+        _benchmark(pq, vectors, queries, truth, args.k, "rerank", [0, 50, 100, 200])
@@ -1,13 +1,24 @@
 # app.py
 import os
 import json
-from flask import Flask, request, jsonify, render_template
+import math
+import time
+from flask import Flask, Response, request, jsonify, render_template
 from dotenv import load_dotenv
 
 # Import the core logic functions from test4.py
 # Make sure test4.py is in the same directory
 try:
-    from test6 import generate_caption, create_json_from_caption, search_similar_products
+    from test7 import search_similar_products, catalog_cache, query_planner, query_term_stats
+    from test7 import create_json_from_text_query, result_cursors
+    from catalog_client import get_catalog_client
+    from catalog_index import SORT_OPTIONS, snapshot_load_info
+    from similar_items import SIMILAR_ITEMS_K, load_similar_items
+    from embedding_store import EmbeddingStore
+    from pipeline import coalesced_image_search, stream_image_search, record_stream, pipeline_stats
+    from pipeline import image_search_graph, image_search_outcome
+    from jobs import JobStore
+    from admission import AdmissionController, AsyncAdmissionController, AdmissionRejected
 except ImportError:
     print("Error: Could not import functions from test4.py. Make sure it exists in the same directory.")
     # Optionally exit or raise a more specific error
@@ -21,6 +32,18 @@ load_dotenv()
 # Initialize Flask app
 app = Flask(__name__)
 
+# Precomputed "more like this" table (built offline with `python similar_items.py`); None if not built
+similar_items_table = load_similar_items()
+# Image-embedding index published by `python image_index.py build/update`; current() picks up new snapshots
+image_embeddings = EmbeddingStore()
+
+# Searches submitted with POST /jobs, run on a bounded pool and kept for JOB_RESULT_TTL once finished
+search_jobs = JobStore()
+# Bound on the searches running at once (routes and jobs); requests beyond it wait briefly or are shed with 503
+search_admission = AdmissionController()
+# The same slots for the native async routes in asgi.py, which wait on the event loop instead of a thread
+search_admission_async = AsyncAdmissionController(search_admission)
+
 # --- Flask Routes ---
 
 @app.route('/')
@@ -29,47 +52,91 @@ def index():
     # Ensure your index.html is in a 'templates' subfolder
     return render_template('index.html')
 
-@app.route('/find_similar_jewelry', methods=['POST'])
-def find_similar_jewelry_route():
-    """Endpoint to handle image URL and return similar jewelry by calling functions from test4.py."""
-    data = request.get_json()
-    if not data or 'image_url' not in data:
-        print("Error: Missing 'image_url' in request payload.")
-        return jsonify({"error": "Missing 'image_url' in request."}), 400
-
-    image_url = data['image_url']
-    print(f"\nReceived request for image URL: {image_url}")
+def parse_price(value):
+    """A min_price / max_price field as a finite float, None if absent; raises ValueError otherwise."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError(value)
+    price = float(value)
+    if not math.isfinite(price):
+        raise ValueError(value)
+    return price
 
-    # --- Call the processing pipeline functions imported from test4.py ---
+def parse_search_options(data):
+    """
+    Optional min_price / max_price / sort fields of a search request. Returns (options, error message).
+    sort="price_asc" / "price_desc" turns off the Pass 1 early stop: the whole candidate set (up
+    to max_total_results_fetch, 5000 items) is read so the cheapest / dearest items are found.
+    """
     try:
-        print("Step 1: Calling generate_caption from test4.py")
-        caption = generate_caption(image_url) # Function from test4.py
-        if not caption:
-            print("Failed to generate caption using test4.generate_caption.")
-            # Provide a user-friendly error message back to the frontend
-            return jsonify({"error": "Could not analyze the image. Please try a different image or URL.", "data": [], "total_found": 0}), 500
-
-        print(f"Step 2: Calling create_json_from_caption from test4.py with caption: {caption}")
-        json_prompt = create_json_from_caption(caption) # Function from test4.py
-        if not json_prompt:
-            print("Failed to create JSON prompt using test4.create_json_from_caption.")
-            return jsonify({"error": "Could not understand the features of the jewelry in the image.", "data": [], "total_found": 0}), 500
+        min_price = parse_price(data.get('min_price'))
+        max_price = parse_price(data.get('max_price'))
+    except (TypeError, ValueError):
+        return None, "'min_price' and 'max_price' must be finite numbers."
+    if min_price is not None and max_price is not None and min_price > max_price:
+        return None, "'min_price' must not be greater than 'max_price'."
+    sort = data.get('sort') or "relevance"
+    if sort not in SORT_OPTIONS:
+        return None, f"'sort' must be one of: {', '.join(sorted(SORT_OPTIONS))}."
+    return {"min_price": min_price, "max_price": max_price, "sort": sort}, None
 
-        print(f"Step 3: Calling search_similar_products from test4.py with JSON prompt: {json_prompt}")
-        # Assuming search_similar_products returns a dict, potentially with an 'error' key
-        results = search_similar_products(json_prompt, caption) # Function from test4.py
+def image_search_response(caption, json_prompt, results):
+    """(body, status) of an image search from its pipeline outcome, as returned by coalesced_image_search."""
+    if not caption:
+        print("Failed to generate caption using test4.generate_caption.")
+        # Provide a user-friendly error message back to the frontend
+        return {"error": "Could not analyze the image. Please try a different image or URL.", "data": [], "total_found": 0}, 500
 
-        # Check if the search function itself indicated an error
-        if isinstance(results, dict) and results.get("error"):
-             print(f"Error reported by search_similar_products: {results['error']}")
-             # Pass the specific error message to the frontend if available
-             return jsonify({"error": results.get("error", "Search failed."), "data": [], "total_found": 0}), 500
+    if not json_prompt:
+        print("Failed to create JSON prompt using test4.create_json_from_caption.")
+        return {"error": "Could not understand the features of the jewelry in the image.", "data": [], "total_found": 0}, 500
+
+    # Check if the search function itself indicated an error
+    if isinstance(results, dict) and results.get("error"):
+         print(f"Error reported by search_similar_products: {results['error']}")
+         # Pass the specific error message to the frontend if available
+         return {"error": results.get("error", "Search failed."), "data": [], "total_found": 0}, 500
+
+    # Ensure results is a dictionary before adding the caption
+    if not isinstance(results, dict):
+         print("Error: search_similar_products did not return a dictionary.")
+         return {"error": "Internal server error during search.", "data": [], "total_found": 0}, 500
 
-        # Ensure results is a dictionary before adding the caption
-        if not isinstance(results, dict):
-             print("Error: search_similar_products did not return a dictionary.")
-             return jsonify({"error": "Internal server error during search.", "data": [], "total_found": 0}), 500
+    # Add the generated caption to the results sent back to the frontend
+    results['generated_caption'] = caption
+    return results, 200
+
+def shed_response(rejected):
+    """503 for a request shed by search_admission, with a Retry-After hint."""
+    print(f"Search request shed ({rejected.reason}); retry after {rejected.retry_after}s.")
+    response = jsonify({"error": "The service is busy. Please try again shortly.", "data": [], "total_found": 0})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(rejected.retry_after)
+    return response
+
+def parse_image_search_request(data):
+    """(image_url, search options, error message) of an image search request."""
+    if not data or 'image_url' not in data:
+        print("Error: Missing 'image_url' in request payload.")
+        return None, None, "Missing 'image_url' in request."
+    image_url = data['image_url']
+    print(f"\nReceived request for image URL: {image_url}")
+    search_options, error = parse_search_options(data)
+    return image_url, search_options, error
 
+@app.route('/find_similar_jewelry', methods=['POST'])
+def find_similar_jewelry_route():
+    """Endpoint to handle image URL and return similar jewelry by calling functions from test4.py."""
+    image_url, search_options, error = parse_image_search_request(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    # --- Run the processing pipeline (pipeline.py: overlapped stages, shared by identical concurrent requests) ---
+    try:
+        caption, json_prompt, results = coalesced_image_search(image_url, search_options, search_admission)
+    except AdmissionRejected as rejected:
+        return shed_response(rejected)
     except Exception as e:
         # Catch any unexpected errors during the calls to test4 functions
         print(f"An unexpected error occurred during processing: {e}")
@@ -79,13 +146,232 @@ def find_similar_jewelry_route():
         return jsonify({"error": "An unexpected error occurred. Please check server logs.", "data": [], "total_found": 0}), 500
     # --- End processing pipeline ---
 
-    # Add the generated caption to the results sent back to the frontend
-    # (Do this only if processing was successful and results is a dict)
-    results['generated_caption'] = caption
+    body, status = image_search_response(caption, json_prompt, results)
+    if status == 200:
+        print("Processing complete. Sending results back to frontend.")
+    return jsonify(body), status
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/find_similar_jewelry/stream', methods=['POST'])
+def find_similar_jewelry_stream_route():
+    """
+    /find_similar_jewelry as Server-Sent Events, sent as the pipeline stages finish:
+    "caption", "attributes", "candidates" (early Pass 1 items, when any), then "results" (the
+    /find_similar_jewelry response) or "error" ({"error", "status"}). Bad requests and shed
+    requests get the same 400 / 503 JSON responses as /find_similar_jewelry.
+    """
+    image_url, search_options, error = parse_image_search_request(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+    started = time.perf_counter()
+    try:
+        search_admission.acquire()
+    except AdmissionRejected as rejected:
+        return shed_response(rejected)
+    admitted = time.monotonic()
+    # The slot is held until the search itself is over, even if the client disconnects first
+    try:
+        events = stream_image_search(image_url, search_options,
+                                     on_finished=lambda: search_admission.release(time.monotonic() - admitted))
+    except Exception:
+        search_admission.release(time.monotonic() - admitted)
+        raise
+
+    def generate():
+        first_event_ms = None
+        for event, data in events:
+            if event == "caption":
+                data = {"generated_caption": data}
+            elif event == "attributes":
+                data = {"extracted_attributes": data}
+            elif event == "candidates":
+                data = {"data": data, "total_found": len(data), "source_pass": "Pass 1 (early results)"}
+            elif event == "end":
+                body, status = image_search_response(*data)
+                event, data = ("results", body) if status == 200 else ("error", dict(body, status=status))
+            else:
+                print(f"An unexpected error occurred during processing: {data}")
+                event, data = "error", {"error": "An unexpected error occurred. Please check server logs.", "data": [],
+                                        "total_found": 0, "status": 500}
+            if first_event_ms is None:
+                first_event_ms = (time.perf_counter() - started) * 1000
+            yield sse_event(event, data)
+        record_stream(first_event_ms, (time.perf_counter() - started) * 1000)
+
+    return Response(generate(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def parse_text_search_request(data):
+    """(query, search options, error message) of a text search request."""
+    data = data or {}
+    query = data.get('query').strip() if isinstance(data.get('query'), str) else ''
+    if not query:
+        print("Error: Missing 'query' in request payload.")
+        return None, None, "Missing 'query' in request."
+    print(f"\nReceived text search: {query}")
+    search_options, error = parse_search_options(data)
+    return query, search_options, error
+
+def text_search_response(query, search_options):
+    """(body, status) of a text search."""
+    try:
+        json_prompt, attribute_source = create_json_from_text_query(query)
+        if not json_prompt:
+            return {"error": "Could not understand what jewelry you are looking for.", "data": [], "total_found": 0}, 500
+        results = search_similar_products(json_prompt, query, **search_options)
+        if isinstance(results, dict) and results.get("error"):
+            print(f"Error reported by search_similar_products: {results['error']}")
+            return {"error": results.get("error", "Search failed."), "data": [], "total_found": 0}, 500
+    except Exception as e:
+        print(f"An unexpected error occurred during text search: {e}")
+        import traceback
+        traceback.print_exc()
+        return {"error": "An unexpected error occurred. Please check server logs.", "data": [], "total_found": 0}, 500
+
+    results['search_query'] = query
+    results['extracted_attributes'] = json_prompt
+    results['attribute_source'] = attribute_source
+    return results, 200
+
+@app.route('/search_text', methods=['POST'])
+def search_text_route():
+    """Search from a text query: attributes are extracted locally when possible (no vision or LLM call)."""
+    query, search_options, error = parse_text_search_request(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        with search_admission.admit():
+            body, status = text_search_response(query, search_options)
+    except AdmissionRejected as rejected:
+        return shed_response(rejected)
+    return jsonify(body), status
+
+def image_search_job(image_url, search_options):
+    """Work function of an image search job: runs the stage graph and exposes its stage timings as progress."""
+    def work(job):
+        run = image_search_graph.run(image_url=image_url, search_options=search_options)
+        job.progress = run.timings
+        return image_search_response(*image_search_outcome(run))
+    return work
+
+def admitted_job(work):
+    """A job work function that holds a search_admission slot while it runs, like the search routes."""
+    def run(job):
+        try:
+            with search_admission.admit():
+                return work(job)
+        except AdmissionRejected as rejected:
+            print(f"Search job {job.id} shed ({rejected.reason}).")
+            return {"error": "The service is busy. Please try again shortly.", "data": [], "total_found": 0,
+                    "retry_after": rejected.retry_after}, 503
+    return run
+
+@app.route('/jobs', methods=['POST'])
+def submit_job_route():
+    """
+    Start an image search ({"image_url": ...}) or text search ({"query": ...}) in the background.
+    Returns 202 with the job id at once; poll GET /jobs/<job_id> for progress and the result.
+    """
+    data = request.get_json() or {}
+    if 'image_url' in data:
+        image_url, search_options, error = parse_image_search_request(data)
+        kind, work = "image", image_search_job(image_url, search_options)
+    else:
+        query, search_options, error = parse_text_search_request(data)
+        kind, work = "text", lambda job: text_search_response(query, search_options)
+    if error:
+        return jsonify({"error": error}), 400
+    job_id = search_jobs.submit(kind, admitted_job(work))
+    if job_id is None:
+        return jsonify({"error": "Too many searches are waiting. Please try again shortly."}), 503
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_route(job_id):
+    """Status of a search job: queued / running (with per-stage progress) / done or failed (with the result)."""
+    job = search_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown or expired job '{job_id}'."}), 404
+    return jsonify(job)
+
+@app.route('/find_similar_jewelry/more', methods=['GET'])
+def find_similar_jewelry_more_route():
+    """Next page of a previous search's ranked results, served from memory (no LLM or catalog calls)."""
+    cursor = request.args.get('cursor', '')
+    if not cursor:
+        return jsonify({"error": "Missing 'cursor' parameter."}), 400
+    page = result_cursors.page(cursor)
+    if page is None:
+        return jsonify({"error": "These results have expired. Please run the search again.", "data": [], "total_found": 0}), 410
+    items, next_cursor, info = page
+    return jsonify({
+        "data": items,
+        "total_found": len(items),
+        "source_pass": info.get("source_pass", "N/A"),
+        "sort": info.get("sort"),
+        "next_cursor": next_cursor,
+    })
+
+@app.route('/similar/<item_id>', methods=['GET'])
+def similar_items_route(item_id):
+    """Items similar to a catalog item, served from the precomputed kNN table (no LLM or catalog calls)."""
+    if similar_items_table is None:
+        return jsonify({"error": "Similar items are not available yet.", "data": [], "total_found": 0}), 503
+    try:
+        # The table may have been built with another k than this process's SIMILAR_ITEMS_K
+        k = min(max(int(request.args.get('k', SIMILAR_ITEMS_K)), 1), similar_items_table.neighbors.shape[1])
+    except ValueError:
+        return jsonify({"error": "'k' must be an integer."}), 400
+    neighbors = similar_items_table.similar(item_id, k)
+    if neighbors is None:
+        return jsonify({"error": f"Unknown item '{item_id}'.", "data": [], "total_found": 0}), 404
+    return jsonify({
+        "item_id": item_id,
+        "data": [payload for payload, _ in neighbors],
+        "scores": [round(score, 4) for _, score in neighbors],
+        "total_found": len(neighbors),
+        "source_pass": "Similar Items",
+    })
+
+@app.route('/similar_images/<item_id>', methods=['GET'])
+def similar_images_route(item_id):
+    """Items whose catalog image looks like this item's, searched in the published image-embedding snapshot."""
+    index = image_embeddings.current()
+    if index is None:
+        return jsonify({"error": "Image similarity is not available yet.", "data": [], "total_found": 0}), 503
+    try:
+        k = min(max(int(request.args.get('k', SIMILAR_ITEMS_K)), 1), 100)
+    except ValueError:
+        return jsonify({"error": "'k' must be an integer."}), 400
+    vector = index.vector_for(item_id)
+    if vector is None:
+        return jsonify({"error": f"Unknown item '{item_id}'.", "data": [], "total_found": 0}), 404
+    # The item itself is its own best match; ask for one more and drop it
+    neighbors = [(other_id, score) for other_id, score in index.search(vector, k + 1) if other_id != str(item_id)][:k]
+    return jsonify({
+        "item_id": item_id,
+        "data": [other_id for other_id, _ in neighbors],
+        "scores": [round(score, 4) for _, score in neighbors],
+        "total_found": len(neighbors),
+        "source_pass": "Image Embeddings",
+        "snapshot": image_embeddings.snapshot_name,
+    })
 
-    print("Processing complete. Sending results back to frontend.")
-    # print(f"Final results being sent: {json.dumps(results, indent=2)}") # Optional: log final results
-    return jsonify(results)
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """Operational counters, e.g. catalog cache hit rate and upstream calls saved."""
+    return jsonify({
+        "catalog_client": get_catalog_client().stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "query_planner": dict(query_planner.stats(), term_stats=query_term_stats.stats()),
+        "result_cursors": result_cursors.stats(),
+        "catalog_index_snapshot": snapshot_load_info,
+        "embedding_store": image_embeddings.stats(),
+        "pipeline": pipeline_stats(),
+        "jobs": search_jobs.stats(),
+        "admission": search_admission.stats(),
+    })
 
 if __name__ == '__main__':
     # Make sure DEBUG is False in production
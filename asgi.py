@@ -0,0 +1,154 @@
+# asgi.py
+import json
+import traceback
+
+from asgiref.wsgi import WsgiToAsgi
+
+from admission import AdmissionRejected
+from app import app as flask_app, parse_search_options, search_admission_async
+from async_pipeline import (generate_caption_async, create_json_from_caption_async, create_json_from_text_query_async,
+                            search_similar_products_async, close_clients)
+from pipeline import image_searches, image_search_key
+
+# --- ASGI entry point ---
+# Run with: uvicorn asgi:app --port 5001
+# The two search routes run the asyncio pipeline natively, so a request waiting on the image,
+# Groq or the catalog API holds no thread. Every other route (page, static files, /metrics,
+# /find_similar_jewelry/more, /similar/...) is the unchanged Flask app behind WsgiToAsgi.
+# Responses keep the Flask routes' JSON contract and status codes. Identical concurrent image
+# searches share one run through pipeline.image_searches, as in the Flask route, and both
+# routes are bounded by app.search_admission_async, which shares its slots with the Flask routes
+# and jobs (503 with Retry-After when shed).
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+
+async def _image_search(image_url, search_options):
+    """(caption, json_prompt, results) of an image search; later values are None after a failed step."""
+    caption = await generate_caption_async(image_url)
+    if not caption:
+        return None, None, None
+    json_prompt = await create_json_from_caption_async(caption)
+    if not json_prompt:
+        return caption, None, None
+    return caption, json_prompt, await search_similar_products_async(json_prompt, caption, **search_options)
+
+
+async def _admitted_image_search(image_url, search_options):
+    async with search_admission_async.admit():
+        return await _image_search(image_url, search_options)
+
+
+def _shed(rejected):
+    """(status, body, headers) for a request shed by search_admission_async."""
+    print(f"Search request shed ({rejected.reason}); retry after {rejected.retry_after}s.")
+    return (503, {"error": "The service is busy. Please try again shortly.", "data": [], "total_found": 0},
+            [(b"retry-after", str(rejected.retry_after).encode("ascii"))])
+
+
+async def find_similar_jewelry(data):
+    """Async twin of app.find_similar_jewelry_route. Returns (status, body) or (status, body, headers)."""
+    if not data or 'image_url' not in data:
+        print("Error: Missing 'image_url' in request payload.")
+        return 400, {"error": "Missing 'image_url' in request."}
+    image_url = data['image_url']
+    print(f"\nReceived request for image URL: {image_url}")
+    search_options, error = parse_search_options(data)
+    if error:
+        return 400, {"error": error}
+    try:
+        (caption, json_prompt, results), shared = await image_searches.do_async(
+            image_search_key(image_url, search_options), lambda: _admitted_image_search(image_url, search_options))
+        if shared:
+            print(f"Joined an identical in-flight search for {image_url}")
+        if not caption:
+            return 500, {"error": "Could not analyze the image. Please try a different image or URL.", "data": [], "total_found": 0}
+        if not json_prompt:
+            return 500, {"error": "Could not understand the features of the jewelry in the image.", "data": [], "total_found": 0}
+        if isinstance(results, dict) and results.get("error"):
+            print(f"Error reported by search_similar_products: {results['error']}")
+            return 500, {"error": results.get("error", "Search failed."), "data": [], "total_found": 0}
+    except AdmissionRejected as rejected:
+        return _shed(rejected)
+    except Exception as e:
+        print(f"An unexpected error occurred during processing: {e}")
+        traceback.print_exc()
+        return 500, {"error": "An unexpected error occurred. Please check server logs.", "data": [], "total_found": 0}
+    results = dict(results)
+    results['generated_caption'] = caption
+    return 200, results
+
+
+async def search_text(data):
+    """Async twin of app.search_text_route. Returns (status, body) or (status, body, headers)."""
+    data = data or {}
+    query = data.get('query').strip() if isinstance(data.get('query'), str) else ''
+    if not query:
+        print("Error: Missing 'query' in request payload.")
+        return 400, {"error": "Missing 'query' in request."}
+    print(f"\nReceived text search: {query}")
+    search_options, error = parse_search_options(data)
+    if error:
+        return 400, {"error": error}
+    try:
+        async with search_admission_async.admit():
+            json_prompt, attribute_source = await create_json_from_text_query_async(query)
+            if not json_prompt:
+                return 500, {"error": "Could not understand what jewelry you are looking for.", "data": [], "total_found": 0}
+            results = await search_similar_products_async(json_prompt, query, **search_options)
+        if isinstance(results, dict) and results.get("error"):
+            print(f"Error reported by search_similar_products: {results['error']}")
+            return 500, {"error": results.get("error", "Search failed."), "data": [], "total_found": 0}
+    except AdmissionRejected as rejected:
+        return _shed(rejected)
+    except Exception as e:
+        print(f"An unexpected error occurred during text search: {e}")
+        traceback.print_exc()
+        return 500, {"error": "An unexpected error occurred. Please check server logs.", "data": [], "total_found": 0}
+    results['search_query'] = query
+    results['extracted_attributes'] = json_prompt
+    results['attribute_source'] = attribute_source
+    return 200, results
+
+
+ASYNC_ROUTES = {
+    ("POST", "/find_similar_jewelry"): find_similar_jewelry,
+    ("POST", "/search_text"): search_text,
+}
+
+
+async def _read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return None
+
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode("ascii")), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_clients()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    handler = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        await flask_asgi(scope, receive, send)
+        return
+    await _send_json(send, *await handler(await _read_json(receive)))
@@ -0,0 +1,271 @@
+# async_pipeline.py
+import os
+import base64
+import asyncio
+import weakref
+
+import httpx
+from groq import AsyncGroq
+from dotenv import load_dotenv
+
+import test7
+from test7 import (caption_request, caption_json_request, parse_caption_json, keyword_request, parse_keyword_response,
+                   pass3_llm_exclusions, accept_pass3_llm_term, extract_attributes_locally, image_to_base64,
+                   Pass1Step, step_facets, prepare_search, pass3_needs_llm, record_pass3_term, describe_plan_step, next_plan_step,
+                   combine_search_results, _pass1_search_body, PASS1_MAX_CONCURRENCY)
+from catalog_client import get_async_catalog_client
+from result_cursor import RESULT_CURSOR_MAX_CANDIDATES
+
+# --- asyncio version of the test7 pipeline ---
+# Same prompts, terms, plan, selection and response as test7; only the I/O differs. Image
+# download, the Groq calls and the catalog pages are awaited on the event loop instead of
+# blocking a thread, so one process can hold thousands of requests that are waiting on them.
+# Shared state (catalog_cache, query_planner, result_cursors, catalog_index) is test7's.
+
+load_dotenv()
+IMAGE_FETCH_TIMEOUT = 15  # seconds, as in test7.image_to_base64
+
+# Clients and semaphores are bound to the event loop they were created on
+_loop_state = weakref.WeakKeyDictionary()
+
+
+def _state():
+    loop = asyncio.get_running_loop()
+    if loop not in _loop_state:
+        groq_api_key = os.getenv("GROQ_API_KEY")
+        _loop_state[loop] = {
+            "groq": AsyncGroq(api_key=groq_api_key) if groq_api_key else None,
+            "http": httpx.AsyncClient(timeout=IMAGE_FETCH_TIMEOUT, follow_redirects=True),
+            # Per-host cap on catalog requests, like test7._catalog_request_slots
+            "catalog_slots": asyncio.Semaphore(PASS1_MAX_CONCURRENCY),
+            "background": set(),
+        }
+    return _loop_state[loop]
+
+
+async def close_clients():
+    """Close this loop's HTTP clients (ASGI lifespan shutdown)."""
+    state = _loop_state.pop(asyncio.get_running_loop(), None)
+    if state:
+        await state["http"].aclose()
+        if state["groq"] is not None:
+            await state["groq"].close()
+    await get_async_catalog_client().close()
+
+
+def _in_background(coro):
+    """Run coro as a task nobody awaits (e.g. a page prefetched past an early stop)."""
+    state = _state()
+    task = asyncio.ensure_future(coro)
+    state["background"].add(task)
+    task.add_done_callback(lambda t: (state["background"].discard(t), t.cancelled() or t.exception()))
+    return task
+
+
+# --- Image and LLM stages ---
+async def image_to_base64_async(image_path_or_url):
+    """test7.image_to_base64 with the URL download awaited (local files are read in a thread)."""
+    if not (image_path_or_url.startswith('http://') or image_path_or_url.startswith('https://')):
+        return await asyncio.to_thread(image_to_base64, image_path_or_url)
+    print(f"  Fetching image from URL: {image_path_or_url}")
+    try:
+        response = await _state()["http"].get(image_path_or_url)
+        response.raise_for_status()
+    except httpx.TimeoutException:
+        print(f"  Error: Timeout while fetching image URL: {image_path_or_url}")
+        return None
+    except httpx.HTTPError as e:
+        print(f"  Error: Failed to download or access image URL: {image_path_or_url}. Error: {e}")
+        return None
+    if not response.content:
+        print(f"  Error: Failed to obtain image content for {image_path_or_url}")
+        return None
+    return base64.b64encode(response.content).decode('utf-8')
+
+
+async def generate_caption_async(image_path_or_url):
+    groq_client = _state()["groq"]
+    if not groq_client:
+        print("Error: Groq client not initialized. Check API key.")
+        return None
+    print(f"Attempting to generate caption for source: {image_path_or_url}")
+    image_base64 = await image_to_base64_async(image_path_or_url)
+    if not image_base64:
+        print("Image conversion to base64 failed.")
+        return None
+    try:
+        response = await groq_client.chat.completions.create(**caption_request(image_base64))
+        caption = response.choices[0].message.content.strip()
+        print(f"Generated Caption: {caption}")
+        return caption
+    except Exception as e:
+        print(f"Error in LLaMA vision request: {e}")
+        return None
+
+
+async def create_json_from_caption_async(caption):
+    groq_client = _state()["groq"]
+    if not groq_client:
+        print("Error: Groq client not initialized. Check API key.")
+        return None
+    print(f"Creating JSON from caption: {caption}")
+    try:
+        response = await groq_client.chat.completions.create(**caption_json_request(caption))
+        return parse_caption_json(response.choices[0].message.content.strip())
+    except Exception as e:
+        print(f"Error in LLaMA JSON creation request: {e}")
+        return None
+
+
+async def create_json_from_text_query_async(query):
+    """Attributes for a text query: local rules first, the LLM only if they find nothing. Returns (json, source)."""
+    json_prompt = extract_attributes_locally(query)
+    if json_prompt:
+        print(f"Extracted attributes locally from text query: {json_prompt}")
+        return json_prompt, "local"
+    print("Local attribute extraction found no type or design; asking the LLM.")
+    return await create_json_from_caption_async(query), "llm"
+
+
+async def select_pass3_llm_term_async(search):
+    print("  No specific filter term found. Trying LLM fallback...")
+    groq_client = _state()["groq"]
+    if not groq_client:
+        print("Error: Groq client not initialized for additional keyword extraction.")
+        return "", ""
+    exclusions = pass3_llm_exclusions(search["design"], search["material"], search["material_search_term"],
+                                      search["jew_type"], search["categories"], search["used_filter_term_pass2"])
+    print("    Attempting AI suggestion for Pass 3 keywords (Fallback)...")
+    try:
+        response = await groq_client.chat.completions.create(**keyword_request(search["initial_caption"], exclusions))
+        llm_keyword = parse_keyword_response(response.choices[0].message.content, exclusions)
+    except Exception as e:
+        print(f"    Error during AI fallback keyword suggestion: {e}")
+        llm_keyword = ""
+    return accept_pass3_llm_term(llm_keyword, search["used_filter_term_pass2"])
+
+
+# --- Catalog pages ---
+async def _fetch_catalog_page_upstream_async(search_body):
+    async with _state()["catalog_slots"]:
+        response = await get_async_catalog_client().get(search_body)
+    print(f"  API Response Status (Pass 1, Type={search_body.get('type')}, Offset={search_body.get('offset')}): {response.status_code}")
+    response.raise_for_status()
+    data = response.json().get("data", [])
+    test7.query_term_stats.observe_page(data, int(response.headers.get("Content-Length") or len(response.content)))
+    return data
+
+
+async def fetch_catalog_page_async(search_body):
+    """One page of catalog results, from test7.catalog_cache when possible."""
+    return await test7.catalog_cache.get_async(search_body, _fetch_catalog_page_upstream_async)
+
+
+async def iter_pass1_pages_async(search_type, title_term, search_style, limit_per_call, max_results, state,
+                                 first_page=None, first_page_limit=None):
+    """test7.iter_pass1_pages with pages fetched as tasks (same waves, order and stop rules)."""
+    print(f"Fetching results for type '{search_type}'...")
+    offset = 0
+    wave_size = 1
+    fetched = 0
+    while offset < max_results:
+        search_bodies = []
+        while offset < max_results and len(search_bodies) < wave_size:
+            page_limit = first_page_limit if offset == 0 and first_page_limit else limit_per_call
+            search_bodies.append(_pass1_search_body(search_type, title_term, search_style, offset, min(page_limit, max_results - offset)))
+            offset += page_limit
+        tasks = []
+        for search_body in search_bodies:
+            if first_page is not None and search_body["offset"] == 0:
+                tasks.append(first_page)
+            else:
+                print(f"  API Request (Pass 1, Type={search_type}): {search_body}")
+                tasks.append(_in_background(fetch_catalog_page_async(search_body)))
+        for search_body, task in zip(search_bodies, tasks):
+            try:
+                current_batch = await asyncio.shield(task)
+            except httpx.TimeoutException:
+                print(f"  Error: Pass 1 API search timed out for type '{search_type}'. Proceeding with {fetched} fetched results.")
+                state["api_error"] = True
+                return
+            except httpx.HTTPError as e:
+                print(f"  Error: Pass 1 API search failed for type '{search_type}': {e}")
+                state["api_error"] = True
+                return
+            except Exception as e:
+                print(f"  Error: Unexpected error during Pass 1 for type '{search_type}': {e}")
+                state["api_error"] = True
+                return
+            state["pages_fetched"] = state.get("pages_fetched", 0) + 1
+            fetched += len(current_batch)
+            if current_batch:
+                yield current_batch
+            if len(current_batch) < search_body["limit"]:
+                return
+        wave_size = min(wave_size * 2, PASS1_MAX_CONCURRENCY)
+
+
+async def iter_pass1_items_async(search_types, title_term, search_style, limit_per_call, max_results, state, first_page_limit=None):
+    """test7.iter_pass1_items as an async generator: first pages of every type up front, later pages on demand."""
+    first_pages = {}
+    for search_type in search_types:
+        search_body = _pass1_search_body(search_type, title_term, search_style, 0, min(first_page_limit or limit_per_call, max_results))
+        print(f"  API Request (Pass 1, Type={search_type}): {search_body}")
+        first_pages[search_type] = _in_background(fetch_catalog_page_async(search_body))
+    added_ids = set()
+    for search_type in search_types:
+        pages = iter_pass1_pages_async(search_type, title_term, search_style, limit_per_call, max_results, state,
+                                       first_pages[search_type], first_page_limit)
+        try:
+            async for current_batch in pages:
+                for item in current_batch:
+                    item_id = item.get("id")
+                    if item_id and item_id not in added_ids:
+                        added_ids.add(item_id)
+                        yield item
+                        if len(added_ids) >= max_results:
+                            return
+        finally:
+            await pages.aclose()
+
+
+# --- Search ---
+async def stream_pass1_step_async(search, step, title_term, required_terms):
+    """test7.stream_pass1_step for one plan step; the Pass 3 LLM fallback is awaited on the first item."""
+    pass1_step = Pass1Step(required_terms, search["used_filter_term_pass2"], search["desired_limit"],
+                           search["accept_item"], search["item_key"], RESULT_CURSOR_MAX_CANDIDATES,
+                           step_facets(search, title_term, required_terms))
+    third_pass_filter_term, pass3_active = None, False
+    stream_state = {"api_error": False}
+    pass1_items = iter_pass1_items_async(search["search_types"], title_term, search["search_style"], search["limit_per_call"],
+                                         search["max_total_results_fetch"], stream_state, step["first_page_limit"])
+    try:
+        async for api_item in pass1_items:
+            item = pass1_step.accept(api_item)
+            if item is None:
+                continue
+            if third_pass_filter_term is None:
+                term, source = search["local_term_pass3"], search["local_source_pass3"]
+                if pass3_needs_llm(search):
+                    term, source = await select_pass3_llm_term_async(search)
+                third_pass_filter_term, pass3_active = record_pass3_term(search, term, source)
+            if pass1_step.add(item, third_pass_filter_term, pass3_active):
+                break
+    finally:
+        await pass1_items.aclose()
+    return pass1_step.finish(stream_state)
+
+
+async def search_similar_products_async(json_prompt, initial_caption, desired_limit=10, min_price=None, max_price=None, sort=None):
+    """test7.search_similar_products on the event loop; returns the same response."""
+    search, error_result = prepare_search(json_prompt, initial_caption, desired_limit, min_price, max_price, sort)
+    if error_result:
+        return error_result
+    step_index = 0
+    while True:
+        step, is_material_step, title_term, required_terms = describe_plan_step(search, step_index)
+        outcome = await stream_pass1_step_async(search, step, title_term, required_terms)
+        if is_material_step or outcome["filled"]:
+            break
+        step_index = next_plan_step(search, step_index, title_term, outcome)
+    return combine_search_results(search, outcome)
@@ -0,0 +1,178 @@
+# catalog_cache.py
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Cache Constants ---
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "300"))              # seconds a page is served as fresh
+CATALOG_CACHE_STALE_TTL = float(os.getenv("CATALOG_CACHE_STALE_TTL", "900"))  # extra seconds served stale while refreshing
+CATALOG_CACHE_MAX_ITEMS = int(os.getenv("CATALOG_CACHE_MAX_ITEMS", "50000"))  # bound on cached catalog items across all pages
+REFRESH_WORKERS = 2
+
+
+def canonical_key(search_body):
+    """Canonical cache key for a catalog query: (title, style, type, offset, limit)."""
+    style = search_body.get("style") or []
+    if isinstance(style, str):
+        style = [style]
+    return (
+        (search_body.get("title") or "").strip().lower(),
+        tuple(sorted(s.strip().lower() for s in style if s)),
+        (search_body.get("type") or "").strip().lower(),
+        int(search_body.get("offset") or 0),
+        int(search_body.get("limit") or 0),
+    )
+
+
+class CatalogCache:
+    """
+    Cache in front of the catalog API.
+    - Fresh entries (younger than ttl) are served directly.
+    - Stale entries (up to ttl + stale_ttl) are served immediately while one background
+      refresh replaces them (stale-while-revalidate).
+    - Concurrent misses for the same key are coalesced: one upstream request is in flight and
+      every caller waits for its result. Errors reach all waiters and are never cached.
+    Cached pages are shared between requests and must be treated as read-only.
+    """
+
+    def __init__(self, fetch_fn, ttl=CATALOG_CACHE_TTL, stale_ttl=CATALOG_CACHE_STALE_TTL, max_items=CATALOG_CACHE_MAX_ITEMS):
+        self.fetch_fn = fetch_fn
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_items = max_items
+        self._entries = OrderedDict()  # key -> (fetched_at, page)
+        self._cached_items = 0
+        self._in_flight = {}           # key -> Future of the upstream request
+        self._async_in_flight = {}     # key -> asyncio.Future of an upstream request made by get_async
+        self._lock = threading.Lock()
+        self._refresh_pool = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="catalog-cache-refresh")
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0,
+                       "upstream_calls": 0, "upstream_errors": 0, "refreshes": 0, "evictions": 0}
+
+    def _cached(self, key, search_body):
+        """Fresh or stale cached page for key (starting a background refresh if stale), else None. Hold _lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        age = time.monotonic() - entry[0]
+        if age < self.ttl:
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+        if age < self.ttl + self.stale_ttl:
+            self._entries.move_to_end(key)
+            self._stats["stale_hits"] += 1
+            if key not in self._in_flight:
+                self._stats["refreshes"] += 1
+                self._in_flight[key] = Future()
+                self._refresh_pool.submit(self._fetch, key, search_body, self._in_flight[key])
+            return entry[1]
+        return None
+
+    def get(self, search_body):
+        """Return the page for search_body, from cache when possible."""
+        key = canonical_key(search_body)
+        with self._lock:
+            page = self._cached(key, search_body)
+            if page is not None:
+                return page
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                self._stats["misses"] += 1
+                future = self._in_flight[key] = Future()
+            else:
+                self._stats["coalesced"] += 1
+        if owner:
+            self._fetch(key, search_body, future)
+        return future.result()
+
+    async def get_async(self, search_body, fetch_async):
+        """
+        get() for asyncio callers: a miss awaits fetch_async(search_body) instead of blocking a
+        thread, and concurrent async misses for the same key share one upstream request.
+        Stale entries are still refreshed in the background thread pool.
+        """
+        key = canonical_key(search_body)
+        with self._lock:
+            page = self._cached(key, search_body)
+            if page is not None:
+                return page
+            future = self._async_in_flight.get(key)
+            owner = future is None
+            if owner:
+                self._stats["misses"] += 1
+                self._stats["upstream_calls"] += 1
+                future = self._async_in_flight[key] = asyncio.get_running_loop().create_future()
+            else:
+                self._stats["coalesced"] += 1
+        if not owner:
+            return await asyncio.shield(future)
+        try:
+            page = await fetch_async(search_body)
+        except BaseException as e:
+            with self._lock:
+                self._stats["upstream_errors"] += 1
+                self._async_in_flight.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # waiters re-raise it; mark it retrieved if there are none
+            raise
+        with self._lock:
+            self._store(key, page)
+            self._async_in_flight.pop(key, None)
+        future.set_result(page)
+        return page
+
+    def _fetch(self, key, search_body, future):
+        """Run the upstream request for key and publish the result (or error) to its waiters."""
+        with self._lock:
+            self._stats["upstream_calls"] += 1
+        try:
+            page = self.fetch_fn(search_body)
+        except BaseException as e:
+            with self._lock:
+                self._stats["upstream_errors"] += 1
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            return
+        with self._lock:
+            self._store(key, page)
+            self._in_flight.pop(key, None)
+        future.set_result(page)
+
+    def _store(self, key, page):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._cached_items -= len(old[1])
+        self._entries[key] = (time.monotonic(), page)
+        self._cached_items += len(page)
+        while self._cached_items > self.max_items and len(self._entries) > 1:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._cached_items -= len(evicted)
+            self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._cached_items = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["cached_items"] = self._cached_items
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"] + stats["coalesced"]
+        served_without_upstream = stats["hits"] + stats["stale_hits"] + stats["coalesced"]
+        stats["hit_rate"] = round(served_without_upstream / lookups, 4) if lookups else 0.0
+        stats["upstream_calls_saved"] = served_without_upstream
+        return stats
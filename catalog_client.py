@@ -0,0 +1,221 @@
+# catalog_client.py
+import os
+import time
+import asyncio
+import threading
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Catalog API configuration ---
+API_URL = os.getenv("API_URL")
+API_APP = os.getenv("API_APP")
+API_KEY = os.getenv("API_KEY")
+API_SECRET = os.getenv("API_SECRET")
+HEADERS = {
+    "x-api-app": API_APP,
+    "x-api-key": API_KEY,
+    "x-api-secret": API_SECRET,
+    "Content-Type": "application/json"
+} if all([API_APP, API_KEY, API_SECRET]) else {} # Ensure headers are valid
+
+# --- Transport Constants ---
+CATALOG_CONNECT_TIMEOUT = float(os.getenv("CATALOG_CONNECT_TIMEOUT", "3.05"))  # seconds to establish TCP+TLS
+CATALOG_READ_TIMEOUT = float(os.getenv("CATALOG_READ_TIMEOUT", "20"))         # seconds between bytes of a response
+CATALOG_POOL_SIZE = int(os.getenv("CATALOG_POOL_SIZE", "8"))                  # keep-alive connections kept per host
+CATALOG_PAGE_SIZE = 500
+
+
+class CatalogConfigError(RuntimeError):
+    """API_URL / API_APP / API_KEY / API_SECRET are not all set; raised when a request is made."""
+
+
+def _config_missing():
+    print("Error: Brilliance Hub API configuration missing.")
+    return CatalogConfigError("Brilliance Hub API configuration missing.")
+
+
+class CatalogClient:
+    """
+    HTTP transport for the Brilliance Hub API. One pooled requests.Session keeps connections
+    alive between page requests (one TCP+TLS handshake per pooled connection instead of one
+    per page), asks for gzip-compressed JSON and uses separate connect/read timeouts.
+    Safe to share between threads; use get_catalog_client() for the per-process instance.
+    """
+
+    def __init__(self, api_url=API_URL, headers=HEADERS, connect_timeout=CATALOG_CONNECT_TIMEOUT,
+                 read_timeout=CATALOG_READ_TIMEOUT, pool_size=CATALOG_POOL_SIZE):
+        self.api_url = api_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        self.session.headers.update(headers)
+        self.session.headers["Accept-Encoding"] = "gzip"
+        self._configured = bool(api_url) and bool(headers)
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "errors": 0, "compressed_responses": 0, "unmeasured_responses": 0,
+                       "bytes_received": 0, "bytes_decoded": 0, "bytes_decoded_measured": 0, "request_seconds": 0.0}
+
+    def get(self, params, read_timeout=None):
+        """
+        GET the catalog endpoint with params. Returns the requests.Response (status not checked).
+        Raises CatalogConfigError if the API is not configured.
+        """
+        if not self._configured:
+            raise _config_missing()
+        start_time = time.perf_counter()
+        try:
+            response = self.session.get(self.api_url, params=params,
+                                        timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+        except requests.RequestException:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        elapsed = time.perf_counter() - start_time
+        decoded = len(response.content)
+        compressed = "gzip" in response.headers.get("Content-Encoding", "")
+        # Bytes read off the wire (before gzip decoding). urllib3 does not count a chunked body,
+        # so without a Content-Length such a response is left out of compression_ratio.
+        received = response.raw.tell() or response.headers.get("Content-Length")
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["request_seconds"] += elapsed
+            self._stats["bytes_decoded"] += decoded
+            self._stats["compressed_responses"] += compressed
+            if received is None:
+                self._stats["unmeasured_responses"] += 1
+            else:
+                self._stats["bytes_received"] += int(received)
+                self._stats["bytes_decoded_measured"] += decoded
+        return response
+
+    def fetch_page(self, params, read_timeout=None):
+        """GET one page and return its 'data' list. Raises requests.HTTPError on an error status."""
+        response = self.get(params, read_timeout)
+        response.raise_for_status()
+        return response.json().get("data", [])
+
+    def _connections_opened(self):
+        # urllib3 counts the connections each host pool had to open
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in list(pools.keys()) if key in pools)
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        connections = self._connections_opened()
+        requests_made = stats["requests"] + stats["errors"]
+        stats["connections_opened"] = connections
+        stats["connections_reused"] = max(requests_made - connections, 0)
+        stats["reuse_rate"] = round(stats["connections_reused"] / requests_made, 4) if requests_made else 0.0
+        stats["avg_request_ms"] = round(stats.pop("request_seconds") / stats["requests"] * 1000, 2) if stats["requests"] else 0.0
+        decoded_measured = stats.pop("bytes_decoded_measured")
+        stats["compression_ratio"] = round(decoded_measured / stats["bytes_received"], 2) if stats["bytes_received"] else 0.0
+        return stats
+
+
+# One client per worker process; a forked worker builds its own instead of sharing sockets
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_catalog_client():
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client, _client_pid = CatalogClient(), os.getpid()
+    return _client
+
+
+class AsyncCatalogClient:
+    """
+    asyncio counterpart of CatalogClient for the async pipeline: one httpx.AsyncClient with a
+    bounded keep-alive pool, gzip and the same connect/read timeouts. Bound to the event loop
+    it was created on; use get_async_catalog_client() from inside that loop.
+    """
+
+    def __init__(self, api_url=API_URL, headers=HEADERS, connect_timeout=CATALOG_CONNECT_TIMEOUT,
+                 read_timeout=CATALOG_READ_TIMEOUT, pool_size=CATALOG_POOL_SIZE):
+        self.api_url = api_url
+        self.read_timeout = read_timeout
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._configured = bool(api_url) and bool(headers)
+        self.client = httpx.AsyncClient(headers=dict(headers, **{"Accept-Encoding": "gzip"}), timeout=self.timeout,
+                                        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+        self._stats = {"requests": 0, "errors": 0, "compressed_responses": 0,
+                       "bytes_received": 0, "bytes_decoded": 0, "request_seconds": 0.0}
+
+    async def get(self, params, read_timeout=None):
+        """
+        GET the catalog endpoint with params. Returns the httpx.Response (status not checked).
+        Raises CatalogConfigError if the API is not configured.
+        """
+        if not self._configured:
+            raise _config_missing()
+        start_time = time.perf_counter()
+        timeout = self.timeout if read_timeout is None else httpx.Timeout(read_timeout, connect=self.timeout.connect)
+        try:
+            response = await self.client.get(self.api_url, params=params, timeout=timeout)
+        except httpx.HTTPError:
+            self._stats["errors"] += 1
+            raise
+        decoded = len(response.content)
+        self._stats["requests"] += 1
+        self._stats["request_seconds"] += time.perf_counter() - start_time
+        self._stats["bytes_received"] += response.num_bytes_downloaded  # off the wire, chunked or not
+        self._stats["bytes_decoded"] += decoded
+        self._stats["compressed_responses"] += "gzip" in response.headers.get("Content-Encoding", "")
+        return response
+
+    async def close(self):
+        await self.client.aclose()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["avg_request_ms"] = round(stats.pop("request_seconds") / stats["requests"] * 1000, 2) if stats["requests"] else 0.0
+        stats["compression_ratio"] = round(stats["bytes_decoded"] / stats["bytes_received"], 2) if stats["bytes_received"] else 0.0
+        return stats
+
+
+# One async client per event loop (httpx connections cannot move between loops)
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_catalog_client():
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = AsyncCatalogClient()
+    return _async_clients[loop]
+
+
+def iter_catalog_items(page_size=CATALOG_PAGE_SIZE, max_items=None):
+    """Page through the whole Brilliance Hub catalog, yielding raw item dicts."""
+    if not HEADERS or not API_URL:
+        print("Error: Brilliance Hub API configuration missing.")
+        return
+    client = get_catalog_client()
+    offset = 0
+    fetched = 0
+    while max_items is None or fetched < max_items:
+        limit = page_size if max_items is None else min(page_size, max_items - fetched)
+        batch = client.fetch_page({"offset": offset, "limit": limit}, read_timeout=30)
+        for item in batch:
+            yield item
+        fetched += len(batch)
+        if len(batch) < limit:
+            break
+        offset += limit
+        time.sleep(0.1)
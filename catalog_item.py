@@ -0,0 +1,129 @@
+# catalog_item.py
+import sys
+import json
+import time
+import argparse
+import threading
+import tracemalloc
+
+# Materials recognised in titles, most specific first ("Sterling Silver" before "Silver")
+MATERIAL_NAMES = ["Sterling Silver", "Silver Plated", "Gold Plated", "Yellow Gold", "Rose Gold", "White Gold",
+                  "Platinum", "Palladium", "Stainless Steel", "Titanium", "Tungsten", "Brass", "Copper",
+                  "Silver", "Gold"]
+_MATERIAL_NAMES_LOWER = [(name.lower(), name) for name in MATERIAL_NAMES]
+
+
+def _interned(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def title_material(title):
+    """The first of MATERIAL_NAMES named in title (case-insensitive), or None. Returns the shared list entry."""
+    title = (title or "").lower()
+    return next((name for lowered, name in _MATERIAL_NAMES_LOWER if lowered in title), None)
+
+
+def parse_price(value):
+    """jew_sell_price as a float, or None if it is missing or not a number."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CatalogItem:
+    """
+    Record for one catalog item held during a search, with only the fields the passes read:
+    the lowercased title (term matching), the parsed price (price filter and sort) and the
+    type, material, categories and currency, which are low-cardinality strings interned so
+    every record shares one copy. The material is the one named in the title (title_material).
+    The raw API dict is kept as is (it is shared with the catalog_cache page it came from);
+    the title, image and every other field are read from it, and to_dict() returns it as the
+    payload sent to the client.
+
+    This trades memory for precomputation: the dicts themselves are not copied, but each
+    record adds an object, a lowercased title and a categories tuple on top of the cached
+    page (about 1.3 MB per request for 5000 items, against 0.04 MB for a plain list of the
+    dicts; run this module to measure). In exchange the title is lowercased and the price
+    parsed once per item rather than in every pass, filter and sort key.
+    """
+    __slots__ = ("id", "title_lower", "jew_type", "material", "categories", "sell_price", "currency_sym", "raw")
+
+    def __init__(self, item_id, title, jew_type, categories, sell_price, currency_sym, raw=None):
+        self.id = item_id
+        self.title_lower = title.lower() if title else None
+        self.jew_type = _interned(jew_type)
+        self.material = title_material(self.title_lower)
+        self.categories = tuple(_interned(cat) for cat in categories or ())
+        self.sell_price = sell_price
+        self.currency_sym = _interned(currency_sym)
+        self.raw = raw
+
+    @classmethod
+    def from_api(cls, item):
+        """Build a record from one catalog API dict (the dict is shared and never modified)."""
+        return cls(item.get("id"), item.get("jew_title"), item.get("jew_type"), item.get("jew_categories"),
+                   parse_price(item.get("jew_sell_price")), item.get("currency_sym"), item)
+
+    def to_dict(self):
+        """The API payload for this item."""
+        return self.raw
+
+    def __repr__(self):
+        return f"CatalogItem(id={self.id!r}, type={self.jew_type!r}, material={self.material!r})"
+
+
+# --- Benchmark: per-request footprint of Pass 1 results over a cached page ---
+# The raw API dicts are not freed by a search: catalog_cache keeps the parsed page (for up to
+# CATALOG_CACHE_TTL + CATALOG_CACHE_STALE_TTL, 20 minutes by default) and every record points
+# at its dict. So the page is counted once, and per request only what the search adds on top:
+# a list of references to the dicts, or one CatalogItem per item.
+def _synthetic_page_bytes(n):
+    items = []
+    for i in range(n):
+        items.append({
+            "id": i + 1, "jew_title": f"Sterling Silver Blue Topaz Heart Pendant {i}", "jew_type": "Pendants",
+            "jew_categories": ["Heart", "Classic"], "jew_sell_price": f"{20 + i % 900}.99", "currency_sym": "$",
+            "jew_default_img": f"https://cdn.example.com/img/{i + 1}.jpg", "jew_sku": f"SKU{i + 1:06d}",
+            "jew_company": "Brilliance", "jew_status": "Active", "jew_desc": "Polished sterling silver pendant. " * 6,
+            "jew_images": [f"https://cdn.example.com/img/{i + 1}-{k}.jpg" for k in range(4)], "jew_videos": [],
+        })
+    return json.dumps({"data": items}).encode("utf-8")
+
+
+def _hold_request(data, compact, barrier, held):
+    # Keep the request's results and wait until all simulated requests hold theirs so the peak
+    # covers them at once
+    held.append([CatalogItem.from_api(item) for item in data] if compact else list(data))
+    barrier.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-request memory of Pass 1 results: raw dicts vs CatalogItem.")
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    page_bytes = _synthetic_page_bytes(args.items)
+    tracemalloc.start()
+    cached_page = json.loads(page_bytes)["data"]
+    page_size, _ = tracemalloc.get_traced_memory()
+    print(f"cached page : {page_size / 2**20:7.2f} MB, held by catalog_cache and shared by every request")
+    for label, compact in [("raw dicts", False), ("CatalogItem", True)]:
+        held = []
+        barrier = threading.Barrier(args.concurrency + 1)
+        base_bytes, _ = tracemalloc.get_traced_memory()
+        start_time = time.perf_counter()
+        threads = [threading.Thread(target=_hold_request, args=(cached_page, compact, barrier, held))
+                   for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        held_bytes, _ = tracemalloc.get_traced_memory()
+        elapsed = time.perf_counter() - start_time
+        for thread in threads:
+            thread.join()
+        print(f"{label:12s}: {(held_bytes - base_bytes) / args.concurrency / 2**20:7.2f} MB per request on top of the page "
+              f"({args.concurrency} concurrent requests x {args.items} items, {elapsed:.2f}s)")
+        del held
+    tracemalloc.stop()
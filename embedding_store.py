@@ -0,0 +1,248 @@
+# embedding_store.py
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Flat, versioned snapshot format ---
+# [8-byte magic][uint32 format version][uint32 header length][JSON header][padding]
+# followed by every array's raw bytes, each starting on an ARRAY_ALIGNMENT boundary.
+# The JSON header records dtype/shape/offset per array plus free-form metadata, so a
+# reader can mmap the file read-only and wrap each array with np.frombuffer (no copy).
+# Every worker mapping the same file shares one copy of the data in the OS page cache.
+SNAPSHOT_MAGIC = b"JEWSNAP\x00"
+SNAPSHOT_FORMAT_VERSION = 1
+ARRAY_ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<8sII")
+
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", "embedding_store")
+CURRENT_POINTER = "CURRENT"
+RELOAD_CHECK_INTERVAL = 5.0  # seconds between checks of the CURRENT pointer
+SNAPSHOTS_KEPT = 2  # the current snapshot plus the one workers may still be serving until their next check
+
+
+def _aligned(offset):
+    return (offset + ARRAY_ALIGNMENT - 1) // ARRAY_ALIGNMENT * ARRAY_ALIGNMENT
+
+
+def write_flat_file(path, arrays, metadata=None, format_version=SNAPSHOT_FORMAT_VERSION):
+    """
+    Write named numpy arrays into one flat snapshot file. The file is written to a temporary
+    name, fsynced and renamed into place, so readers never observe a partial snapshot.
+    """
+    arrays = {name: np.ascontiguousarray(value) for name, value in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, value in arrays.items():
+        layout[name] = {"dtype": value.dtype.str, "shape": list(value.shape), "offset": offset, "nbytes": value.nbytes}
+        offset = _aligned(offset + value.nbytes)
+    header = json.dumps({"metadata": metadata or {}, "arrays": layout}).encode("utf-8")
+    data_start = _aligned(_PREAMBLE.size + len(header))
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, format_version, len(header)))
+        f.write(header)
+        for name, value in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(value.tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def open_flat_file(path, expected_version=SNAPSHOT_FORMAT_VERSION):
+    """
+    Map a snapshot file read-only. Returns (metadata, arrays) where every array is a
+    read-only view into the shared mapping. Raises ValueError on a bad magic or version, or
+    on a file too short to hold the preamble.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # ValueError if the file is empty
+    try:
+        magic, version, header_len = _PREAMBLE.unpack_from(mapped, 0)
+    except struct.error:
+        raise ValueError(f"'{path}' is truncated ({len(mapped)} bytes).")
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f"'{path}' is not a snapshot file.")
+    if version != expected_version:
+        raise ValueError(f"'{path}' has snapshot format version {version}, expected {expected_version}.")
+    header = json.loads(mapped[_PREAMBLE.size:_PREAMBLE.size + header_len].decode("utf-8"))
+    data_start = _aligned(_PREAMBLE.size + header_len)
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"], dtype=np.int64))
+        if count == 0:
+            arrays[name] = np.zeros(spec["shape"], dtype=dtype)
+            continue
+        arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count,
+                                     offset=data_start + spec["offset"]).reshape(spec["shape"])
+    return header["metadata"], arrays
+
+
+# --- Embedding index snapshots ---
+def write_embedding_snapshot(index, store_dir=EMBEDDING_STORE_DIR, version=None):
+    """
+    Write an ImageEmbeddingIndex (vectors, id mapping and any ANN structures) as a new
+    snapshot and atomically repoint CURRENT at it. Returns the snapshot file path.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    version = version or time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+    with index._lock:
+        arrays = index.to_arrays()
+        metadata = dict(index.metadata(), version=version)
+    snapshot_name = f"snapshot-{version}.emb"
+    write_flat_file(os.path.join(store_dir, snapshot_name), arrays, metadata)
+
+    pointer_tmp = os.path.join(store_dir, f"{CURRENT_POINTER}.tmp-{os.getpid()}")
+    with open(pointer_tmp, "w") as f:
+        f.write(snapshot_name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer_tmp, os.path.join(store_dir, CURRENT_POINTER))
+    print(f"Wrote embedding snapshot '{snapshot_name}' ({len(index)} vectors) to '{store_dir}'.")
+    prune_embedding_snapshots(store_dir, snapshot_name)
+    return os.path.join(store_dir, snapshot_name)
+
+
+def prune_embedding_snapshots(store_dir, current_name, keep=SNAPSHOTS_KEPT):
+    """
+    Delete superseded snapshots, keeping current_name and the newest others up to `keep` in
+    total. A worker that still has a deleted snapshot mapped keeps reading it: the file's
+    blocks are only freed once the last mapping goes away.
+    """
+    snapshots = [os.path.join(store_dir, name) for name in os.listdir(store_dir)
+                 if name.startswith("snapshot-") and name.endswith(".emb") and name != current_name]
+    snapshots.sort(key=os.path.getmtime, reverse=True)
+    for path in snapshots[max(keep - 1, 0):]:
+        try:
+            os.remove(path)
+            print(f"Removed superseded embedding snapshot '{os.path.basename(path)}'.")
+        except OSError as e:
+            print(f"Warning: Could not remove embedding snapshot '{path}': {e}")
+
+
+def open_embedding_snapshot(path):
+    """Open a snapshot as an ImageEmbeddingIndex whose arrays live in a read-only mmap."""
+    from image_index import ImageEmbeddingIndex
+
+    metadata, arrays = open_flat_file(path)
+    return ImageEmbeddingIndex.from_arrays(arrays, metadata)
+
+
+class EmbeddingStore:
+    """
+    Serves the snapshot named by CURRENT in a store directory. current() re-reads the pointer
+    at most every check_interval seconds and swaps in a newly published snapshot without a
+    restart; requests already holding the previous index keep using its mapping until done.
+    """
+
+    def __init__(self, store_dir=EMBEDDING_STORE_DIR, check_interval=RELOAD_CHECK_INTERVAL):
+        self.store_dir = store_dir
+        self.check_interval = check_interval
+        self.snapshot_name = None
+        self.index = None
+        self.load_seconds = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _read_pointer(self):
+        try:
+            with open(os.path.join(self.store_dir, CURRENT_POINTER)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def current(self):
+        """Return the current ImageEmbeddingIndex, or None if no snapshot was published yet."""
+        now = time.monotonic()
+        if now < self._next_check:
+            return self.index
+        with self._lock:
+            if now < self._next_check:
+                return self.index
+            self._next_check = now + self.check_interval
+            snapshot_name = self._read_pointer()
+            if snapshot_name and snapshot_name != self.snapshot_name:
+                start_time = time.perf_counter()
+                try:
+                    index = open_embedding_snapshot(os.path.join(self.store_dir, snapshot_name))
+                except (OSError, ValueError) as e:
+                    print(f"Error: Could not open embedding snapshot '{snapshot_name}': {e}")
+                    return self.index
+                self.load_seconds = time.perf_counter() - start_time
+                self.index, self.snapshot_name = index, snapshot_name
+                print(f"Loaded embedding snapshot '{snapshot_name}' ({len(index)} vectors) in {self.load_seconds * 1000:.1f}ms")
+        return self.index
+
+    def stats(self):
+        return {
+            "snapshot": self.snapshot_name,
+            "vectors": len(self.index) if self.index is not None else 0,
+            "load_ms": round(self.load_seconds * 1000, 2) if self.load_seconds is not None else None,
+        }
+
+
+# --- Benchmark: worker cold start with np.load (copy per worker) vs mmap snapshot ---
+_COLD_START_SCRIPT = """
+import sys, time
+sys.path.insert(0, {repo!r})
+import numpy as np
+import ann_index, image_index, embedding_store
+
+def private_mb():
+    # Anonymous memory is private to this worker; pages mapped from the snapshot file are not
+    # counted because they live in the page cache shared by every worker mapping the file
+    with open("/proc/self/smaps_rollup") as f:
+        fields = dict(line.split(":", 1) for line in f)
+    return int(fields["Anonymous"].split()[0]) / 1024
+
+query = np.ones({dim}, dtype=np.float32)
+before = private_mb()
+start = time.perf_counter()
+if {mode!r} == "npz":
+    index = image_index.ImageEmbeddingIndex.load({path!r})
+else:
+    index = embedding_store.open_embedding_snapshot({path!r})
+index.search(query, k=10)
+elapsed = time.perf_counter() - start
+print(elapsed, private_mb() - before)
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure worker cold start: npz load vs mmap snapshot.")
+    parser.add_argument("--n", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--dir", default="/tmp/embedding_store_bench")
+    args = parser.parse_args()
+
+    from image_index import ImageEmbeddingIndex
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((args.n, args.dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index = ImageEmbeddingIndex([f"item-{i}" for i in range(args.n)], vectors, "synthetic")
+    os.makedirs(args.dir, exist_ok=True)
+    npz_path = os.path.join(args.dir, "image_index.npz")
+    index.save(npz_path)
+    snapshot_path = write_embedding_snapshot(index, args.dir)
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    for mode, path in [("npz", npz_path), ("mmap", snapshot_path)]:
+        script = _COLD_START_SCRIPT.format(repo=repo_dir, dim=args.dim, mode=mode, path=path)
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        elapsed, private_mb = output.strip().splitlines()[-1].split()
+        print(f"{mode:5s} cold start (load + first query): {float(elapsed) * 1000:8.1f}ms, "
+              f"per-worker private memory {float(private_mb):8.1f} MB")
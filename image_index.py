@@ -0,0 +1,511 @@
+# image_index.py
+import io
+import os
+import json
+import hashlib
+import threading
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModelWithProjection
+from dotenv import load_dotenv
+
+from ann_index import ANN_INDEX_TYPES, PQIndex, exact_search_scores
+from catalog_client import iter_catalog_items
+from embedding_store import EMBEDDING_STORE_DIR, write_embedding_snapshot
+
+load_dotenv()
+
+# --- Index Constants ---
+IMAGE_EMBEDDING_MODEL = os.getenv("IMAGE_EMBEDDING_MODEL", "openai/clip-vit-base-patch32")
+IMAGE_INDEX_PATH = os.getenv("IMAGE_INDEX_PATH", "image_index.npz")
+EMBED_BATCH_SIZE = 32
+DOWNLOAD_WORKERS = 8
+CONTENT_HASH_DTYPE = "S40"          # hex SHA-1 of each item's image URL (or bytes)
+COMPACTION_TOMBSTONE_RATIO = 0.2
+LOOKUP_DELTA_MAX_ROWS = 4096        # appended ids looked up through a dict before they are merged into sorted_ids
+
+
+def load_image_bytes(image_path_or_url):
+    """Fetches raw image bytes from a URL or a local path. Returns None on failure."""
+    try:
+        if image_path_or_url.startswith('http://') or image_path_or_url.startswith('https://'):
+            response = requests.get(image_path_or_url, timeout=15)
+            response.raise_for_status()
+            return response.content
+        with open(image_path_or_url, 'rb') as image_file:
+            return image_file.read()
+    except Exception as e:
+        print(f"  Error: Could not load image '{image_path_or_url}': {e}")
+        return None
+
+
+def decode_image(content):
+    """Decode image bytes into an RGB PIL image. Returns None if the bytes are not an image."""
+    try:
+        return Image.open(io.BytesIO(content)).convert("RGB")
+    except Exception as e:
+        print(f"  Error: Could not decode image: {e}")
+        return None
+
+
+def load_image(image_path_or_url):
+    """
+    Fetches an image from a URL or reads it from a local path and returns an RGB PIL image.
+    Returns None if the image could not be obtained or decoded.
+    """
+    content = load_image_bytes(image_path_or_url)
+    return decode_image(content) if content is not None else None
+
+
+class ImageEncoder:
+    """CPU image encoder producing L2-normalized float32 embeddings with a CLIP vision tower."""
+
+    def __init__(self, model_name=None, model=None, processor=None):
+        self.model_name = model_name or IMAGE_EMBEDDING_MODEL
+        if model is None:
+            print(f"Loading image encoder '{self.model_name}'...")
+            model = CLIPVisionModelWithProjection.from_pretrained(self.model_name)
+            processor = CLIPImageProcessor.from_pretrained(self.model_name)
+        self.model = model.eval()
+        self.processor = processor
+        self.dim = self.model.config.projection_dim
+
+    @classmethod
+    def tiny_random(cls, seed=0, dim=16):
+        """Build a small randomly initialized encoder (no download) for local checks."""
+        torch.manual_seed(seed)
+        config = CLIPVisionConfig(
+            hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+            image_size=32, patch_size=8, projection_dim=dim
+        )
+        processor = CLIPImageProcessor(
+            size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32}
+        )
+        return cls(model_name="tiny-random", model=CLIPVisionModelWithProjection(config), processor=processor)
+
+    def encode(self, images):
+        """Embed a list of PIL images into an (n, dim) float32 array of unit vectors."""
+        if not images:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        inputs = self.processor(images=images, return_tensors="pt")
+        with torch.no_grad():
+            embeds = self.model(pixel_values=inputs["pixel_values"]).image_embeds
+        vectors = embeds.cpu().numpy().astype(np.float32)
+        return normalize_rows(vectors)
+
+
+def normalize_rows(vectors):
+    """L2-normalize each row so that dot products are cosine similarities."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class ImageEmbeddingIndex:
+    """
+    Float32 catalog image embeddings keyed by item id, searched by cosine similarity.
+
+    Supports incremental updates: append() adds rows (replacing any live row with the same
+    id), delete() tombstones rows so search filters them out, and compact() drops tombstoned
+    rows and rebuilds the ANN partitions. Rows past `ann_rows` were appended after the ANN
+    was built and are searched exactly until the next compaction. Appends fill spare capacity
+    in the row buffers (grown geometrically) and new ids are found through a small dict until
+    they are merged into the sorted id arrays, so an append costs O(rows appended), not a copy
+    and re-sort of the whole index.
+    """
+
+    def __init__(self, ids, vectors, model_name="", ann=None, sorted_ids=None, sorted_positions=None,
+                 content_hashes=None, deleted=None, ann_rows=None):
+        # Arrays (not lists/dicts) so a snapshot opened with mmap is used without copying
+        self.ids = ids if isinstance(ids, np.ndarray) and ids.dtype.kind == "U" else np.array([str(i) for i in ids], dtype=str)
+        self.vectors = vectors if isinstance(vectors, np.ndarray) and vectors.dtype == np.float32 else np.ascontiguousarray(vectors, dtype=np.float32)
+        self.model_name = model_name
+        if sorted_ids is None:
+            sorted_positions = np.argsort(self.ids, kind="stable")
+            sorted_ids = self.ids[sorted_positions]
+        self.sorted_ids = sorted_ids              # ids in sorted order, for binary-search lookups
+        self.sorted_positions = sorted_positions  # row of each sorted id
+        self.content_hashes = content_hashes if content_hashes is not None else np.full(len(self.ids), b"", dtype=CONTENT_HASH_DTYPE)
+        self.deleted = deleted if deleted is not None else np.zeros(len(self.ids), dtype=bool)
+        self.ann = ann  # Optional IVFIndex / HNSWIndex / PQIndex; exact search is used when None
+        self.ann_rows = len(self.ids) if ann_rows is None else int(ann_rows)
+        self._lock = threading.RLock()
+        self._compaction_thread = None
+        self._buffers = None         # {name: array with spare rows} once append() has grown the arrays
+        self._delta_positions = {}   # id -> row, for rows appended since sorted_ids was last updated
+
+    def __len__(self):
+        return len(self.ids)
+
+    def live_count(self):
+        return len(self.ids) - int(self.deleted.sum())
+
+    def tombstone_ratio(self):
+        return float(self.deleted.mean()) if len(self.ids) else 0.0
+
+    def build_ann(self, kind="ivf", **params):
+        """Build an approximate nearest-neighbour index ('ivf', 'hnsw' or 'pq') over the vectors."""
+        start_time = time.time()
+        with self._lock:
+            self.ann = ANN_INDEX_TYPES[kind](**params).build(self.vectors)
+            self.ann_rows = len(self.ids)
+        print(f"Built {kind.upper()} index over {len(self)} vectors in {time.time() - start_time:.2f}s")
+        return self.ann
+
+    def to_arrays(self):
+        """Every array needed to restore the index, keyed by name (ANN arrays prefixed 'ann_')."""
+        with self._lock:
+            self._merge_delta()
+        arrays = {"ids": self.ids, "vectors": self.vectors, "sorted_ids": self.sorted_ids,
+                  "sorted_positions": self.sorted_positions, "content_hashes": self.content_hashes,
+                  "deleted": self.deleted}
+        if self.ann is not None:
+            arrays.update({f"ann_{name}": value for name, value in self.ann.to_arrays().items()})
+        return arrays
+
+    def metadata(self):
+        return {"model_name": self.model_name, "ann_kind": self.ann.kind if self.ann is not None else "",
+                "ann_rows": self.ann_rows, "count": len(self)}
+
+    @classmethod
+    def from_arrays(cls, arrays, metadata):
+        ann = None
+        if metadata.get("ann_kind"):
+            ann_arrays = {name[4:]: value for name, value in arrays.items() if name.startswith("ann_")}
+            ann = ANN_INDEX_TYPES[metadata["ann_kind"]].from_arrays(ann_arrays)
+        return cls(arrays["ids"], arrays["vectors"], metadata.get("model_name", ""), ann=ann,
+                   sorted_ids=arrays.get("sorted_ids"), sorted_positions=arrays.get("sorted_positions"),
+                   content_hashes=arrays.get("content_hashes"), deleted=arrays.get("deleted"),
+                   ann_rows=metadata.get("ann_rows"))
+
+    def save(self, path=IMAGE_INDEX_PATH):
+        """
+        Save to an .npz file. With a PQ index the float vectors go to a separate .npy file next
+        to it instead, so load() keeps only the PQ codes in memory and maps the vectors.
+        """
+        with self._lock:
+            metadata, arrays = self.metadata(), self.to_arrays()
+            if isinstance(self.ann, PQIndex):
+                vectors_path = rerank_vectors_path(path)
+                # Written aside and renamed: the vectors being saved may be a mapping of that very file
+                with open(f"{vectors_path}.tmp-{os.getpid()}", "wb") as f:
+                    np.save(f, arrays.pop("vectors"))
+                os.replace(f.name, vectors_path)
+                metadata["vectors_file"] = os.path.basename(vectors_path)
+            np.savez(path, metadata=np.array(json.dumps(metadata)), **arrays)
+        print(f"Saved {len(self)} image embeddings to '{path}'.")
+
+    @classmethod
+    def load(cls, path=IMAGE_INDEX_PATH):
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files if name != "metadata"}
+            metadata = json.loads(str(data["metadata"]))
+        if metadata.get("vectors_file"):
+            # Read-only mmap, as in load_ann_index: PQ re-ranking and lookups read only the rows they need
+            arrays["vectors"] = np.load(os.path.join(os.path.dirname(path), metadata["vectors_file"]), mmap_mode="r")
+        return cls.from_arrays(arrays, metadata)
+
+    def position_of(self, item_id):
+        """Live row of item_id in the vectors matrix, or None if the id is not indexed."""
+        item_id = str(item_id)
+        with self._lock:
+            pos = self._delta_positions.get(item_id)
+            if pos is not None and not self.deleted[pos]:
+                return pos
+            slot = int(np.searchsorted(self.sorted_ids, item_id))
+            while slot < len(self.sorted_ids) and self.sorted_ids[slot] == item_id:
+                pos = int(self.sorted_positions[slot])
+                if not self.deleted[pos]:
+                    return pos
+                slot += 1
+            return None
+
+    def vector_for(self, item_id):
+        pos = self.position_of(item_id)
+        return None if pos is None else self.vectors[pos]
+
+    def content_hash_for(self, item_id):
+        pos = self.position_of(item_id)
+        return None if pos is None else self.content_hashes[pos].decode("ascii")
+
+    def search(self, query_vector, k=10, **search_params):
+        """
+        Return up to k (item_id, cosine_score) pairs, best first. Uses the ANN index when one
+        is built (search_params such as nprobe / ef are forwarded), otherwise exact search.
+        Tombstoned rows are never returned.
+        """
+        query_vector = normalize_rows(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))[0]
+        # Score outside the lock, like compact(): the arrays are replaced rather than changed in
+        # place, except `deleted`, which is copied
+        with self._lock:
+            if not len(self):
+                return []
+            ids, vectors, deleted, ann, ann_rows = self.ids, self.vectors, self.deleted.copy(), self.ann, self.ann_rows
+        if ann is None:
+            scores = vectors @ query_vector
+            scores[deleted] = -np.inf
+            positions, scores = exact_search_scores(scores, k)
+        else:
+            # Over-fetch by the number of tombstoned ANN rows so k live rows survive filtering
+            covered_deleted = int(deleted[:ann_rows].sum())
+            # The ANN covers rows [0, ann_rows) of `vectors` and scores against them, keeping no copy
+            positions, scores = ann.search(query_vector, vectors, k=min(k + covered_deleted, ann_rows), **search_params)
+            if ann_rows < len(ids):
+                delta_scores = vectors[ann_rows:] @ query_vector
+                delta_top, delta_scores = exact_search_scores(delta_scores, k)
+                positions = np.concatenate([positions, delta_top + ann_rows])
+                scores = np.concatenate([scores, delta_scores])
+                order = np.argsort(-scores, kind="stable")
+                positions, scores = positions[order], scores[order]
+        keep = ~deleted[positions] & np.isfinite(scores)
+        positions, scores = positions[keep][:k], scores[keep][:k]
+        return [(str(ids[pos]), float(score)) for pos, score in zip(positions.tolist(), scores.tolist())]
+
+    def append(self, ids, vectors, content_hashes=None):
+        """Append rows; an existing live row with the same id is tombstoned (replaced)."""
+        if not len(ids):
+            return
+        new_ids = np.array([str(i) for i in ids], dtype=str)
+        new_vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        new_hashes = np.array(content_hashes if content_hashes is not None else [b""] * len(new_ids), dtype=CONTENT_HASH_DTYPE)
+        with self._lock:
+            self.delete(new_ids)
+            rows = len(self.ids)
+            end = rows + len(new_ids)
+            self._reserve(end, new_ids.dtype)
+            for name, new_rows in [("ids", new_ids), ("vectors", new_vectors), ("content_hashes", new_hashes),
+                                   ("deleted", np.zeros(len(new_ids), dtype=bool))]:
+                buffer = self._buffers[name]
+                buffer[rows:end] = new_rows
+                # A view of the rows in use; views held by searches still see only their rows
+                setattr(self, name, buffer[:end])
+            self._delta_positions.update(zip(new_ids.tolist(), range(rows, end)))
+            if len(self._delta_positions) > LOOKUP_DELTA_MAX_ROWS:
+                self._merge_delta()
+
+    def _reserve(self, rows, ids_dtype):
+        # Hold _lock. Make room for `rows` rows, doubling the buffers so a run of small appends
+        # copies the existing rows only O(log n) times
+        ids_dtype = np.promote_types(self.ids.dtype, ids_dtype)  # a longer id widens the column
+        buffers = self._buffers
+        if buffers is not None and rows <= len(buffers["vectors"]) and buffers["ids"].dtype == ids_dtype:
+            return
+        capacity = max(rows, 2 * len(self.ids), 64)
+        self._buffers = {}
+        for name in ("ids", "vectors", "content_hashes", "deleted"):
+            current = getattr(self, name)
+            buffer = np.empty((capacity,) + current.shape[1:], dtype=ids_dtype if name == "ids" else current.dtype)
+            buffer[:len(current)] = current
+            self._buffers[name] = buffer
+            setattr(self, name, buffer[:len(current)])
+
+    def _merge_delta(self):
+        # Hold _lock. Fold the ids appended since the last merge into sorted_ids / sorted_positions
+        if not self._delta_positions:
+            return
+        new_rows = np.fromiter(self._delta_positions.values(), dtype=np.int64, count=len(self._delta_positions))
+        new_ids = self.ids[new_rows]
+        order = np.argsort(new_ids, kind="stable")
+        new_ids, new_rows = new_ids[order], new_rows[order]
+        sorted_ids = self.sorted_ids.astype(self.ids.dtype, copy=False)
+        slots = np.searchsorted(sorted_ids, new_ids, side="right")
+        self.sorted_ids = np.insert(sorted_ids, slots, new_ids)
+        self.sorted_positions = np.insert(self.sorted_positions, slots, new_rows)
+        self._delta_positions = {}
+
+    def delete(self, ids):
+        """Tombstone the live rows of the given ids. Returns the number of rows tombstoned."""
+        with self._lock:
+            positions = [pos for pos in (self.position_of(item_id) for item_id in ids) if pos is not None]
+            if positions:
+                if not self.deleted.flags.writeable:
+                    self.deleted = self.deleted.copy()  # mmap'd snapshots are read-only
+                    self._buffers = None
+                self.deleted[positions] = True
+            return len(positions)
+
+    def compact(self):
+        """
+        Drop tombstoned rows and rebuild the ANN partitions over the live rows (IVF keeps its
+        centroids and PQ its codebooks; HNSW is rebuilt). The rebuild runs without holding the
+        lock; rows appended or deleted meanwhile are carried over when the result is swapped in.
+        """
+        start_time = time.time()
+        with self._lock:
+            snapshot_rows = len(self.ids)
+            live_rows = np.flatnonzero(~self.deleted)
+            live_vectors = self.vectors[live_rows]
+            ann = self.ann
+        new_ann = ann.rebuild(live_vectors) if ann is not None else None
+        with self._lock:
+            tail = np.arange(snapshot_rows, len(self.ids))
+            rows = np.concatenate([live_rows, tail])
+            self.ids = self.ids[rows]
+            self.vectors = np.concatenate([live_vectors, self.vectors[tail]])
+            self.content_hashes = self.content_hashes[rows]
+            self.deleted = self.deleted[rows]  # picks up tombstones made during the rebuild
+            self.sorted_positions = np.argsort(self.ids, kind="stable")
+            self.sorted_ids = self.ids[self.sorted_positions]
+            self._buffers = None
+            self._delta_positions = {}
+            self.ann = new_ann
+            self.ann_rows = len(live_rows)
+        print(f"Compacted image index: dropped {snapshot_rows - len(live_rows)} tombstoned rows, "
+              f"{len(self)} rows remain ({time.time() - start_time:.2f}s)")
+
+    def maybe_compact(self, threshold=COMPACTION_TOMBSTONE_RATIO, background=True):
+        """
+        Compact once the tombstone ratio (or the share of rows appended since the ANN was
+        built) passes `threshold`. With background=True compaction runs on a daemon thread.
+        """
+        delta_ratio = (len(self) - self.ann_rows) / len(self) if self.ann is not None and len(self) else 0.0
+        if self.tombstone_ratio() <= threshold and delta_ratio <= threshold:
+            return False
+        if not background:
+            self.compact()
+            return True
+        with self._lock:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return False
+            self._compaction_thread = threading.Thread(target=self.compact, name="image-index-compaction", daemon=True)
+            self._compaction_thread.start()
+        return True
+
+
+def rerank_vectors_path(path):
+    """The .npy file holding the float vectors of a PQ-backed index saved at path."""
+    return os.path.splitext(path)[0] + ".vectors.npy"
+
+
+def image_content_hash(image_url, content=None):
+    """Hex SHA-1 of the image bytes when given, otherwise of the image URL."""
+    return hashlib.sha1(content if content is not None else image_url.encode("utf-8")).hexdigest()
+
+
+def _embed_images(entries, encoder, batch_size=EMBED_BATCH_SIZE):
+    """
+    Embed (item_id, image_url, content_or_None) entries, downloading images that were not
+    prefetched. Failed downloads are skipped. Returns (ids, vectors, content_hashes).
+    """
+    ids = []
+    hashes = []
+    vectors = []
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start:start + batch_size]
+            contents = list(pool.map(lambda entry: entry[2] if entry[2] is not None else load_image_bytes(entry[1]), batch))
+            images = [decode_image(content) if content is not None else None for content in contents]
+            loaded = [(entry, image) for entry, image in zip(batch, images) if image is not None]
+            if not loaded:
+                continue
+            ids.extend(entry[0] for entry, _ in loaded)
+            # Prefetched entries were hashed by content; the others by URL
+            hashes.extend(image_content_hash(entry[1], entry[2]) for entry, _ in loaded)
+            vectors.append(encoder.encode([image for _, image in loaded]))
+            print(f"  Embedded {len(ids)}/{len(entries)} images ({time.time() - start_time:.1f}s)")
+    matrix = np.vstack(vectors) if vectors else np.zeros((0, encoder.dim), dtype=np.float32)
+    return ids, matrix, np.array(hashes, dtype=CONTENT_HASH_DTYPE)
+
+
+def build_image_index(items, encoder, batch_size=EMBED_BATCH_SIZE):
+    """
+    Embed the `jew_default_img` of every catalog item. Items without an image or whose
+    image fails to download are skipped. Returns an ImageEmbeddingIndex.
+    """
+    entries = [(item.get("id"), item.get("jew_default_img"), None) for item in items
+               if item.get("id") and item.get("jew_default_img")]
+    print(f"Embedding {len(entries)} catalog images in batches of {batch_size}...")
+    ids, vectors, hashes = _embed_images(entries, encoder, batch_size)
+    return ImageEmbeddingIndex(ids, vectors, encoder.model_name, content_hashes=hashes)
+
+
+def apply_catalog_changes(index, items, encoder, hash_bytes=False, batch_size=EMBED_BATCH_SIZE):
+    """
+    Bring the index in line with the current catalog without a full rebuild. Each item's
+    image is content-hashed (its URL, or its downloaded bytes with hash_bytes=True); only new
+    items and items whose hash changed are embedded and appended, and ids that left the
+    catalog are tombstoned. Returns a summary dict of the changes applied.
+    """
+    entries = []
+    seen_ids = set()
+    unchanged = 0
+    for item in items:
+        item_id, image_url = item.get("id"), item.get("jew_default_img")
+        if not item_id or not image_url:
+            continue
+        seen_ids.add(str(item_id))
+        content = load_image_bytes(image_url) if hash_bytes else None
+        if hash_bytes and content is None:
+            continue
+        if index.content_hash_for(item_id) == image_content_hash(image_url, content):
+            unchanged += 1
+            continue
+        entries.append((item_id, image_url, content))
+
+    print(f"Catalog changes: {len(entries)} new/changed images, {unchanged} unchanged.")
+    ids, vectors, hashes = _embed_images(entries, encoder, batch_size)
+    index.append(ids, vectors, hashes)
+    live_ids = index.ids[~index.deleted].tolist()
+    removed = index.delete([item_id for item_id in live_ids if item_id not in seen_ids])
+    summary = {"embedded": len(ids), "unchanged": unchanged, "removed": removed,
+               "tombstone_ratio": round(index.tombstone_ratio(), 4)}
+    print(f"Applied catalog changes: {summary}")
+    return summary
+
+
+def query_image_index(index, encoder, image_path_or_url, k=10):
+    """Embed the input image and return the k nearest catalog items. No LLM calls are made."""
+    image = load_image(image_path_or_url)
+    if image is None:
+        return []
+    return index.search(encoder.encode([image])[0], k=k)
+
+
+# --- Offline job / query mode ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the catalog image-embedding index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Embed every catalog image and save the index.")
+    build_parser.add_argument("--max-items", type=int, default=None)
+    build_parser.add_argument("--ann", choices=sorted(ANN_INDEX_TYPES), default=None,
+                              help="Also build an approximate nearest-neighbour index")
+    update_parser = subparsers.add_parser("update", help="Embed only new/changed catalog images and tombstone removed ones.")
+    update_parser.add_argument("--hash-bytes", action="store_true", help="Detect changes by image bytes instead of URL")
+    query_parser = subparsers.add_parser("query", help="Find catalog items visually similar to an image.")
+    query_parser.add_argument("image", help="Image URL or local path")
+    query_parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--index", default=IMAGE_INDEX_PATH)
+    parser.add_argument("--store-dir", default=EMBEDDING_STORE_DIR,
+                        help="Embedding store the serving workers read; build/update publish a snapshot here")
+    args = parser.parse_args()
+
+    encoder = ImageEncoder()
+    if args.command == "build":
+        start_time = time.time()
+        index = build_image_index(list(iter_catalog_items(max_items=args.max_items)), encoder)
+        if args.ann:
+            index.build_ann(args.ann)
+        index.save(args.index)
+        write_embedding_snapshot(index, args.store_dir)
+        print(f"Index build time: {time.time() - start_time:.2f}s")
+    elif args.command == "update":
+        start_time = time.time()
+        index = ImageEmbeddingIndex.load(args.index)
+        apply_catalog_changes(index, iter_catalog_items(), encoder, hash_bytes=args.hash_bytes)
+        index.maybe_compact(background=False)
+        index.save(args.index)
+        write_embedding_snapshot(index, args.store_dir)
+        print(f"Index update time: {time.time() - start_time:.2f}s")
+    else:
+        index = ImageEmbeddingIndex.load(args.index)
+        start_time = time.time()
+        for rank, (item_id, score) in enumerate(query_image_index(index, encoder, args.image, k=args.k), 1):
+            print(f"{rank:2d}. id={item_id} cosine={score:.4f}")
+        print(f"Query time: {time.time() - start_time:.3f}s")
@@ -0,0 +1,118 @@
+# jobs.py
+import os
+import time
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Job Queue Constants ---
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", "4"))    # searches run at once by the job executor
+JOBS_MAX_QUEUED = int(os.getenv("JOBS_MAX_QUEUED", "100"))    # jobs waiting for a worker before submissions are refused
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "600"))    # seconds a finished job's result can be fetched
+
+
+class Job:
+    """One submitted search. progress, if set by the work function, returns its per-stage timings."""
+
+    def __init__(self, job_id, kind):
+        self.id = job_id
+        self.kind = kind
+        self.status = "queued"  # queued -> running -> done | failed
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.progress = None
+        self.body = None
+        self.status_code = None
+
+    def snapshot(self):
+        now = time.monotonic()
+        snapshot = {"job_id": self.id, "kind": self.kind, "status": self.status,
+                    "queued_ms": round(((self.started_at or now) - self.submitted_at) * 1000, 1)}
+        if self.started_at is not None:
+            snapshot["run_ms"] = round(((self.finished_at or now) - self.started_at) * 1000, 1)
+        if self.progress is not None:
+            snapshot["stages"] = self.progress()
+        if self.finished_at is not None:
+            snapshot["result"] = self.body
+            snapshot["result_status"] = self.status_code
+        return snapshot
+
+
+class JobStore:
+    """
+    Background searches for clients that cannot hold a request open. submit() queues
+    fn(job) -> (body, status code) on a bounded thread pool and returns the job id at once;
+    get() reports status, per-stage progress and, once finished, the result. Finished jobs are
+    kept for ttl seconds. When max_queued jobs are already waiting, submit() refuses new ones.
+    """
+
+    def __init__(self, max_workers=JOBS_MAX_WORKERS, max_queued=JOBS_MAX_QUEUED, ttl=JOB_RESULT_TTL):
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._jobs = OrderedDict()  # job id -> Job, in submission order
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search-job")
+        self._queued = 0
+        self._running = 0
+        self._stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "expired": 0}
+
+    def submit(self, kind, fn):
+        """Queue fn(job); returns the job id, or None if the queue is full."""
+        with self._lock:
+            self._purge_expired()
+            if self._queued >= self.max_queued:
+                self._stats["rejected"] += 1
+                return None
+            job = Job(secrets.token_urlsafe(12), kind)
+            self._jobs[job.id] = job
+            self._queued += 1
+            self._stats["submitted"] += 1
+        self._pool.submit(self._run, job, fn)
+        return job.id
+
+    def _run(self, job, fn):
+        with self._lock:
+            job.status = "running"
+            job.started_at = time.monotonic()
+            self._queued -= 1
+            self._running += 1
+        try:
+            body, status_code = fn(job)
+        except Exception as e:
+            print(f"Search job {job.id} failed: {e}")
+            body, status_code = {"error": "An unexpected error occurred. Please check server logs.", "data": [], "total_found": 0}, 500
+        with self._lock:
+            job.body, job.status_code = body, status_code
+            job.status = "done" if status_code == 200 else "failed"
+            job.finished_at = time.monotonic()
+            self._running -= 1
+            self._stats["completed" if status_code == 200 else "failed"] += 1
+
+    def get(self, job_id):
+        """Snapshot of a job (see Job.snapshot), or None if it is unknown or its result has expired."""
+        with self._lock:
+            self._purge_expired()
+            job = self._jobs.get(job_id)
+            return job.snapshot() if job is not None else None
+
+    def _purge_expired(self):
+        # Hold _lock. Jobs finish out of order, so every finished job is checked.
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None and now - job.finished_at >= self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self._stats["expired"] += len(expired)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queue_depth"] = self._queued
+            stats["running"] = self._running
+            stats["retained"] = len(self._jobs)
+        return stats
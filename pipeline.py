@@ -0,0 +1,386 @@
+# pipeline.py
+import os
+import time
+import queue
+import hashlib
+import threading
+from urllib.parse import urlsplit, urlunsplit
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from test7 import (generate_caption, create_json_from_caption, extract_attributes_locally, prepare_search, first_page_bodies,
+                   execute_search, pass3_needs_llm, select_pass3_llm_term_for, fetch_catalog_page, _catalog_fetch_pool)
+from single_flight import SingleFlight
+
+load_dotenv()
+
+# --- Stage Graph Constants ---
+PIPELINE_STAGE_WORKERS = int(os.getenv("PIPELINE_STAGE_WORKERS", "32"))  # threads running stages, shared by all searches
+# Speculative Pass 1 prefetch from locally guessed attributes (off by default, see below)
+PIPELINE_SPECULATIVE_PASS1 = os.getenv("PIPELINE_SPECULATIVE_PASS1", "0").lower() in ("1", "true", "yes")
+
+# Stages are queued in the order they become ready (FIFO), so a stage that waits on a sibling
+# with StageRun.result() never holds the thread that sibling needs: the sibling was queued first.
+_stage_pool = ThreadPoolExecutor(max_workers=PIPELINE_STAGE_WORKERS, thread_name_prefix="pipeline-stage")
+
+
+class StageRun:
+    """
+    One execution of a StageGraph. Every stage gets a Future when the run starts; a stage is
+    submitted once all the stages it runs after have completed with a result. If one of them
+    failed, raised or returned None, the stage is skipped and its result is None.
+    listener(event, data), if given, is called from the stage threads with ("stage", (name,
+    status, result)) as each stage finishes and with whatever stages emit().
+    """
+
+    def __init__(self, graph, inputs, listener=None):
+        self.graph = graph
+        self.inputs = inputs
+        self.listener = listener
+        self.started_at = time.perf_counter()
+        self.notes = {}  # facts stages record about this run (e.g. whether a speculation was kept)
+        self._futures = {name: Future() for name in graph.stages}
+        self._timings = {}
+        self._scheduled = set()
+        self._lock = threading.Lock()
+
+    def result(self, name, timeout=None):
+        """Result of a stage, waiting for it; re-raises the stage's exception."""
+        return self._futures[name].result(timeout)
+
+    def emit(self, event, data):
+        """Report progress from inside a stage to the run's listener (if any)."""
+        if self.listener is not None:
+            self.listener(event, data)
+
+    def timings(self):
+        """{stage: {"status", "start_ms", "duration_ms"}}, times relative to the start of the run."""
+        with self._lock:
+            return {name: dict(timing) for name, timing in self._timings.items()}
+
+    def _start(self):
+        for name, stage in self.graph.stages.items():
+            if not stage["after"]:
+                self._schedule(name)
+
+    def _schedule(self, name):
+        with self._lock:
+            if name in self._scheduled:
+                return
+            self._scheduled.add(name)
+        after = self.graph.stages[name]["after"]
+        if any(self._futures[dep].exception() is not None or self._futures[dep].result() is None for dep in after):
+            self._finish(name, "skipped", None, None, time.perf_counter())
+            return
+        _stage_pool.submit(self._run_stage, name)
+
+    def _run_stage(self, name):
+        started = time.perf_counter()
+        try:
+            value = self.graph.stages[name]["fn"](self)
+        except Exception as e:
+            print(f"Pipeline stage '{name}' failed: {e}")
+            self._finish(name, "error", None, e, started)
+            return
+        self._finish(name, "done" if value is not None else "empty", value, None, started)
+
+    def _finish(self, name, status, value, error, started):
+        ended = time.perf_counter()
+        timing = {"status": status, "start_ms": round((started - self.started_at) * 1000, 1),
+                  "duration_ms": round((ended - started) * 1000, 1)}
+        with self._lock:
+            self._timings[name] = timing
+        self.graph.record(name, timing)
+        if error is not None:
+            self._futures[name].set_exception(error)
+        else:
+            self._futures[name].set_result(value)
+        self.emit("stage", (name, status, value))
+        for dependent in self.graph.dependents[name]:
+            if all(self._futures[dep].done() for dep in self.graph.stages[dependent]["after"]):
+                self._schedule(dependent)
+
+
+class StageGraph:
+    """
+    A pipeline as a dependency graph of named stages. Each stage is fn(run) -> result and
+    starts as soon as the stages it runs after have finished, so independent stages overlap.
+    A stage reads earlier results with run.result(name) (or run.inputs); it may also wait on a
+    stage it is not ordered after, which then runs concurrently with it. Timing of every stage
+    is kept per run (StageRun.timings) and aggregated per stage (stats).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}      # name -> {"fn", "after"}, in declaration order
+        self.dependents = {}  # name -> stages that run after it
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, name, fn, after=()):
+        for dep in after:
+            if dep not in self.stages:
+                raise ValueError(f"Stage '{name}' runs after unknown stage '{dep}'.")
+        self.stages[name] = {"fn": fn, "after": tuple(after)}
+        self.dependents[name] = []
+        for dep in after:
+            self.dependents[dep].append(name)
+        return self
+
+    def run(self, listener=None, **inputs):
+        """Start every stage that has no dependencies and return the StageRun; results are awaited with run.result()."""
+        run = StageRun(self, inputs, listener)
+        run._start()
+        return run
+
+    def record(self, name, timing):
+        with self._lock:
+            stats = self._stats.setdefault(name, {"runs": 0, "skipped": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            if timing["status"] == "skipped":
+                stats["skipped"] += 1
+                return
+            stats["runs"] += 1
+            stats["errors"] += timing["status"] == "error"
+            stats["total_ms"] += timing["duration_ms"]
+            stats["max_ms"] = max(stats["max_ms"], timing["duration_ms"])
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(stats, avg_ms=round(stats["total_ms"] / stats["runs"], 1) if stats["runs"] else None,
+                               total_ms=round(stats["total_ms"], 1))
+                    for name, stats in self._stats.items()}
+
+
+def format_timings(timings):
+    """One log line: stage start+duration in ms, in start order."""
+    return ", ".join(f"{name} {timing['status']} @{timing['start_ms']:.0f}+{timing['duration_ms']:.0f}ms"
+                     for name, timing in sorted(timings.items(), key=lambda entry: entry[1]["start_ms"]))
+
+
+# --- Image search as a stage graph ---
+# caption ──> guess ──> speculative_pass1
+#    └──────> attributes ──> plan ──> pass3_keyword
+#                                └──> search   (waits on pass3_keyword only if Pass 3 needs the LLM)
+# While the JSON LLM call runs, a local rule-based guess of the attributes (extract_attributes_locally
+# on the caption) plans the search and requests its first Pass 1 pages through catalog_cache. The
+# speculation is kept only if the final attributes plan exactly the same first pages: the search
+# then finds them cached or in flight. Otherwise it is discarded: the search does not use those
+# pages (they stay in catalog_cache as ordinary catalog pages). The Pass 3 LLM keyword fallback
+# starts as soon as the plan shows it is needed, alongside Pass 1 rather than after its first item.
+# The first pages depend on `style`, i.e. on the exact categories, which the local rules rarely
+# guess the same as the LLM (e.g. ['heart', 'diamond'] vs ['heart']); a discarded speculation
+# costs up to one full page per search type. So the guess stages are only added with
+# PIPELINE_SPECULATIVE_PASS1=1; /metrics reports the kept rate to judge whether it pays off.
+
+_stats_lock = threading.Lock()
+speculation_stats = {"started": 0, "kept": 0, "discarded": 0}
+stream_stats = {"streams": 0, "first_event_ms_total": 0.0, "first_event_ms_max": 0.0, "total_ms_total": 0.0}
+
+
+def _count_speculation(key):
+    with _stats_lock:
+        speculation_stats[key] += 1
+
+
+def _caption_stage(run):
+    return generate_caption(run.inputs["image_url"])
+
+
+def _guess_stage(run):
+    guessed = extract_attributes_locally(run.result("caption"), log=lambda *args: None)
+    if not guessed:
+        return None
+    options = run.inputs["search_options"]
+    search, error_result = prepare_search(guessed, run.result("caption"), speculative=True, quiet=True, **options)
+    if error_result:
+        return None
+    return {"attributes": guessed, "bodies": first_page_bodies(search)}
+
+
+def _speculative_pass1_stage(run):
+    bodies = run.result("guess")["bodies"]
+    _count_speculation("started")
+    print(f"Speculative Pass 1: prefetching {len(bodies)} first page(s) from guessed attributes {run.result('guess')['attributes']}")
+    for future in [_catalog_fetch_pool.submit(fetch_catalog_page, body) for body in bodies]:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Speculative Pass 1 prefetch failed: {e}")
+    return bodies
+
+
+def _attributes_stage(run):
+    return create_json_from_caption(run.result("caption"))
+
+
+def _plan_stage(run):
+    search, error_result = prepare_search(run.result("attributes"), run.result("caption"), **run.inputs["search_options"])
+    if error_result:
+        run.notes["error_result"] = error_result
+        return None
+    # The guess stage is local and fast, so this normally does not wait
+    guess = None
+    if "guess" in run.graph.stages:
+        try:
+            guess = run.result("guess")
+        except Exception:
+            guess = None
+    if guess is not None:
+        kept = guess["bodies"] == first_page_bodies(search)
+        run.notes["speculation"] = "kept" if kept else "discarded"
+        _count_speculation("kept" if kept else "discarded")
+        print(f"Speculative Pass 1 {'kept' if kept else 'discarded'}: guessed {guess['attributes']}, final {run.result('attributes')}")
+    return search
+
+
+def _pass3_keyword_stage(run):
+    search = run.result("plan")
+    return select_pass3_llm_term_for(search) if pass3_needs_llm(search) else ("", "")
+
+
+def _search_stage(run):
+    on_candidates = (lambda payloads: run.emit("candidates", payloads)) if run.listener is not None else None
+    return execute_search(run.result("plan"), pass3_llm_term=lambda: run.result("pass3_keyword"), on_candidates=on_candidates)
+
+
+def build_image_search_graph(speculative_pass1=PIPELINE_SPECULATIVE_PASS1):
+    graph = StageGraph("image_search").add("caption", _caption_stage)
+    if speculative_pass1:
+        graph.add("guess", _guess_stage, after=["caption"]).add("speculative_pass1", _speculative_pass1_stage, after=["guess"])
+    return (graph.add("attributes", _attributes_stage, after=["caption"])
+            .add("plan", _plan_stage, after=["attributes"])
+            .add("pass3_keyword", _pass3_keyword_stage, after=["plan"])
+            .add("search", _search_stage, after=["plan"]))
+
+
+image_search_graph = build_image_search_graph()
+
+
+def run_image_search(image_url, search_options):
+    """
+    Runs image_search_graph until its response is known. Returns (caption, json_prompt,
+    results, run); caption / json_prompt are None if that stage failed, results is the
+    search response (or prepare_search's error result). Stages the response does not
+    need (a discarded speculation) may still be finishing in the background.
+    """
+    run = image_search_graph.run(image_url=image_url, search_options=search_options)
+    return image_search_outcome(run) + (run,)
+
+
+def image_search_outcome(run):
+    """(caption, json_prompt, results) of a run of image_search_graph, waiting for the stages it needs."""
+    caption = run.result("caption")
+    json_prompt = run.result("attributes") if caption else None
+    results = None
+    if json_prompt:
+        results = run.result("search") if run.result("plan") is not None else run.notes.get("error_result")
+    print(f"Pipeline stages: {format_timings(run.timings())}")
+    return caption, json_prompt, results
+
+
+def stream_image_search(image_url, search_options, on_finished=None):
+    """
+    Starts image_search_graph and returns a generator of (event, data) as the stages finish:
+    ("caption", caption), ("attributes", json_prompt), ("candidates", early Pass 1 payloads)
+    when available, then always ("end", (caption, json_prompt, results)) or ("end_error",
+    exception). on_finished() is called once the search itself is over, whether or not the
+    generator is ever consumed (e.g. the client disconnected). Not coalesced: every stream
+    runs its own pipeline.
+    """
+    events = queue.Queue()
+
+    def listener(event, data):
+        if event == "stage":
+            name, status, value = data
+            if status == "done" and name in ("caption", "attributes"):
+                events.put((name, value))
+        elif event == "candidates":
+            events.put((event, data))
+
+    run = image_search_graph.run(listener=listener, image_url=image_url, search_options=search_options)
+
+    def finish():
+        try:
+            events.put(("end", image_search_outcome(run)))
+        except Exception as e:
+            events.put(("end_error", e))
+        finally:
+            if on_finished is not None:
+                on_finished()
+
+    threading.Thread(target=finish, name="pipeline-stream", daemon=True).start()
+
+    def drain():
+        while True:
+            event, data = events.get()
+            yield event, data
+            if event in ("end", "end_error"):
+                return
+
+    return drain()
+
+
+def record_stream(first_event_ms, total_ms):
+    """Latency of one streamed search: time to its first event and to its final result."""
+    with _stats_lock:
+        stream_stats["streams"] += 1
+        stream_stats["first_event_ms_total"] += first_event_ms
+        stream_stats["first_event_ms_max"] = max(stream_stats["first_event_ms_max"], first_event_ms)
+        stream_stats["total_ms_total"] += total_ms
+
+
+# --- Coalescing identical searches ---
+# A shared link brings many requests for the same image within seconds; concurrent ones share
+# one pipeline run (caption, JSON and Pass 3 LLM calls and the catalog pages) via image_searches.
+image_searches = SingleFlight()
+
+
+def image_source_key(image_url):
+    """Canonical key of an image source: the URL with scheme and host lowercased and no fragment, or a local file's content hash."""
+    image_url = image_url.strip()
+    if image_url.startswith('http://') or image_url.startswith('https://'):
+        parts = urlsplit(image_url)
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", parts.query, ""))
+    try:
+        with open(image_url, 'rb') as image_file:
+            return "sha256:" + hashlib.sha256(image_file.read()).hexdigest()
+    except OSError:
+        return image_url
+
+
+def image_search_key(image_url, search_options):
+    return image_source_key(image_url), tuple(sorted(search_options.items()))
+
+
+def coalesced_image_search(image_url, search_options, admission=None):
+    """
+    run_image_search, shared with identical concurrent requests (same image source and search
+    options). Returns (caption, json_prompt, results); results is a shallow copy the caller may
+    add keys to. An error of the shared run is raised in every waiting request. With an
+    admission.AdmissionController, only the request that runs the search takes a slot; if it
+    is shed, every request sharing it gets the AdmissionRejected.
+    """
+    def run():
+        if admission is None:
+            return run_image_search(image_url, search_options)
+        with admission.admit():
+            return run_image_search(image_url, search_options)
+
+    (caption, json_prompt, results, _), shared = image_searches.do(image_search_key(image_url, search_options), run)
+    if shared:
+        print(f"Joined an identical in-flight search for {image_url}")
+    return caption, json_prompt, dict(results) if isinstance(results, dict) else results
+
+
+def pipeline_stats():
+    with _stats_lock:
+        speculation = dict(speculation_stats, enabled="guess" in image_search_graph.stages)
+        decided = speculation["kept"] + speculation["discarded"]
+        speculation["kept_rate"] = round(speculation["kept"] / decided, 4) if decided else None
+        streams = stream_stats["streams"]
+        streaming = {"streams": streams, "first_event_ms_max": round(stream_stats["first_event_ms_max"], 1),
+                     "first_event_ms_avg": round(stream_stats["first_event_ms_total"] / streams, 1) if streams else None,
+                     "total_ms_avg": round(stream_stats["total_ms_total"] / streams, 1) if streams else None}
+    return {"stages": image_search_graph.stats(), "speculation": speculation, "coalescing": image_searches.stats(),
+            "streaming": streaming}
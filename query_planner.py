@@ -0,0 +1,208 @@
+# query_planner.py
+import re
+import math
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+
+# --- Planner Constants ---
+MIN_OBSERVED_ITEMS = 200  # per type; below this the planner keeps the plain material query
+PAGE_LIMIT = 500          # catalog page size used for Pass 1
+FIRST_PAGE_HEADROOM = 2.0 # a planned first page is sized to the estimated need times this factor
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+class TermStatistics:
+    """
+    Per-jewelry-type title token statistics learned from catalog responses (or a catalog mirror).
+    Used to estimate the selectivity of a title substring term within a type.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen_ids = defaultdict(set)     # type -> ids observed
+        self._token_df = defaultdict(Counter) # type -> token -> number of observed items containing it
+        self._stats = {"pages_observed": 0, "bytes_fetched": 0, "items_fetched": 0}
+
+    def observe_page(self, items, nbytes=0):
+        """Record every not-yet-seen item of a catalog page (called for upstream pages only)."""
+        with self._lock:
+            self._stats["pages_observed"] += 1
+            self._stats["bytes_fetched"] += nbytes
+            self._stats["items_fetched"] += len(items)
+            for item in items:
+                item_id, item_type = item.get("id"), (item.get("jew_type") or "").lower()
+                item_id = str(item_id) if item_id else None  # ids read back from a snapshot are strings
+                if not item_id or not item_type or item_id in self._seen_ids[item_type]:
+                    continue
+                self._seen_ids[item_type].add(item_id)
+                self._token_df[item_type].update(set(tokenize(item.get("jew_title"))))
+
+    def observe_catalog(self, items):
+        """Seed the statistics from a full catalog mirror."""
+        self.observe_page(list(items))
+
+    def observed_items(self, item_type):
+        return len(self._seen_ids.get(item_type.lower(), ()))
+
+    def selectivity(self, item_type, term):
+        """
+        Estimated fraction of a type's items whose title contains `term`, or None when too few
+        items were observed. A multi-word term is bounded by its rarest token.
+        """
+        item_type = item_type.lower()
+        observed = self.observed_items(item_type)
+        tokens = tokenize(term)
+        if observed < MIN_OBSERVED_ITEMS or not tokens:
+            return None
+        df = self._token_df[item_type]
+        # Add-one smoothing so an unseen token is "rare", not impossible
+        return min((df.get(token, 0) + 1) / (observed + 1) for token in tokens)
+
+    def to_arrays(self):
+        """(arrays, metadata) for a snapshot: per type, the observed ids and the token document frequencies."""
+        arrays, types = {}, []
+        with self._lock:
+            for type_number, (item_type, seen_ids) in enumerate(sorted(self._seen_ids.items())):
+                types.append(item_type)
+                df = self._token_df[item_type]
+                arrays[f"terms_ids_{type_number}"] = np.array(sorted(str(item_id) for item_id in seen_ids), dtype=np.str_)
+                arrays[f"terms_tokens_{type_number}"] = np.array(list(df.keys()), dtype=np.str_)
+                arrays[f"terms_df_{type_number}"] = np.array(list(df.values()), dtype=np.int64)
+        return arrays, {"types": types}
+
+    @classmethod
+    def from_arrays(cls, arrays, metadata):
+        term_stats = cls()
+        for type_number, item_type in enumerate(metadata.get("types", [])):
+            term_stats._seen_ids[item_type] = set(arrays[f"terms_ids_{type_number}"].tolist())
+            term_stats._token_df[item_type] = Counter(dict(zip(arrays[f"terms_tokens_{type_number}"].tolist(),
+                                                               arrays[f"terms_df_{type_number}"].tolist())))
+        return term_stats
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["observed_items_by_type"] = {t: len(ids) for t, ids in self._seen_ids.items()}
+        return stats
+
+
+class QueryPlanner:
+    """
+    Chooses which filter term is sent as the catalog `title` parameter. Each candidate step
+    sends one term server-side and applies the remaining terms to titles client-side. Steps
+    are ordered tightest first and relaxed one at a time; the final step is always the plain
+    material query, so the worst case is today's behaviour. The starting step is the one with
+    the lowest expected number of items fetched, using the learned term statistics.
+    """
+
+    def __init__(self, term_stats):
+        self.term_stats = term_stats
+        self._lock = threading.Lock()
+        self._stats = {"plans": 0, "pushed_down": 0, "relaxations": 0}
+
+    def plan(self, search_types, material_term, filter_terms, desired_limit, full_scan=False, record_stats=True):
+        """
+        Returns a list of steps, each a dict with 'title' (server-side term), 'client_terms'
+        (terms every top-tier item must contain) and 'first_page_limit'.
+        `filter_terms` are the Pass 2 / Pass 3 terms in priority order (empty ones skipped).
+        full_scan: every matching item is read (e.g. results sorted by price), so no step stops early.
+        record_stats=False leaves the plan counters alone (e.g. a speculative plan).
+        """
+        filter_terms = [term for term in dict.fromkeys(filter_terms) if term and term.lower() != material_term.lower()]
+        all_terms = [material_term] + filter_terms
+        candidates = [material_term] + filter_terms
+
+        estimates = []
+        for title_term in candidates:
+            client_terms = [term for term in all_terms if term != title_term]
+            estimate = self._estimate(search_types, title_term, client_terms, desired_limit, full_scan)
+            estimates.append((title_term, client_terms, estimate))
+
+        if any(estimate is None for _, _, estimate in estimates):
+            if record_stats:
+                self._count("plans")
+            return [{"title": material_term, "client_terms": filter_terms, "first_page_limit": None}]
+        material_step = {"title": material_term, "client_terms": filter_terms,
+                         "first_page_limit": estimates[0][2]["first_page_limit"]}
+
+        # Relaxation order: fewest server-side matches first, the material query last
+        pushed = sorted(estimates[1:], key=lambda entry: entry[2]["matches"])
+        steps = []
+        for title_term, client_terms, estimate in pushed:
+            steps.append({"title": title_term, "client_terms": client_terms,
+                          "first_page_limit": estimate["first_page_limit"]})
+        steps.append(material_step)
+
+        # Start at the step with the lowest expected fetch cost, counting the cost of the
+        # steps that are expected to come up short and be relaxed past.
+        step_estimates = [entry[2] for entry in pushed] + [estimates[0][2]]
+        best_start, best_cost = len(steps) - 1, math.inf
+        for start in range(len(steps)):
+            cost = 0.0
+            for estimate in step_estimates[start:]:
+                cost += estimate["items_fetched"]
+                if estimate["fills"]:
+                    break
+            if cost < best_cost:
+                best_start, best_cost = start, cost
+        if record_stats:
+            self._count("plans")
+            if best_start < len(steps) - 1:
+                self._count("pushed_down")
+        return steps[best_start:]
+
+    def _estimate(self, search_types, title_term, client_terms, desired_limit, full_scan=False):
+        """
+        Expected server-side matches, top-tier yield and items fetched for one step. Counts are
+        in units of observed items, so on a partial sample `fills` errs towards relaxing.
+        Types are streamed in order, but the first page of every type is requested up front.
+        """
+        per_type = []  # (matches, top-tier items) per search type
+        for search_type in search_types:
+            title_sel = self.term_stats.selectivity(search_type, title_term)
+            if title_sel is None:
+                return None
+            client_sel = 1.0
+            for term in client_terms:
+                term_sel = self.term_stats.selectivity(search_type, term)
+                if term_sel is None:
+                    return None
+                client_sel *= term_sel
+            type_matches = title_sel * self.term_stats.observed_items(search_type)
+            per_type.append((type_matches, type_matches * client_sel))
+        matches = sum(type_matches for type_matches, _ in per_type)
+        top_tier = sum(type_top for _, type_top in per_type)
+        fills = top_tier >= desired_limit
+        items_fetched, first_page_limit = matches, None
+        first_matches, first_top = per_type[0]
+        if first_top >= desired_limit:
+            # The first type fills the top tier on its own: size its first page to the expected need
+            needed = desired_limit * first_matches / first_top
+        elif fills:
+            # Every type contributes: size each first page to its share of the expected need
+            needed = desired_limit * max(type_matches for type_matches, _ in per_type) / top_tier
+        if fills and not full_scan:
+            first_page_limit = int(min(PAGE_LIMIT, max(desired_limit, math.ceil(needed * FIRST_PAGE_HEADROOM))))
+            pages_needed = math.ceil(needed / PAGE_LIMIT) * PAGE_LIMIT
+            items_fetched = sum(min(type_matches, first_page_limit if needed <= first_page_limit else pages_needed)
+                                for type_matches, _ in per_type)
+        return {"matches": matches, "top_tier": top_tier, "fills": fills,
+                "items_fetched": items_fetched, "first_page_limit": first_page_limit}
+
+    def record_relaxation(self):
+        self._count("relaxations")
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
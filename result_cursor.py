@@ -0,0 +1,99 @@
+# result_cursor.py
+import os
+import time
+import base64
+import secrets
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Cursor Cache Constants ---
+RESULT_CURSOR_TTL = float(os.getenv("RESULT_CURSOR_TTL", "600"))                     # seconds a result set can be paged
+RESULT_CURSOR_MAX_ENTRIES = int(os.getenv("RESULT_CURSOR_MAX_ENTRIES", "500"))       # result sets kept across all users
+RESULT_CURSOR_MAX_CANDIDATES = int(os.getenv("RESULT_CURSOR_MAX_CANDIDATES", "200"))  # ranked items kept per search
+
+
+def encode_cursor(token, offset):
+    return base64.urlsafe_b64encode(f"{token}:{offset}".encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(token, offset) of a cursor, or None if it is malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        token, offset = base64.urlsafe_b64decode(padded.encode("ascii")).decode("ascii").rsplit(":", 1)
+        offset = int(offset)
+    except (ValueError, UnicodeError, AttributeError):
+        return None
+    return (token, offset) if offset >= 0 else None
+
+
+class ResultCursorCache:
+    """
+    Short-lived store of ranked search results for "load more" paging. store() keeps the
+    ranked candidates of one search (the item payloads, shared with the pipeline, never
+    copied) under a random token and returns an opaque cursor for the next page; page() serves
+    that page from memory, with no LLM or catalog call. Entries expire after ttl and the oldest
+    are evicted beyond max_entries.
+    """
+
+    def __init__(self, ttl=RESULT_CURSOR_TTL, max_entries=RESULT_CURSOR_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # token -> (stored_at, items, page_size, info)
+        self._lock = threading.Lock()
+        self._stats = {"stored": 0, "pages_served": 0, "expired": 0, "invalid": 0, "evictions": 0}
+
+    def store(self, items, offset, page_size, info=None):
+        """Keep ranked items; returns the cursor of the page starting at offset, or None if nothing is left."""
+        if offset >= len(items):
+            return None
+        token = secrets.token_urlsafe(12)
+        now = time.monotonic()
+        with self._lock:
+            # Entries are in insertion order, so the expired ones are all at the front
+            while self._entries and now - next(iter(self._entries.values()))[0] >= self.ttl:
+                self._entries.popitem(last=False)
+                self._stats["expired"] += 1
+            self._entries[token] = (now, items, page_size, info or {})
+            self._stats["stored"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        return encode_cursor(token, offset)
+
+    def page(self, cursor):
+        """
+        (items, next_cursor, info) of the page at cursor; next_cursor is None on the last page.
+        Returns None if the cursor is malformed, expired or evicted.
+        """
+        decoded = decode_cursor(cursor)
+        with self._lock:
+            entry = self._entries.get(decoded[0]) if decoded else None
+            if entry is None:
+                self._stats["invalid"] += 1
+                return None
+            token, offset = decoded
+            stored_at, items, page_size, info = entry
+            if time.monotonic() - stored_at >= self.ttl:
+                del self._entries[token]
+                self._stats["expired"] += 1
+                return None
+            self._stats["pages_served"] += 1
+        end = offset + page_size
+        next_cursor = encode_cursor(token, end) if end < len(items) else None
+        return items[offset:end], next_cursor, info
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["items_held"] = sum(len(entry[1]) for entry in self._entries.values())
+        return stats
@@ -0,0 +1,347 @@
+# sharded_index.py
+import os
+import time
+import zlib
+import heapq
+import argparse
+import threading
+import multiprocessing
+
+import numpy as np
+from dotenv import load_dotenv
+
+from catalog_item import parse_price
+from embedding_store import write_flat_file, open_flat_file
+
+load_dotenv()
+
+# --- Shard Constants ---
+SHARD_DIR = os.getenv("CATALOG_SHARD_DIR", "catalog_shards")
+DEFAULT_SHARD_COUNT = int(os.getenv("CATALOG_SHARD_COUNT", "4"))
+SHARD_QUERY_TIMEOUT = 10.0  # seconds to wait for one shard's answer
+
+
+def shard_of(item_id, n_shards):
+    """Shard number of an item: a stable hash of its id (the same in every process and run)."""
+    return zlib.crc32(str(item_id).encode("utf-8")) % n_shards
+
+
+def _query_vector(query):
+    vector = query.get("vector")
+    return None if vector is None else np.asarray(vector, dtype=np.float32)
+
+
+class CatalogShard:
+    """
+    One partition of the local catalog index: ids, lowercased titles and types, prices and
+    (optionally) one embedding row per item, plus each item's position in catalog order so
+    shards rank ties exactly like the unsharded catalog. search() answers one query with this
+    shard's total match count and its top-k hits as (key, id, score), smallest key first.
+    """
+
+    def __init__(self, positions, ids, titles, types, prices, vectors=None):
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.str_)
+        self.titles = np.asarray(titles, dtype=np.str_)
+        self.types = np.asarray(types, dtype=np.str_)
+        self.prices = np.asarray(prices, dtype=np.float64)  # NaN where the item has no price
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_items(cls, positioned_items, vectors=None):
+        """Build from (catalog position, raw item dict) pairs; vectors (n x d) is row-aligned with them."""
+        rows = [(position, str(item["id"]), (item.get("jew_title") or "").lower(), (item.get("jew_type") or "").lower(),
+                 parse_price(item.get("jew_sell_price"))) for position, item in positioned_items]
+        positions, ids, titles, types, prices = zip(*rows) if rows else ((), (), (), (), ())
+        prices = [np.nan if price is None else price for price in prices]
+        return cls(positions, ids, titles, types, prices, vectors)
+
+    def to_arrays(self):
+        arrays = {"positions": self.positions, "ids": self.ids, "titles": self.titles,
+                  "types": self.types, "prices": self.prices}
+        if self.vectors is not None:
+            arrays["vectors"] = self.vectors
+        return arrays
+
+    def save(self, path):
+        write_flat_file(path, self.to_arrays(), {"count": len(self)})
+
+    @classmethod
+    def load(cls, path):
+        _, arrays = open_flat_file(path)
+        return cls(arrays["positions"], arrays["ids"], arrays["titles"], arrays["types"], arrays["prices"],
+                   arrays.get("vectors"))
+
+    def matching_rows(self, query):
+        """Rows passing the type, price and title-term constraints of query."""
+        mask = np.ones(len(self), dtype=bool)
+        if query.get("types"):
+            mask &= np.isin(self.types, [t.lower() for t in query["types"]])
+        if query.get("min_price") is not None:
+            mask &= self.prices >= query["min_price"]
+        if query.get("max_price") is not None:
+            mask &= self.prices <= query["max_price"]
+        rows = np.flatnonzero(mask)
+        # Substring tests (the same rule as the Pass 2 / Pass 3 title filters) only on survivors
+        for term in query.get("terms") or ():
+            if len(rows):
+                rows = rows[np.char.find(self.titles[rows], term.lower()) >= 0]
+        return rows
+
+    def search(self, query):
+        """{"total": matches, "hits": [(key, id, score)]} for query, at most query["k"] hits."""
+        rows = self.matching_rows(query)
+        k = int(query.get("k", 10))
+        vector = _query_vector(query)
+        scores = np.zeros(len(rows), dtype=np.float32)
+        if vector is not None and self.vectors is not None:
+            if self.vectors.shape[1]:  # shards written before every shard shared one dimension may have none
+                scores = self.vectors[rows] @ vector
+            primary = -scores.astype(np.float64)
+        elif query.get("sort") in ("price_asc", "price_desc"):
+            prices = self.prices[rows]
+            primary = np.where(np.isnan(prices), np.inf, prices if query["sort"] == "price_asc" else -prices)
+        else:
+            primary = np.zeros(len(rows))
+        order = np.lexsort((self.positions[rows], primary))[:k]
+        hits = [((float(primary[i]), int(self.positions[rows[i]])), str(self.ids[rows[i]]), float(scores[i]))
+                for i in order]
+        return {"total": int(len(rows)), "hits": hits}
+
+
+def build_shards(items, n_shards=DEFAULT_SHARD_COUNT, shard_dir=SHARD_DIR, vector_for=None):
+    """
+    Partition raw catalog items into n_shards files by item-id hash. vector_for(item_id), if
+    given, returns each item's embedding (None if it has none; such items get a zero row).
+    Every shard gets the same dimension, even one whose items have no embedding; if no item
+    has one, the shards carry no vectors. Returns the shard paths.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    partitions = [[] for _ in range(n_shards)]
+    for position, item in enumerate(item for item in items if item.get("id")):
+        partitions[shard_of(item["id"], n_shards)].append((position, item))
+    embedded, dim = None, 0
+    if vector_for is not None:
+        embedded = [[vector_for(item["id"]) for _, item in partition] for partition in partitions]
+        dim = next((len(v) for shard_vectors in embedded for v in shard_vectors if v is not None), 0)
+    paths = []
+    for shard_number, partition in enumerate(partitions):
+        vectors = None
+        if dim:
+            vectors = np.zeros((len(partition), dim), dtype=np.float32)
+            for row, vector in enumerate(embedded[shard_number]):
+                if vector is not None:
+                    vectors[row] = vector
+        path = os.path.join(shard_dir, f"shard-{shard_number}-of-{n_shards}.snap")
+        CatalogShard.from_items(partition, vectors).save(path)
+        paths.append(path)
+    print(f"Wrote {n_shards} catalog shards ({sum(len(p) for p in partitions)} items) to '{shard_dir}'.")
+    return paths
+
+
+def shard_paths(n_shards=DEFAULT_SHARD_COUNT, shard_dir=SHARD_DIR):
+    return [os.path.join(shard_dir, f"shard-{i}-of-{n_shards}.snap") for i in range(n_shards)]
+
+
+def _serve_shard(path, conn):
+    """Shard worker process: map the shard file and answer queries until told to stop (None)."""
+    shard = CatalogShard.load(path)
+    conn.send({"ready": len(shard)})
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        query_id, query = message
+        try:
+            conn.send((query_id, shard.search(query)))
+        except Exception as e:
+            conn.send((query_id, {"error": f"{type(e).__name__}: {e}"}))
+    conn.close()
+
+
+class ShardedCatalogIndex:
+    """
+    Query front end over shard worker processes. search() scatters the query to every shard
+    over its pipe, gathers each shard's top-k and merges them (heapq.merge on the shard-sorted
+    keys), so the answer equals an unsharded search. Concurrent searches pipeline: each shard
+    connection is held only from sending a query until its answer is read.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = []
+        self._connections = []
+        self._locks = []
+        self._stats_lock = threading.Lock()
+        self._stats = {"queries": 0, "errors": 0, "query_seconds": 0.0}
+        self._query_ids = iter(range(1, 1 << 62))
+
+    def start(self):
+        for path in self.paths:
+            parent_conn, child_conn = self._context.Pipe()
+            worker = self._context.Process(target=_serve_shard, args=(path, child_conn), daemon=True)
+            worker.start()
+            child_conn.close()
+            self._workers.append(worker)
+            self._connections.append(parent_conn)
+            self._locks.append(threading.Lock())
+        items = sum(conn.recv()["ready"] for conn in self._connections)
+        print(f"Started {len(self._workers)} shard workers serving {items} items.")
+        return self
+
+    def search(self, query):
+        """Merged {"total", "hits"} of query over all shards. Raises RuntimeError if a shard fails."""
+        start_time = time.perf_counter()
+        answers, error = [], None
+        with self._stats_lock:
+            query_id = next(self._query_ids)
+        # Locks are always taken in shard order, so concurrent searches cannot deadlock
+        sent = []
+        for lock, conn in zip(self._locks, self._connections):
+            lock.acquire()
+            try:
+                conn.send((query_id, query))
+                sent.append(True)
+            except OSError as e:
+                error = error or e
+                sent.append(False)
+        for lock, conn, was_sent in zip(self._locks, self._connections, sent):
+            try:
+                if not was_sent:
+                    continue
+                # Answers to earlier queries that timed out are still in the pipe; skip them
+                answered_id, answer = None, None
+                while answered_id != query_id:
+                    if not conn.poll(SHARD_QUERY_TIMEOUT):
+                        raise RuntimeError("shard did not answer in time")
+                    answered_id, answer = conn.recv()
+                if "error" in answer:
+                    raise RuntimeError(answer["error"])
+                answers.append(answer)
+            except (RuntimeError, EOFError, OSError) as e:
+                error = error or e
+            finally:
+                lock.release()
+        with self._stats_lock:
+            self._stats["queries"] += 1
+            self._stats["errors"] += error is not None
+            self._stats["query_seconds"] += time.perf_counter() - start_time
+        if error is not None:
+            raise RuntimeError(f"Sharded search failed: {error}")
+        k = int(query.get("k", 10))
+        merged = heapq.merge(*(answer["hits"] for answer in answers), key=lambda hit: hit[0])
+        return {"total": sum(answer["total"] for answer in answers), "hits": [hit for _, hit in zip(range(k), merged)]}
+
+    def close(self):
+        for conn in self._connections:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.join(timeout=5)
+        self._workers, self._connections, self._locks = [], [], []
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["shards"] = len(self.paths)
+        stats["avg_query_ms"] = round(stats.pop("query_seconds") / stats["queries"] * 1000, 2) if stats["queries"] else 0.0
+        return stats
+
+
+# --- Benchmark: throughput per shard count on a synthetic catalog ---
+def _synthetic_catalog(n, seed=0):
+    rng = np.random.default_rng(seed)
+    types = ["Rings", "Earrings", "Pendants", "Bracelets", "Necklaces", "Charms"]
+    materials = ["Sterling Silver", "Yellow Gold", "Rose Gold", "White Gold", "Platinum"]
+    designs = ["Heart", "Cross", "Moon", "Star", "Floral", "Initial P", "Infinity", "Tree Of Life", "Butterfly"]
+    return [{"id": f"{i + 1}", "jew_type": types[i % len(types)],
+             "jew_title": f"{materials[int(rng.integers(len(materials)))]} {designs[int(rng.integers(len(designs)))]} "
+                          f"{types[i % len(types)][:-1]} {i}",
+             "jew_sell_price": f"{rng.uniform(20, 900):.2f}"} for i in range(n)]
+
+
+def _synthetic_queries(count, dim, seed=1):
+    rng = np.random.default_rng(seed)
+    terms = [["silver"], ["gold", "heart"], ["moon"], ["rose gold", "initial p"], ["star"], []]
+    queries = []
+    for i in range(count):
+        query = {"terms": terms[i % len(terms)], "types": [["Pendants", "Necklaces"], ["Rings"], []][i % 3],
+                 "min_price": 50.0 if i % 2 else None, "max_price": 600.0 if i % 4 == 1 else None,
+                 "sort": ["relevance", "price_asc", "price_desc"][i % 3], "k": 10}
+        if dim and i % 5 == 4:
+            vector = rng.standard_normal(dim).astype(np.float32)
+            query["vector"] = vector / np.linalg.norm(vector)
+        queries.append(query)
+    return queries
+
+
+def _run_clients(index, queries, clients):
+    """Run queries from `clients` threads; returns the wall time."""
+    chunks = [queries[i::clients] for i in range(clients)]
+    threads = [threading.Thread(target=lambda chunk=chunk: [index.search(q) for q in chunk]) for chunk in chunks]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the sharded catalog index, or benchmark scatter-gather throughput.")
+    parser.add_argument("--shards", type=int, default=DEFAULT_SHARD_COUNT)
+    parser.add_argument("--shard-dir", default=SHARD_DIR)
+    parser.add_argument("--max-items", type=int, default=None)
+    parser.add_argument("--image-index", default=None, help="ImageEmbeddingIndex .npz whose vectors go into the shards")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="N",
+                        help="time queries over a synthetic N-item catalog for 1..--shards shards instead of building")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--dim", type=int, default=64)
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        start_time = time.time()
+        from catalog_client import iter_catalog_items  # only the build needs the API (workers are spawned without it)
+        vector_for = None
+        if args.image_index:
+            from image_index import ImageEmbeddingIndex
+            vector_for = ImageEmbeddingIndex.load(args.image_index).vector_for
+        build_shards(iter_catalog_items(max_items=args.max_items), args.shards, args.shard_dir, vector_for)
+        print(f"Shard build time: {time.time() - start_time:.2f}s")
+    else:
+        items = _synthetic_catalog(args.benchmark)
+        vectors = np.random.default_rng(2).standard_normal((len(items), args.dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        rows_by_id = {item["id"]: row for row, item in enumerate(items)}
+        queries = _synthetic_queries(args.queries, args.dim)
+        # Reference answers from one in-process shard holding the whole catalog
+        unsharded = CatalogShard.from_items(list(enumerate(items)), vectors)
+        start_time = time.perf_counter()
+        expected = [unsharded.search(query) for query in queries]
+        baseline = time.perf_counter() - start_time
+        print(f"{args.benchmark} items, {len(queries)} queries, {args.clients} clients")
+        print(f"  in-process, unsharded: {len(queries) / baseline:8.1f} QPS (single thread)")
+        shard_counts = sorted({1, 2, 4, 8, args.shards} & set(range(1, args.shards + 1)))
+        for n_shards in shard_counts:
+            shard_dir = os.path.join(args.shard_dir, f"benchmark-{n_shards}")
+            paths = build_shards(items, n_shards, shard_dir, lambda item_id: vectors[rows_by_id[item_id]])
+            index = ShardedCatalogIndex(paths).start()
+            try:
+                answers = [index.search(query) for query in queries]
+                mismatches = sum((got["total"], [hit[1] for hit in got["hits"]]) != (want["total"], [hit[1] for hit in want["hits"]])
+                                 for got, want in zip(answers, expected))
+                elapsed = _run_clients(index, queries, args.clients)
+                print(f"  {n_shards} shard(s): {len(queries) / elapsed:8.1f} QPS, "
+                      f"avg latency {index.stats()['avg_query_ms']:.2f}ms, {mismatches} answers differ from unsharded")
+            finally:
+                index.close()
@@ -0,0 +1,214 @@
+# similar_items.py
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+from dotenv import load_dotenv
+
+from ann_index import IVFIndex, exact_search_scores
+from catalog_client import iter_catalog_items
+from catalog_index import FACETS, item_facet_values
+from embedding_store import write_flat_file, open_flat_file
+
+load_dotenv()
+
+# --- Similar Items Constants ---
+SIMILAR_ITEMS_PATH = os.getenv("SIMILAR_ITEMS_PATH", "similar_items.snap")
+SIMILAR_ITEMS_K = 12            # neighbours stored per item
+TITLE_FEATURE_DIM = 256         # hashed random projection of title TF-IDF
+TITLE_WEIGHT = 1.0              # weights of the similarity components (cosines are mixed by weight)
+ATTRIBUTE_WEIGHT = 0.5
+IMAGE_WEIGHT = 1.0
+EXACT_KNN_MAX_ITEMS = 20000     # above this the graph is built with an IVF index instead of all-pairs scores
+EXACT_KNN_BLOCK = 1024
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _token_vector(token, dim):
+    # Same pseudo-random direction for a token in every build, so graphs are reproducible
+    seed = int.from_bytes(hashlib.md5(token.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def _normalized(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def title_features(titles, dim=TITLE_FEATURE_DIM):
+    """TF-IDF of title tokens, randomly projected to dim dimensions and L2-normalized."""
+    tokenized = [_TOKEN_RE.findall((title or "").lower()) for title in titles]
+    document_frequency = {}
+    for tokens in tokenized:
+        for token in set(tokens):
+            document_frequency[token] = document_frequency.get(token, 0) + 1
+    n = len(tokenized)
+    directions = {token: _token_vector(token, dim) * (np.log((n + 1) / (df + 1)) + 1.0)
+                  for token, df in document_frequency.items()}
+    features = np.zeros((n, dim), dtype=np.float32)
+    for row, tokens in enumerate(tokenized):
+        for token in tokens:
+            features[row] += directions[token]
+    return _normalized(features)
+
+
+def attribute_features(items):
+    """One-hot type / material / style values (catalog_index facets), L2-normalized."""
+    rows = [item_facet_values(item.get("jew_type"), item.get("jew_title"), item.get("jew_categories")) for item in items]
+    columns = {}
+    for values in rows:
+        for facet in FACETS:
+            for value in values[facet]:
+                columns.setdefault((facet, value), len(columns))
+    features = np.zeros((len(items), max(len(columns), 1)), dtype=np.float32)
+    for row, values in enumerate(rows):
+        for facet in FACETS:
+            for value in values[facet]:
+                features[row, columns[(facet, value)]] = 1.0
+    return _normalized(features)
+
+
+def item_features(items, image_index=None):
+    """
+    One unit vector per item whose inner products are the weighted mean of the title,
+    attribute and (when an ImageEmbeddingIndex is given) image cosine similarities.
+    Items without an image embedding get a zero image block.
+    """
+    blocks = [(TITLE_WEIGHT, title_features([item.get("jew_title") for item in items])),
+              (ATTRIBUTE_WEIGHT, attribute_features(items))]
+    if image_index is not None and len(image_index):
+        images = np.zeros((len(items), image_index.vectors.shape[1]), dtype=np.float32)
+        for row, item in enumerate(items):
+            vector = image_index.vector_for(item["id"])
+            if vector is not None:
+                images[row] = vector
+        blocks.append((IMAGE_WEIGHT, images))
+    total_weight = sum(weight for weight, _ in blocks)
+    return np.hstack([np.sqrt(weight / total_weight) * block for weight, block in blocks]).astype(np.float32)
+
+
+def nearest_neighbors(features, k=SIMILAR_ITEMS_K, exact_max_items=EXACT_KNN_MAX_ITEMS):
+    """
+    Top-k neighbours of every row, excluding itself: exact blocked all-pairs scores for small
+    catalogs, an IVF index above exact_max_items. Returns (neighbors int64, scores float32),
+    both (n, k) and best first; rows with fewer than k neighbours are padded with -1 / 0.
+    """
+    n = len(features)
+    neighbors = np.full((n, k), -1, dtype=np.int64)
+    scores = np.zeros((n, k), dtype=np.float32)
+    if n <= exact_max_items:
+        for start in range(0, n, EXACT_KNN_BLOCK):
+            block_scores = features[start:start + EXACT_KNN_BLOCK] @ features.T
+            for offset, row_scores in enumerate(block_scores):
+                row_scores[start + offset] = -np.inf
+                top, top_scores = exact_search_scores(row_scores, min(k, n - 1))
+                neighbors[start + offset, :len(top)] = top
+                scores[start + offset, :len(top)] = top_scores
+        return neighbors, scores
+    index = IVFIndex(nlist=int(np.sqrt(n) * 2)).build(features)
+    for row in range(n):
+        top, top_scores = index.search(features[row], features, k + 1)
+        keep = top != row
+        top, top_scores = top[keep][:k], top_scores[keep][:k]
+        neighbors[row, :len(top)] = top
+        scores[row, :len(top)] = top_scores
+    return neighbors, scores
+
+
+class SimilarItemsTable:
+    """
+    Precomputed "more like this" table: for every catalog item, its top-k neighbours and
+    scores, plus each item's API payload (JSON, stored as one byte blob with offsets) so a
+    lookup needs no catalog call. Saved in the flat snapshot format and opened with mmap.
+    """
+
+    def __init__(self, ids, neighbors, scores, payload_blob, payload_offsets, sorted_ids=None, sorted_positions=None):
+        self.ids = np.asarray(ids, dtype=np.str_)
+        self.neighbors = neighbors
+        self.scores = scores
+        self.payload_blob = payload_blob
+        self.payload_offsets = payload_offsets
+        if sorted_ids is None:
+            sorted_positions = np.argsort(self.ids, kind="stable")
+            sorted_ids = self.ids[sorted_positions]
+        self.sorted_ids = sorted_ids
+        self.sorted_positions = sorted_positions
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, items, image_index=None, k=SIMILAR_ITEMS_K):
+        items = [item for item in items if item.get("id")]
+        start_time = time.time()
+        neighbors, scores = nearest_neighbors(item_features(items, image_index), k)
+        payloads = [json.dumps(item, separators=(",", ":")).encode("utf-8") for item in items]
+        payload_offsets = np.concatenate([[0], np.cumsum([len(p) for p in payloads])]).astype(np.int64)
+        payload_blob = np.frombuffer(b"".join(payloads), dtype=np.uint8)
+        print(f"Built similar-items table for {len(items)} items (k={k}) in {time.time() - start_time:.2f}s")
+        return cls([str(item["id"]) for item in items], neighbors, scores, payload_blob, payload_offsets)
+
+    def to_arrays(self):
+        return {"ids": self.ids, "neighbors": self.neighbors, "scores": self.scores,
+                "payload_blob": self.payload_blob, "payload_offsets": self.payload_offsets,
+                "sorted_ids": self.sorted_ids, "sorted_positions": self.sorted_positions}
+
+    def save(self, path=SIMILAR_ITEMS_PATH):
+        write_flat_file(path, self.to_arrays(), {"count": len(self), "k": int(self.neighbors.shape[1])})
+        print(f"Saved similar-items table of {len(self)} items to '{path}'.")
+
+    @classmethod
+    def load(cls, path=SIMILAR_ITEMS_PATH):
+        _, arrays = open_flat_file(path)
+        return cls(arrays["ids"], arrays["neighbors"], arrays["scores"], arrays["payload_blob"],
+                   arrays["payload_offsets"], arrays["sorted_ids"], arrays["sorted_positions"])
+
+    def row_of(self, item_id):
+        item_id = str(item_id)
+        slot = int(np.searchsorted(self.sorted_ids, item_id))
+        if slot < len(self.sorted_ids) and self.sorted_ids[slot] == item_id:
+            return int(self.sorted_positions[slot])
+        return -1
+
+    def payload(self, row):
+        start, end = self.payload_offsets[row], self.payload_offsets[row + 1]
+        return json.loads(self.payload_blob[start:end].tobytes())
+
+    def similar(self, item_id, k=SIMILAR_ITEMS_K):
+        """[(item payload, score)] of item_id's neighbours, best first; None if the item is unknown."""
+        row = self.row_of(item_id)
+        if row < 0:
+            return None
+        return [(self.payload(int(neighbor)), float(score))
+                for neighbor, score in zip(self.neighbors[row, :k], self.scores[row, :k]) if neighbor >= 0]
+
+
+def load_similar_items(path=SIMILAR_ITEMS_PATH):
+    """The saved similar-items table, or None if the offline job has not run yet."""
+    if not os.path.exists(path):
+        return None
+    start_time = time.perf_counter()
+    table = SimilarItemsTable.load(path)
+    print(f"Loaded similar-items table of {len(table)} items from '{path}' in {(time.perf_counter() - start_time) * 1000:.1f}ms")
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the catalog 'more like this' kNN table.")
+    parser.add_argument("--output", default=SIMILAR_ITEMS_PATH)
+    parser.add_argument("--k", type=int, default=SIMILAR_ITEMS_K)
+    parser.add_argument("--max-items", type=int, default=None)
+    parser.add_argument("--image-index", default=None, help="ImageEmbeddingIndex .npz to mix in image similarity")
+    args = parser.parse_args()
+
+    image_index = None
+    if args.image_index:
+        from image_index import ImageEmbeddingIndex
+        image_index = ImageEmbeddingIndex.load(args.image_index)
+    table = SimilarItemsTable.build(list(iter_catalog_items(max_items=args.max_items)), image_index, args.k)
+    table.save(args.output)
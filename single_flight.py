@@ -0,0 +1,81 @@
+# single_flight.py
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the work, callers that
+    arrive while it is in flight wait for its result instead of repeating it. Nothing is kept
+    once the call returns (this is not a cache), and an error reaches every waiter.
+    Results are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self):
+        self._in_flight = {}        # key -> Future of the running call
+        self._async_in_flight = {}  # key -> asyncio.Future of a call made by do_async
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "executed": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key, fn):
+        """fn() once per key at a time. Returns (result, shared); shared is True for a caller that waited."""
+        with self._lock:
+            self._stats["calls"] += 1
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                self._stats["executed"] += 1
+                future = self._in_flight[key] = Future()
+            else:
+                self._stats["coalesced"] += 1
+        if not owner:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self._stats["errors"] += 1
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._in_flight.pop(key, None)
+        future.set_result(result)
+        return result, False
+
+    async def do_async(self, key, fn_async):
+        """do() for asyncio callers: await fn_async() once per key at a time. Returns (result, shared)."""
+        with self._lock:
+            self._stats["calls"] += 1
+            future = self._async_in_flight.get(key)
+            owner = future is None
+            if owner:
+                self._stats["executed"] += 1
+                future = self._async_in_flight[key] = asyncio.get_running_loop().create_future()
+            else:
+                self._stats["coalesced"] += 1
+        if not owner:
+            return await asyncio.shield(future), True
+        try:
+            result = await fn_async()
+        except BaseException as e:
+            with self._lock:
+                self._stats["errors"] += 1
+                self._async_in_flight.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # waiters re-raise it; mark it retrieved if there are none
+            raise
+        with self._lock:
+            self._async_in_flight.pop(key, None)
+        future.set_result(result)
+        return result, False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._in_flight) + len(self._async_in_flight)
+        return stats
@@ -5,7 +5,7 @@ window.closeModal = closeModal;
 window.openModalWithDetails = openModalWithDetails; // Expose the new modal function
 
 // Global variable (can keep or remove if not used elsewhere)
-let lastQuery = ""; // Stores the last successful image URL query
+let lastQuery = ""; // Stores the last successful image URL or text query
 
 /**
  * Close the details modal and clear its content.
@@ -25,7 +25,7 @@ function closeModal() {
  * Add a chat message bubble to the chat interface.
  * Handles both plain text and HTML content for bot messages.
  */
-function addMessage(messageContent, isUser = false) {
+function addMessage(messageContent, isUser = false, plainText = false) {
     const chatMessages = document.getElementById("chatMessages");
     if (!chatMessages) return; // Exit if chat container not found
 
@@ -50,8 +50,9 @@ function addMessage(messageContent, isUser = false) {
     bubble.classList.add(isUser ? "user-bubble" : "bot-bubble");
 
     // IMPORTANT: Render HTML content directly for bot messages (cards, errors with links etc.)
-    // Use textContent for user messages to prevent XSS from user input
-    if (isUser) {
+    // Use textContent for user messages, and for bot messages that quote user input or model
+    // output (plainText), to prevent XSS
+    if (isUser || plainText) {
         bubble.textContent = messageContent;
     } else {
         // Check if the content looks like HTML (contains '<'), otherwise treat as text
@@ -91,6 +92,7 @@ function addMessage(messageContent, isUser = false) {
     chatMessages.appendChild(msgDiv);
     // Scroll to the bottom of the chat messages
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    return msgDiv;
 }
 
 /**
@@ -151,16 +153,20 @@ function isValidHttpUrl(string) {
 /**
  * Parse jewelry data from the backend response and display results.
  */
-function handleJewelryData(responseData) {
+function handleJewelryData(responseData, captionShown = false) {
     // Expected structure: { data: [...], total_found: X, source_pass: '...', generated_caption: '...' }
     const jewelryData = responseData.data;
     const totalFound = responseData.total_found || 0; // Use total_found from response
     const sourcePass = responseData.source_pass || "N/A"; // Which search pass yielded results
     const generatedCaption = responseData.generated_caption; // Caption generated by vision model
 
-    // Add the generated caption as a bot message first (if available)
-    if (generatedCaption) {
-         addMessage(`Okay, I see: "${generatedCaption}"`, false);
+    // Add the generated caption as a bot message first (if available and not already streamed)
+    if (captionShown) {
+         // The caption was shown as soon as it arrived (see streamImageSearch)
+    } else if (generatedCaption) {
+         addMessage(`Okay, I see: "${generatedCaption}"`, false, true);
+    } else if (responseData.search_query) {
+         addMessage(`Looking for: "${responseData.search_query}"`, false, true); // Text search, no image analyzed
     } else {
          addMessage("I analyzed the image.", false); // Fallback message
     }
@@ -168,13 +174,117 @@ function handleJewelryData(responseData) {
 
     if (!jewelryData || jewelryData.length === 0) {
         updateSearchResultsBar("No similar jewelry found.");
-        addMessage("Sorry, I couldn't find any similar items based on that image.", false);
+        addMessage(`Sorry, I couldn't find any similar items based on that ${responseData.search_query ? "description" : "image"}.`, false);
         return;
     }
 
     // Update search results bar - report the number *returned* (which is total_found in the current backend logic)
-    updateSearchResultsBar(`Found ${totalFound} similar item(s). (Results from: ${sourcePass})`);
+    const facetSummary = formatFacetSummary(responseData.facets);
+    updateSearchResultsBar(`Found ${totalFound} similar item(s). (Results from: ${sourcePass})` + (facetSummary ? ` · ${facetSummary}` : ""));
+
+    // Display the cards in a bot message bubble
+    addMessage(renderJewelryCards(jewelryData) + renderLoadMoreButton(responseData.next_cursor), false);
+}
+
+/**
+ * Image search over /find_similar_jewelry/stream: the caption, the extracted attributes and
+ * early Pass 1 matches are shown as their Server-Sent Events arrive, and the early matches are
+ * replaced by the refined results at the end. Rejects with an Error on failure.
+ */
+async function streamImageSearch(imageUrl) {
+    const response = await fetch("/find_similar_jewelry/stream", {
+        method: "POST",
+        headers: { "Content-Type": "application/json", "Accept": "text/event-stream" },
+        body: JSON.stringify({ image_url: imageUrl })
+    });
+    if (!response.ok || !response.body) {
+        const errData = await response.json().catch(() => ({}));
+        throw new Error(errData.error || `Search failed: ${response.statusText} (Status: ${response.status})`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let captionShown = false;
+    let earlyResultsMessage = null;
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) >= 0) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = "message";
+            let data = "";
+            for (const line of frame.split("\n")) {
+                if (line.startsWith("event:")) event = line.slice(6).trim();
+                else if (line.startsWith("data:")) data += line.slice(5).trim();
+            }
+            const payload = data ? JSON.parse(data) : {};
+
+            if (event === "caption") {
+                removeThinkingPlaceholder();
+                addMessage(`Okay, I see: "${payload.generated_caption}"`, false, true);
+                captionShown = true;
+                addMessage("...", false);
+            } else if (event === "attributes") {
+                const attributes = payload.extracted_attributes || {};
+                const description = [attributes.material, attributes.design, attributes.jewelry_type].filter(Boolean).join(" ");
+                updateSearchResultsBar(`Searching for ${description || "similar jewelry"}...`);
+            } else if (event === "candidates") {
+                removeThinkingPlaceholder();
+                updateSearchResultsBar(`Found ${payload.total_found} early match(es), refining...`);
+                earlyResultsMessage = addMessage(renderJewelryCards(payload.data), false);
+                addMessage("...", false);
+            } else if (event === "results") {
+                removeThinkingPlaceholder();
+                if (earlyResultsMessage) earlyResultsMessage.remove(); // Replaced by the refined results
+                handleJewelryData(payload, captionShown);
+                return;
+            } else if (event === "error") {
+                if (earlyResultsMessage) earlyResultsMessage.remove();
+                throw new Error(payload.error || "Search failed.");
+            }
+        }
+    }
+    throw new Error("Search failed: the connection closed before the results arrived.");
+}
+
+/**
+ * "Show more results" button for a search that has more ranked results cached on the server.
+ */
+function renderLoadMoreButton(nextCursor) {
+    if (!nextCursor) return "";
+    return `<button class="load-more-btn" data-cursor="${nextCursor}"
+                    onclick="loadMoreResults(this.dataset.cursor, this)">Show more results</button>`;
+}
 
+/**
+ * Fetch the next page of a previous search (no new image analysis or catalog search) and show it.
+ */
+async function loadMoreResults(cursor, button) {
+    if (button) button.remove(); // Each page is loaded once
+    try {
+        const response = await fetch(`/find_similar_jewelry/more?cursor=${encodeURIComponent(cursor)}`);
+        const responseData = await response.json();
+        if (!response.ok || !responseData.data || responseData.data.length === 0) {
+            addMessage(responseData.error || "There are no more results for this search.", false);
+            return;
+        }
+        updateSearchResultsBar(`Showing ${responseData.total_found} more item(s). (Results from: ${responseData.source_pass})`);
+        addMessage(renderJewelryCards(responseData.data) + renderLoadMoreButton(responseData.next_cursor), false);
+    } catch (error) {
+        console.error("Error loading more results:", error);
+        addMessage("Sorry, something went wrong while loading more results.", false);
+    }
+}
+window.loadMoreResults = loadMoreResults;
+
+/**
+ * Build the HTML for a row of jewelry cards (each with a "View Details" button).
+ */
+function renderJewelryCards(jewelryData) {
     // Build HTML for jewelry cards
     // Ensure using consistent class names defined in CSS
     let cardsHtml = `<div class="jewelry-cards-in-chat">`;
@@ -227,9 +337,44 @@ function handleJewelryData(responseData) {
         `;
     }
     cardsHtml += `</div>`;
+    return cardsHtml;
+}
 
-    // Display the generated cards HTML in a bot message bubble
-    addMessage(cardsHtml, false);
+/**
+ * Fetch items similar to a catalog item from the precomputed table and show them in the chat.
+ */
+async function showSimilarItems(itemId, itemTitle) {
+    closeModal();
+    addMessage(`Show items similar to ${itemTitle || 'this item'}`, true);
+    try {
+        const response = await fetch(`/similar/${encodeURIComponent(itemId)}`);
+        const responseData = await response.json();
+        if (!response.ok || !responseData.data || responseData.data.length === 0) {
+            addMessage(responseData.error || "Sorry, I couldn't find similar items for this one.", false);
+            return;
+        }
+        updateSearchResultsBar(`Found ${responseData.total_found} similar item(s). (Results from: ${responseData.source_pass})`);
+        addMessage(renderJewelryCards(responseData.data), false);
+    } catch (error) {
+        console.error("Error fetching similar items:", error);
+        addMessage("Sorry, something went wrong while looking for similar items.", false);
+    }
+}
+window.showSimilarItems = showSimilarItems;
+
+/**
+ * Summarize facet counts from the backend, e.g. "12 Rings, 30 Pendants, 8 Rose Gold".
+ * Shows the largest few values of each facet (type, material, style).
+ */
+function formatFacetSummary(facets, perFacet = 3) {
+    if (!facets) return "";
+    const parts = [];
+    ["type", "material", "style"].forEach(facet => {
+        Object.entries(facets[facet] || {}).slice(0, perFacet).forEach(([value, count]) => {
+            parts.push(`${count} ${value}`);
+        });
+    });
+    return parts.join(", ");
 }
 
 /**
@@ -313,6 +458,13 @@ function openModalWithDetails(jewelry) {
                     <p>Categories: <strong>${categories || 'N/A'}</strong></p>
                 </div>
 
+                ${jewelry.id ? `
+                    <button class="view-details-btn" data-item-id="${jewelry.id}" data-item-title="${title.replace(/"/g, '&quot;')}"
+                            onclick="showSimilarItems(this.dataset.itemId, this.dataset.itemTitle)">
+                        Show Similar
+                    </button>
+                ` : ''}
+
                 ${description ? `
                     <div class="jewelry-modal-desc">
                         <strong>Description:</strong>
@@ -486,33 +638,45 @@ function sendMessage() {
     if (!message) {
         // Maybe add a visual cue instead of a message? Or keep the message.
         // input.placeholder = "Please enter an image URL first!";
-        addMessage("Please paste an image URL first.", false); // Inform user if input is empty
+        addMessage("Please paste an image URL or describe the jewelry you want.", false); // Inform user if input is empty
         return;
     }
 
+    // Anything that is not a URL is sent as a text query (no image analysis needed)
+    const isImageSearch = message.startsWith('http://') || message.startsWith('https://');
+
     // Validate if the input looks like a plausible image URL
-    if (!isValidHttpUrl(message)) {
+    if (isImageSearch && !isValidHttpUrl(message)) {
          addMessage("Hmm, that doesn't look like a valid image URL. Please check and make sure it starts with http:// or https:// and points to an image file (e.g., .jpg, .png) or a known image service.", false);
          input.focus(); // Keep focus on input for easy correction
          return;
     }
 
     // Update UI: Show user message, clear input, show searching status
-    addMessage(message, true); // Display the URL the user entered
-    lastQuery = message; // Store the URL as the last query
+    addMessage(message, true); // Display the URL or text the user entered
+    lastQuery = message; // Store the URL or text as the last query
     input.value = ""; // Clear the input field
-    input.placeholder = "Paste another image URL..."; // Update placeholder
-    updateSearchResultsBar(`Searching for jewelry similar to image...`);
+    input.placeholder = "Paste another image URL or describe what you want..."; // Update placeholder
+    updateSearchResultsBar(isImageSearch ? `Searching for jewelry similar to image...` : `Searching for "${message}"...`);
     addMessage("...", false); // Add a "Thinking..." placeholder message
 
-    // Send the image URL to the backend endpoint
-    fetch("/find_similar_jewelry", { // Ensure this matches your Flask route
+    if (isImageSearch) {
+        // Image searches stream their progress (caption, early matches) as Server-Sent Events
+        streamImageSearch(message).catch(error => {
+            removeThinkingPlaceholder();
+            handleFetchError(error);
+        });
+        return;
+    }
+
+    // Send the text query to the backend endpoint
+    fetch("/search_text", { // Ensure this matches your Flask route
         method: "POST",
         headers: {
             "Content-Type": "application/json",
             "Accept": "application/json" // Indicate we expect JSON back
         },
-        body: JSON.stringify({ image_url: message }) // Send the URL in JSON format
+        body: JSON.stringify({ query: message }) // Send the input in JSON format
     })
     .then(response => {
         // Check if the response is successful (status code 200-299)
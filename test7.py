@@ -5,9 +5,19 @@ import os
 import json
 import re
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from groq import Groq
 from dotenv import load_dotenv
 
+from catalog_client import HEADERS, get_catalog_client
+from catalog_cache import CatalogCache
+from catalog_item import CatalogItem
+from top_k import TopKTiers
+from catalog_index import PRICE_SORTS, FacetCounter, load_catalog_index, make_price_rules
+from query_planner import TermStatistics, QueryPlanner
+from result_cursor import RESULT_CURSOR_MAX_CANDIDATES, ResultCursorCache
+
 # --- [Load environment variables, Initialize Groq, API Setup, Constants - SAME AS BEFORE] ---
 load_dotenv()
 groq_api_key = os.getenv("GROQ_API_KEY")
@@ -15,19 +25,6 @@ if not groq_api_key:
     print("Error: GROQ_API_KEY not found.")
 groq_client = Groq(api_key=groq_api_key) if groq_api_key else None
 
-API_URL = os.getenv("API_URL")
-API_APP = os.getenv("API_APP")
-API_KEY = os.getenv("API_KEY")
-API_SECRET = os.getenv("API_SECRET")
-if not all([API_URL, API_APP, API_KEY, API_SECRET]):
-    print("Error: Brilliance Hub API configuration missing.")
-HEADERS = {
-    "x-api-app": API_APP,
-    "x-api-key": API_KEY,
-    "x-api-secret": API_SECRET,
-    "Content-Type": "application/json"
-} if all([API_APP, API_KEY, API_SECRET]) else {} # Ensure headers are valid
-
 # --- [Constants - STYLES_MAP, number_words, jewelry_types, ALL_CATEGORIES - SAME AS BEFORE] ---
 STYLES_MAP = {
     "vintage": "Vintage", "modern": "Modern", "classic": "Classic", "bohemian": "Bohemian",
@@ -51,8 +48,25 @@ jewelry_types = {
     "Necklaces": ["necklace", "chain", "collar"], "Charms": ["charm"]
 }
 ALL_CATEGORIES = list(set(STYLES_MAP.values()))
+# Local attribute extraction for text queries (mirrors the create_json_from_caption prompt rules)
+MATERIAL_KEYWORDS = [  # (pattern, material), first match wins; only the materials the prompt allows
+    (r"rose", "Rose"), (r"white gold|platinum", "Sterling Silver"), (r"yellow", "Yellow"),
+    (r"gold", "Yellow"), (r"sterling|silver|metal", "Sterling Silver"), (r"diamonds?", "Diamond"), (r"pearls?", "Pearl")
+]
+DESIGN_KEYWORDS = {
+    "heart": "heart", "hearts": "heart", "flower": "floral", "flowers": "floral", "floral": "floral",
+    "cross": "cross", "angel": "angel", "star": "star", "stars": "star", "moon": "moon", "infinity": "infinity",
+    "tree of life": "tree of life", "butterfly": "butterfly", "knot": "knot", "solitaire": "solitaire",
+    "celestial": "celestial", "animal": "animal", "geometric": "geometric", "circle": "circle", "bar": "bar"
+}
+DETAIL_KEYWORDS = {"diamond", "pearl", "engraved", "gemstone", "birthstone", "personalized"}
+PASS1_MAX_CONCURRENCY = 4 # Max in-flight requests to the catalog host (shared by all searches in this process)
 # --- End Constants ---
 
+# Per-host concurrency cap for catalog API calls, and the pool that issues page requests
+_catalog_request_slots = threading.BoundedSemaphore(PASS1_MAX_CONCURRENCY)
+_catalog_fetch_pool = ThreadPoolExecutor(max_workers=PASS1_MAX_CONCURRENCY * 4, thread_name_prefix="catalog-fetch")
+
 
 # --- [Core Functions: image_to_base64, generate_caption, create_json_from_caption, get_additional_keywords_with_llm, extract_inscription_from_caption - SAME AS BEFORE] ---
 def image_to_base64(image_path_or_url):
@@ -110,6 +124,32 @@ def image_to_base64(image_path_or_url):
         print(f"  Error: Failed to obtain image content for {image_path_or_url}")
         return None
 
+def caption_request(image_base64):
+    """Chat completion arguments for captioning a base64 image (shared with async_pipeline)."""
+    # Updated prompt for more detail, especially inscriptions/text (SAME AS BEFORE)
+    prompt = """Describe this jewelry image concisely in 1-2 lines. Highlight:
+1.  Color (e.g., silver, gold, rose gold).
+2.  Type (e.g., ring, pendant, earrings).
+3.  Material if obvious (e.g., metal, pearl, diamond).
+4.  Main shape or design (e.g., heart-shaped, floral, initial).
+5.  Any text or specific words written/engraved on it (state the exact text if visible, e.g., 'engraved with "MAMA"'). If no text, do not mention it.
+6.  Any prominent secondary features (e.g., 'with a central diamond', 'featuring blue gemstones').
+
+Avoid generic words like 'jewelry'. Do NOT focus on the backgroud of the item. Only include the features that directly relate to the jewelry item itself."""
+
+    # Ensure the model name is correct and available (SAME AS BEFORE)
+    return dict(
+        model="llama-3.2-90b-vision-preview",
+        messages=[
+            {"role": "user", "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}} # Keep format as jpeg for simplicity unless specific need arises
+            ]}
+        ],
+        max_tokens=150,
+        temperature=0.1
+    )
+
 def generate_caption(image_path_or_url): # Rename parameter for clarity
     """Send base64 image to LLaMA Vision model for captioning."""
     if not groq_client:
@@ -123,31 +163,8 @@ def generate_caption(image_path_or_url): # Rename parameter for clarity
         print("Image conversion to base64 failed.")
         return None # Return None if base64 conversion failed
 
-    # Updated prompt for more detail, especially inscriptions/text (SAME AS BEFORE)
-    prompt = """Describe this jewelry image concisely in 1-2 lines. Highlight:
-1.  Color (e.g., silver, gold, rose gold).
-2.  Type (e.g., ring, pendant, earrings).
-3.  Material if obvious (e.g., metal, pearl, diamond).
-4.  Main shape or design (e.g., heart-shaped, floral, initial).
-5.  Any text or specific words written/engraved on it (state the exact text if visible, e.g., 'engraved with "MAMA"'). If no text, do not mention it.
-6.  Any prominent secondary features (e.g., 'with a central diamond', 'featuring blue gemstones').
-
-Avoid generic words like 'jewelry'. Do NOT focus on the backgroud of the item. Only include the features that directly relate to the jewelry item itself."""
-
     try:
-        # Ensure the model name is correct and available (SAME AS BEFORE)
-        response = groq_client.chat.completions.create(
-            model="llama-3.2-90b-vision-preview",
-            messages=[
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}} # Keep format as jpeg for simplicity unless specific need arises
-                ]}
-            ],
-            max_tokens=150,
-            temperature=0.1
-        )
-
+        response = groq_client.chat.completions.create(**caption_request(image_base64))
         caption = response.choices[0].message.content.strip()
         print(f"Generated Caption: {caption}")
         return caption
@@ -159,13 +176,8 @@ Avoid generic words like 'jewelry'. Do NOT focus on the backgroud of the item. O
         # Consider adding retries or specific error handling here
         return None # Return None on LLM error as well
 
-def create_json_from_caption(caption):
-    """Use Groq's LLaMA to convert a jewelry caption into a JSON object, extracting only required info."""
-    if not groq_client:
-        print("Error: Groq client not initialized. Check API key.")
-        return None
-
-    print(f"Creating JSON from caption: {caption}")
+def caption_json_request(caption):
+    """Chat completion arguments for turning a caption into the search JSON (shared with async_pipeline)."""
     prompt = f"""
 Given the following caption of a jewelry image, extract the following information and format it into a JSON object. Focus only on the jewelry item itself, ignoring background or irrelevant details. Extract only the most prominent and relevant features:
 
@@ -183,23 +195,23 @@ Provide the response STRICTLY as a JSON object only, without any introductory te
 
 Caption: "{caption}"
 """
+    return dict(
+        model="llama-3.3-70b-versatile", # Use a capable text model
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=200,
+        temperature=0.1,
+        response_format={"type": "json_object"}
+    )
+
+def parse_caption_json(llm_output):
+    """Parse the search JSON out of the LLM output, tolerating markdown fences and stray text. None on failure."""
+    print("Raw LLM Output (should be JSON):")
+    print(llm_output)
+
+    # Attempt to clean potential markdown ```json ``` artifacts before parsing
+    cleaned_llm_output = re.sub(r'^```json\s*|\s*```$', '', llm_output, flags=re.MULTILINE | re.DOTALL).strip()
 
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile", # Use a capable text model
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=200,
-            temperature=0.1,
-            response_format={"type": "json_object"}
-        )
-        llm_output = response.choices[0].message.content.strip()
-
-        print("Raw LLM Output (should be JSON):")
-        print(llm_output)
-
-        # Attempt to clean potential markdown ```json ``` artifacts before parsing
-        cleaned_llm_output = re.sub(r'^```json\s*|\s*```$', '', llm_output, flags=re.MULTILINE | re.DOTALL).strip()
-
         json_data = json.loads(cleaned_llm_output)
         print("Parsed JSON data:", json_data)
         return json_data
@@ -224,21 +236,24 @@ Caption: "{caption}"
         except json.JSONDecodeError as e2:
             print(f"Fallback JSON Decode Error: {e2}")
             return None
+
+def create_json_from_caption(caption):
+    """Use Groq's LLaMA to convert a jewelry caption into a JSON object, extracting only required info."""
+    if not groq_client:
+        print("Error: Groq client not initialized. Check API key.")
+        return None
+
+    print(f"Creating JSON from caption: {caption}")
+    try:
+        response = groq_client.chat.completions.create(**caption_json_request(caption))
+        return parse_caption_json(response.choices[0].message.content.strip())
     except Exception as e:
         print(f"Error in LLaMA JSON creation request: {e}")
         return None
 
 
-def get_additional_keywords_with_llm(caption, used_keywords_set):
-    """
-    Fallback function: Use LLM to suggest 1 additional keyword from caption,
-    focusing on specific features *if* inscription/category methods failed.
-    """
-    if not groq_client:
-        print("Error: Groq client not initialized for additional keyword extraction.")
-        return ""
-
-    print("    Attempting AI suggestion for Pass 3 keywords (Fallback)...")
+def keyword_request(caption, used_keywords_set):
+    """Chat completion arguments for the Pass 3 keyword fallback (shared with async_pipeline)."""
     # Convert set to a readable list for the prompt
     used_keywords_list = ", ".join(filter(None, used_keywords_set)) # Filter out potential None or empty strings
 
@@ -263,35 +278,49 @@ Examples:
 - Caption: "This silver-colored heart-shaped pendant features a central diamond." Used: [silver, heart, pendant, diamond]. Output: "diamond"
 - Caption: "A delicate bracelet with a floral design with blue gemstone." Used: [delicate, bracelet, floral]. Output: "blue"
 """
+    return dict(
+        model="llama-3.1-8b-instant", # Use a fast model for this refinement task
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=20, # Expect short output
+        temperature=0.1,
+        stop=["\n"] # Stop generation early if needed
+    )
+
+def parse_keyword_response(content, used_keywords_set):
+    """The suggested keyword if it is new and specific, else an empty string."""
+    keywords = content.strip().lower()
+
+    # Basic cleaning: remove potential quotes or extra formatting
+    keywords = keywords.replace('"', '').replace("'", "").strip()
+
+    # Validate the keyword is not empty and not obviously generic
+    generic_fallback_words = {"central", "main", "small", "large", "intricate", "detailed"}
+    if keywords and keywords not in used_keywords_set and keywords not in generic_fallback_words:
+        print(f"    AI suggested fallback keyword: '{keywords}'")
+        return keywords
+    else:
+        print(f"    AI fallback did not suggest a suitable new keyword ('{keywords}').")
+        return "" # Return empty if suggestion is bad or empty
 
-    try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant", # Use a fast model for this refinement task
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=20, # Expect short output
-            temperature=0.1,
-            stop=["\n"] # Stop generation early if needed
-        )
-        keywords = response.choices[0].message.content.strip().lower()
-
-        # Basic cleaning: remove potential quotes or extra formatting
-        keywords = keywords.replace('"', '').replace("'", "").strip()
-
-        # Validate the keyword is not empty and not obviously generic
-        generic_fallback_words = {"central", "main", "small", "large", "intricate", "detailed"}
-        if keywords and keywords not in used_keywords_set and keywords not in generic_fallback_words:
-            print(f"    AI suggested fallback keyword: '{keywords}'")
-            return keywords
-        else:
-            print(f"    AI fallback did not suggest a suitable new keyword ('{keywords}').")
-            return "" # Return empty if suggestion is bad or empty
+def get_additional_keywords_with_llm(caption, used_keywords_set):
+    """
+    Fallback function: Use LLM to suggest 1 additional keyword from caption,
+    focusing on specific features *if* inscription/category methods failed.
+    """
+    if not groq_client:
+        print("Error: Groq client not initialized for additional keyword extraction.")
+        return ""
 
+    print("    Attempting AI suggestion for Pass 3 keywords (Fallback)...")
+    try:
+        response = groq_client.chat.completions.create(**keyword_request(caption, used_keywords_set))
+        return parse_keyword_response(response.choices[0].message.content, used_keywords_set)
     except Exception as e:
         print(f"    Error during AI fallback keyword suggestion: {e}")
         return "" # Return empty on error
 
 
-def extract_inscription_from_caption(caption):
+def extract_inscription_from_caption(caption, log=print):
     """
     Attempt to extract inscription details from the caption.
     Prioritizes quoted text after 'inscribed', 'engraved', 'word(s)', 'text'.
@@ -300,7 +329,7 @@ def extract_inscription_from_caption(caption):
     Returns a lowercase keyword/phrase (max 3 words) or empty string.
     """
     caption_lower = caption.lower()
-    print("  DEBUG: Starting inscription extraction...") # Added debug start
+    log("  DEBUG: Starting inscription extraction...") # Added debug start
 
     # Priority 1: Quoted text after specific verbs/nouns, allowing intervening words
     inscription_match = re.search(r'(?:inscribed|engraved|word|words|text)[\s\w]*?["\']([^"\']+)["\']', caption_lower)
@@ -308,20 +337,20 @@ def extract_inscription_from_caption(caption):
         words = inscription_match.group(1).strip().split()
         keyword = " ".join(words[:3])
         if keyword in ["the", "a", "is", "of", "us", "me"]:
-             print(f"  DEBUG: Inscription regex matched stop-word only: '{inscription_match.group(1)}', ignoring.") # Debug print
+             log(f"  DEBUG: Inscription regex matched stop-word only: '{inscription_match.group(1)}', ignoring.") # Debug print
              return ""
-        print(f"  DEBUG: Inscription regex matched: '{inscription_match.group(1)}', using: '{keyword}'") # Debug print
+        log(f"  DEBUG: Inscription regex matched: '{inscription_match.group(1)}', using: '{keyword}'") # Debug print
         return keyword
 
     # Priority 2: "initial X" where X is a single letter
     initial_match = re.search(r'initial\s+([a-z])', caption_lower)
     if initial_match:
-        print(f"  DEBUG: Initial regex matched: 'initial {initial_match.group(1)}'") # Debug print
+        log(f"  DEBUG: Initial regex matched: 'initial {initial_match.group(1)}'") # Debug print
         return "initial " + initial_match.group(1)
 
     # Priority 3: Specific known phrases like "st. christopher"
     if "saint christopher" in caption_lower:
-        print("  DEBUG: Found 'saint christopher'") # Debug print
+        log("  DEBUG: Found 'saint christopher'") # Debug print
         return "st. christopher"
 
     # Priority 4: Fallback - Unquoted text immediately after verbs (less reliable)
@@ -329,12 +358,12 @@ def extract_inscription_from_caption(caption):
     if fallback_match:
         potential_keyword = fallback_match.group(1).strip()
         if potential_keyword not in ["text", "words", "detail", "design", "pattern", "with", "on", "style"]:
-            print(f"  DEBUG: Fallback regex matched: '{potential_keyword}'") # Debug print
+            log(f"  DEBUG: Fallback regex matched: '{potential_keyword}'") # Debug print
             return potential_keyword
         else:
-            print(f"  DEBUG: Fallback regex matched generic term '{potential_keyword}', ignoring.") # Debug print
+            log(f"  DEBUG: Fallback regex matched generic term '{potential_keyword}', ignoring.") # Debug print
 
-    print("  DEBUG: No specific inscription pattern matched.") # Debug print
+    log("  DEBUG: No specific inscription pattern matched.") # Debug print
     return ""
 
 def extract_additional_color(caption):
@@ -354,18 +383,349 @@ def extract_additional_color(caption):
             return color
     return ""
 
-def search_similar_products(json_prompt, initial_caption, desired_limit=10):
+def extract_attributes_locally(query, log=print):
     """
-    Searches the Brilliance Hub API based on extracted JSON criteria using a multi-pass approach.
-    If the jewelry type is 'Pendants', searches both 'Pendants' and 'Necklaces'.
-    Attempts to return a specific number of results (desired_limit) by backfilling from less specific passes.
+    Rule-based version of create_json_from_caption for short text queries
+    (e.g. "rose gold initial p pendant"). Returns the same JSON shape, or None when the query
+    names neither a jewelry type nor a design, in which case the LLM should interpret it.
+    """
+    query_lower = query.lower()
+    jewelry_type = None
+    for type_name in ["Charms", "Rings", "Earrings", "Pendants", "Bracelets", "Necklaces"]:
+        if any(re.search(r'\b' + word + r's?\b', query_lower) for word in jewelry_types[type_name]):
+            jewelry_type = type_name
+            break
+
+    material = next((name for pattern, name in MATERIAL_KEYWORDS if re.search(r'\b(?:' + pattern + r')\b', query_lower)), "Sterling Silver")
+
+    design = extract_inscription_from_caption(query, log)
+    if not design:
+        design = next((DESIGN_KEYWORDS[word] for word in sorted(DESIGN_KEYWORDS, key=len, reverse=True)
+                       if re.search(r'\b' + word + r'\b', query_lower)), "")
+    if not jewelry_type and not design:
+        return None
+
+    categories = [design] if design else []
+    if design.startswith("initial"):
+        categories.append("personalized")
+    categories += [word for word in sorted(DETAIL_KEYWORDS) if re.search(r'\b' + word + r's?\b', query_lower) and word not in categories]
+    categories += [key for key in STYLES_MAP if re.search(r'\b' + re.escape(key) + r'\b', query_lower) and key not in categories]
+    return {
+        "jewelry_type": jewelry_type or "Pendants",
+        "material": material,
+        "design": design,
+        "categories": categories[:3],
+    }
+
+def create_json_from_text_query(query):
+    """Attributes for a text query: local rules first, the LLM only if they find nothing. Returns (json, source)."""
+    json_prompt = extract_attributes_locally(query)
+    if json_prompt:
+        print(f"Extracted attributes locally from text query: {json_prompt}")
+        return json_prompt, "local"
+    print("Local attribute extraction found no type or design; asking the LLM.")
+    return create_json_from_caption(query), "llm"
+
+def _fetch_catalog_page_upstream(search_body):
+    """GET one page of catalog results, holding one of the per-host request slots. Returns the 'data' list."""
+    with _catalog_request_slots:
+        response = get_catalog_client().get(search_body)
+    print(f"  API Response Status (Pass 1, Type={search_body.get('type')}, Offset={search_body.get('offset')}): {response.status_code}")
+    response.raise_for_status()
+    data = response.json().get("data", [])
+    query_term_stats.observe_page(data, int(response.headers.get("Content-Length") or len(response.content)))
+    return data
+
+# Shared by every search in this process; pages it returns must not be mutated
+catalog_cache = CatalogCache(_fetch_catalog_page_upstream)
+# Local mirror of catalog prices and facets (built with `python catalog_index.py`); None if not built.
+# The snapshot also seeds the title term statistics, so the planner is warm from the first search.
+catalog_index, snapshot_term_stats = load_catalog_index()
+# Title term statistics learned from upstream pages, used to plan which term is sent server-side
+query_term_stats = snapshot_term_stats or TermStatistics()
+query_planner = QueryPlanner(query_term_stats)
+# Ranked results of recent searches, paged by /find_similar_jewelry/more
+result_cursors = ResultCursorCache()
+
+def fetch_catalog_page(search_body):
+    """One page of catalog results for search_body, served from catalog_cache when possible."""
+    return catalog_cache.get(search_body)
+
+def _pass1_search_body(search_type, title_term, search_style, offset, limit):
+    return {
+        "offset": offset,
+        "limit": limit,
+        "title": title_term,
+        "style": search_style,
+        "type": search_type
+    }
+
+def iter_pass1_pages(search_type, title_term, search_style, limit_per_call, max_results, state, first_page=None, first_page_limit=None):
+    """
+    Lazily yields Pass 1 pages for one jewelry type in offset order. The first page is fetched
+    alone (most queries fit in one page; `first_page` may be an already submitted future for it,
+    `first_page_limit` a smaller size for it);
+    after each wave of full pages the next wave doubles, up to PASS1_MAX_CONCURRENCY concurrent
+    requests. Nothing past the current wave is requested until the consumer asks for it.
+    Stops at the first short/empty page; on an error sets state["api_error"] and stops.
+    """
+    print(f"Fetching results for type '{search_type}'...")
+    offset = 0
+    wave_size = 1
+    fetched = 0
+    while offset < max_results:
+        search_bodies = []
+        while offset < max_results and len(search_bodies) < wave_size:
+            page_limit = first_page_limit if offset == 0 and first_page_limit else limit_per_call
+            search_bodies.append(_pass1_search_body(search_type, title_term, search_style, offset, min(page_limit, max_results - offset)))
+            offset += page_limit
+        futures = []
+        for search_body in search_bodies:
+            if first_page is not None and search_body["offset"] == 0:
+                futures.append(first_page)
+            else:
+                print(f"  API Request (Pass 1, Type={search_type}): {search_body}")
+                futures.append(_catalog_fetch_pool.submit(fetch_catalog_page, search_body))
+        for search_body, future in zip(search_bodies, futures):
+            try:
+                current_batch = future.result()
+            except requests.exceptions.Timeout:
+                print(f"  Error: Pass 1 API search timed out for type '{search_type}'. Proceeding with {fetched} fetched results.")
+                state["api_error"] = True
+                return
+            except requests.RequestException as e:
+                print(f"  Error: Pass 1 API search failed for type '{search_type}': {e}")
+                state["api_error"] = True
+                return
+            except Exception as e:
+                print(f"  Error: Unexpected error during Pass 1 for type '{search_type}': {e}")
+                state["api_error"] = True
+                return
+            state["pages_fetched"] = state.get("pages_fetched", 0) + 1
+            fetched += len(current_batch)
+            if current_batch:
+                yield current_batch
+            if len(current_batch) < search_body["limit"]:
+                return
+        wave_size = min(wave_size * 2, PASS1_MAX_CONCURRENCY)
+
+def iter_pass1_items(search_types, title_term, search_style, limit_per_call, max_results, state, first_page_limit=None):
+    """
+    Lazily yields unique Pass 1 items across search_types in deterministic (type, offset) order,
+    at most max_results of them. The first page of every type is requested up front so the
+    types are fetched in parallel; later pages are only requested as the stream is consumed.
+    """
+    first_pages = {}
+    for search_type in search_types:
+        search_body = _pass1_search_body(search_type, title_term, search_style, 0, min(first_page_limit or limit_per_call, max_results))
+        print(f"  API Request (Pass 1, Type={search_type}): {search_body}")
+        first_pages[search_type] = _catalog_fetch_pool.submit(fetch_catalog_page, search_body)
+    added_ids = set()
+    for search_type in search_types:
+        for current_batch in iter_pass1_pages(search_type, title_term, search_style, limit_per_call, max_results, state,
+                                              first_pages[search_type], first_page_limit):
+            for item in current_batch:
+                item_id = item.get("id")
+                if item_id and item_id not in added_ids:
+                    added_ids.add(item_id)
+                    yield item
+                    if len(added_ids) >= max_results:
+                        return
+
+def select_pass2_filter_term(initial_caption, design, categories, generic_designs, log=print):
+    """Pass 2 term: an additional color from the caption, else the primary design or a specific category. Returns (term, source)."""
+    # First, try to extract an additional color from the caption
+    additional_color = extract_additional_color(initial_caption)
+    if additional_color:
+        log(f"\nPass 2: Using additional color '{additional_color}' for filtering.")
+        return additional_color, "Additional Color"
+    if not design:
+        log("\nPass 2: No design keyword or additional color provided; skipping Pass 2 filtering.")
+        return "", ""
+    # If design is generic, try to pick a specific category from the categories list.
+    if design in generic_designs:
+        log(f"\nPass 2: Primary design '{design}' is generic. Looking for specific category...")
+        specific_category = next((cat for cat in categories if cat not in generic_designs and cat != design), None)
+        if specific_category:
+            log(f"Pass 2: Using '{specific_category}' (from Categories) for filtering.")
+            return specific_category, "Specific Category"
+        log(f"Pass 2: No specific category found. Falling back to generic design '{design}' for filtering.")
+        return design, "Generic Design (Fallback)"
+    log(f"\nPass 2: Using primary design '{design}' for filtering.")
+    return design, "Primary Design"
+
+def select_pass3_filter_term(initial_caption, categories, generic_designs, used_filter_term_pass2, log=print):
+    """Local Pass 3 term, avoiding Pass 2's term: non-standard color, inscription, then secondary category. Returns (term, source)."""
+    # 1. Check for a non-standard color in the caption
+    color_keyword = extract_additional_color(initial_caption)
+    if color_keyword and color_keyword != used_filter_term_pass2:
+        log(f"  Using Non-standard Color keyword for filtering: '{color_keyword}'")
+        return color_keyword, "Non-standard Color"
+
+    # 2. If no valid color found, check for inscription
+    inscription_keyword = extract_inscription_from_caption(initial_caption, log)
+    if inscription_keyword and inscription_keyword != used_filter_term_pass2:
+        log(f"  Using Inscription keyword for filtering: '{inscription_keyword}'")
+        return inscription_keyword, "Inscription"
+
+    # 3. If still nothing, check Secondary Category (skipping term used in Pass 2)
+    log("  No color or inscription found/valid. Checking secondary category...")
+    secondary_categories = [cat for cat in categories if cat != used_filter_term_pass2 and cat not in generic_designs]
+    if secondary_categories:
+        log(f"  Using Secondary Category keyword for filtering: '{secondary_categories[0]}'")
+        return secondary_categories[0], "Secondary Category"
+    log("  No suitable secondary category found.")
+    return "", ""
+
+def pass3_llm_exclusions(design, material, material_search_term, jew_type, categories, used_filter_term_pass2):
+    """Words the Pass 3 LLM fallback must not suggest: the search's own terms and common filler words."""
+    used_keywords = set([c.lower() for c in categories if c] +
+                        [d.lower() for d in design.split() if d] +
+                        [material.lower(), jew_type.lower(), material_search_term.lower()] +
+                        [used_filter_term_pass2])
+    common_words_for_ai = {
+        "a", "an", "the", "this", "that", "these", "those", "and", "or", "but", "of", "with", "for", "on", "at", "its",
+        "to", "from", "by", "as", "it", "is", "are", "was", "were", "be", "been", "has", "have", "had", "no",
+        "in", "out", "up", "down", "image", "photo", "picture", "view", "background", "surface", "display",
+        "features", "shaped", "style", "design", "pattern", "piece", "item", "accessory", "jewelry", "wearable",
+        "made", "set", "against", "shown", "engraved", "center"
+    }
+    return used_keywords.union(common_words_for_ai)
+
+def select_pass3_llm_term(initial_caption, design, material, material_search_term, jew_type, categories, used_filter_term_pass2):
+    """Pass 3 fallback when no local term was found: ask the LLM for a keyword. Returns (term, source)."""
+    print("  No specific filter term found. Trying LLM fallback...")
+    full_exclusion_set = pass3_llm_exclusions(design, material, material_search_term, jew_type, categories, used_filter_term_pass2)
+    llm_keyword = get_additional_keywords_with_llm(initial_caption, full_exclusion_set)
+    return accept_pass3_llm_term(llm_keyword, used_filter_term_pass2)
+
+def accept_pass3_llm_term(llm_keyword, used_filter_term_pass2):
+    if llm_keyword and llm_keyword != used_filter_term_pass2:
+        print(f"  Using AI Fallback keyword for filtering: '{llm_keyword}'")
+        return llm_keyword, "AI Fallback"
+    return "", ""
+
+class Pass1Step:
+    """
+    Selection state of one Pass 1 query, fed one catalog item at a time. Items whose title
+    lacks one of required_terms (applied client-side when the planner pushed another term to
+    the API), or rejected by accept_item (price constraints), are not part of Pass 1.
+    Only the candidate_limit (default desired_limit) smallest-key items of each selection tier
+    are kept (see search_similar_products), plus the size of every pass and the Pass 1
+    candidates for facet counts. Shared by the threaded and the asyncio pipelines, which only
+    differ in how pages are fetched.
+    """
+
+    def __init__(self, required_terms, used_filter_term_pass2, desired_limit, accept_item=None, item_key=None,
+                 candidate_limit=None, facets=None):
+        self.required_terms = required_terms
+        self.used_filter_term_pass2 = used_filter_term_pass2
+        self.desired_limit = desired_limit
+        self.accept_item = accept_item
+        self.item_key = item_key
+        self.tiers = TopKTiers(["pass3_from_pass2", "pass3_from_pass1", "pass2_not_pass3", "pass1_not_pass2", "pass1_not_pass3"],
+                               max(candidate_limit or 0, desired_limit))
+        self.outcome = {"tiers": self.tiers, "pass1_count": 0, "pass2_count": 0, "filled": False,
+                        "facets": facets if facets is not None else FacetCounter(None)}
+
+    def accept(self, api_item):
+        """The CatalogItem for api_item if it belongs to Pass 1, else None."""
+        item = CatalogItem.from_api(api_item)
+        title = item.title_lower
+        if self.required_terms and (title is None or not all(term in title for term in self.required_terms)):
+            return None
+        if self.accept_item is not None and not self.accept_item(item):
+            return None
+        return item
+
+    def add(self, item, third_pass_filter_term, pass3_active):
+        """
+        Offer an accepted item to its tiers. Returns True when fetching can stop: with the
+        default key (stream position) once the highest-priority pass has desired_limit items;
+        any other key (a price sort) needs every candidate, so it never stops early.
+        """
+        outcome, tiers = self.outcome, self.tiers
+        title = item.title_lower
+        position = self.item_key(item, outcome["pass1_count"]) if self.item_key is not None else (outcome["pass1_count"],)
+        outcome["pass1_count"] += 1
+        outcome["facets"].add(item)
+        in_pass2 = not self.used_filter_term_pass2 or (title is not None and self.used_filter_term_pass2 in title)
+        in_pass3 = not pass3_active or (title is not None and third_pass_filter_term in title)
+        if in_pass2:
+            outcome["pass2_count"] += 1
+        if in_pass3:
+            tiers.offer("pass3_from_pass1", position, item)
+            if in_pass2:
+                tiers.offer("pass3_from_pass2", position, item)
+        else:
+            tiers.offer("pass1_not_pass3", position, item)
+            if in_pass2:
+                tiers.offer("pass2_not_pass3", position, item)
+        if not in_pass2:
+            tiers.offer("pass1_not_pass2", position, item)
+
+        # Once Pass 2 has a match, Pass 3 is fixed to filter Pass 2 and can only grow; when it
+        # holds desired_limit items the final selection can no longer change.
+        if self.item_key is None and outcome["pass2_count"] and tiers.counts["pass3_from_pass2"] >= self.desired_limit:
+            print(f"Highest-priority pass filled {self.desired_limit} results after {outcome['pass1_count']} items; stopping fetch early.")
+            return True
+        return False
+
+    def finish(self, stream_state):
+        outcome = self.outcome
+        outcome["filled"] = bool(outcome["pass2_count"]) and self.tiers.counts["pass3_from_pass2"] >= self.desired_limit
+        outcome["api_error"] = stream_state["api_error"]
+        outcome["pages_fetched"] = stream_state.get("pages_fetched", 0)
+        return outcome
+
+def stream_pass1_step(search_types, title_term, required_terms, search_style, first_page_limit, used_filter_term_pass2,
+                      resolve_pass3_term, desired_limit, limit_per_call, max_results, accept_item=None, item_key=None,
+                      candidate_limit=None, on_candidates=None, facets=None):
+    """
+    Streams one Pass 1 query and evaluates Pass 2 / Pass 3 as items arrive (see Pass1Step).
+    facets (see step_facets) counts the facets of the query.
+    resolve_pass3_term() is called on the first Pass 1 item and returns (term, active).
+    on_candidates, if given, is called once with the payloads of the first desired_limit Pass 1
+    items (fewer if the step finds fewer), before Pass 2 / Pass 3 have ranked anything.
+    """
+    step = Pass1Step(required_terms, used_filter_term_pass2, desired_limit, accept_item, item_key, candidate_limit, facets)
+    third_pass_filter_term, pass3_active = None, False
+    stream_state = {"api_error": False}
+    candidates = [] if on_candidates is not None else None
+    pass1_items = iter_pass1_items(search_types, title_term, search_style, limit_per_call, max_results, stream_state, first_page_limit)
+    for api_item in pass1_items:
+        item = step.accept(api_item)
+        if item is None:
+            continue
+        if third_pass_filter_term is None:
+            third_pass_filter_term, pass3_active = resolve_pass3_term()
+        if candidates is not None:
+            candidates.append(item.to_dict())
+            if len(candidates) == desired_limit:
+                on_candidates(candidates)
+                candidates = None
+        if step.add(item, third_pass_filter_term, pass3_active):
+            break
+    pass1_items.close()
+    if candidates:
+        on_candidates(candidates)
+    return step.finish(stream_state)
+
+def prepare_search(json_prompt, initial_caption, desired_limit=10, min_price=None, max_price=None, sort=None, speculative=False,
+                   quiet=False):
+    """
+    Everything decided before Pass 1 is fetched: criteria, filter terms, price rules and the
+    query plan. Returns (search, None), or (None, error result) if the search cannot run.
+    speculative=True plans a search that may never run (see pipeline.py), so it is not counted;
+    quiet=True leaves out the search log.
     """
+    log = (lambda *args: None) if quiet else print
     if not json_prompt or not isinstance(json_prompt, dict):
-        print("Invalid JSON prompt provided to search function.")
-        return {"error": "Invalid search criteria generated.", "data": [], "total_found": 0, "source_pass": "N/A"}
+        log("Invalid JSON prompt provided to search function.")
+        return None, {"error": "Invalid search criteria generated.", "data": [], "total_found": 0, "source_pass": "N/A"}
     if not HEADERS:
-        print("Error: API headers not configured.")
-        return {"error": "API configuration error.", "data": [], "total_found": 0, "source_pass": "N/A"}
+        log("Error: API headers not configured.")
+        return None, {"error": "API configuration error.", "data": [], "total_found": 0, "source_pass": "N/A"}
 
     # Extract criteria from JSON prompt
     jew_type = json_prompt.get("jewelry_type", "Pendants").lower()
@@ -376,201 +736,202 @@ def search_similar_products(json_prompt, initial_caption, desired_limit=10):
     categories = [cat.lower().strip() for cat in json_prompt.get("categories", []) if cat]
     generic_designs = {"engraved", "text", "personalized", "abstract", "metal", "geometric", "pattern", "solitaire", "circular", "round", "gemstone"}
 
-    print(f"\n--- Starting Search ---")
-    print(f"Desired Results: {desired_limit}")
-    print(f"Criteria: Type='{jew_type}', Design='{design}', Material='{material}', Categories={categories}")
-    print(f"Initial Caption: '{initial_caption}'")
-
-    limit_per_call = 500
-    max_total_results_fetch = 5000
-    first_pass_results = []
-    second_pass_results = []
-    third_pass_results = []
-    api_error_pass1 = False
+    log(f"\n--- Starting Search ---")
+    log(f"Desired Results: {desired_limit}")
+    log(f"Criteria: Type='{jew_type}', Design='{design}', Material='{material}', Categories={categories}")
+    log(f"Initial Caption: '{initial_caption}'")
+    if min_price is not None or max_price is not None or sort:
+        log(f"Price constraints: min={min_price}, max={max_price}, sort={sort or 'relevance'}")
 
     # --- Determine Search Types ---
     if jew_type == "pendants":
         search_types = ["Pendants", "Necklaces"]
-        print(f"Searching for both 'Pendants' and 'Necklaces' since jewelry type is 'Pendants'.")
+        log(f"Searching for both 'Pendants' and 'Necklaces' since jewelry type is 'Pendants'.")
     else:
         search_types = [jew_type.capitalize()]
-        print(f"Searching for '{search_types[0]}'.")
+        log(f"Searching for '{search_types[0]}'.")
 
-    # --- Pass 1: Broad API Search Across Search Types ---
+    # --- Pass 1: Broad API Search Across Search Types, streamed ---
     search_style = [cat.capitalize() for cat in categories if cat]
     first_pass_title_term = material_search_term.capitalize()
-    added_ids = set()
-
-    for search_type in search_types:
-        print(f"Fetching results for type '{search_type}'...")
-        offset = 0
-        while len(first_pass_results) < max_total_results_fetch:
-            batch_limit = min(limit_per_call, max_total_results_fetch - len(first_pass_results))
-            if batch_limit <= 0:
-                break
-            search_body = {
-                "offset": offset,
-                "limit": batch_limit,
-                "title": first_pass_title_term,
-                "style": search_style,
-                "type": search_type
-            }
-            print(f"  API Request (Pass 1, Type={search_type}): {search_body}")
-            try:
-                response = requests.get(API_URL, headers=HEADERS, params=search_body, timeout=20)
-                print(f"  API Response Status (Pass 1, Type={search_type}): {response.status_code}")
-                response.raise_for_status()
-                results = response.json()
-                current_batch = results.get("data", [])
-                if not current_batch:
-                    break
-                for item in current_batch:
-                    item_id = item.get("id")
-                    if item_id and item_id not in added_ids:
-                        first_pass_results.append(item)
-                        added_ids.add(item_id)
-                        if len(first_pass_results) >= max_total_results_fetch:
-                            break
-                if len(current_batch) < batch_limit or len(first_pass_results) >= max_total_results_fetch:
-                    break
-                offset += batch_limit
-                time.sleep(0.1)
-            except requests.exceptions.Timeout:
-                print(f"  Error: Pass 1 API search timed out for type '{search_type}'. Proceeding with {len(first_pass_results)} fetched results.")
-                api_error_pass1 = True
-                break
-            except requests.RequestException as e:
-                print(f"  Error: Pass 1 API search failed for type '{search_type}': {e}")
-                api_error_pass1 = True
-                break
-            except Exception as e:
-                print(f"  Error: Unexpected error during Pass 1 for type '{search_type}': {e}")
-                api_error_pass1 = True
-                break
-    print(f"Total unique results collected from Pass 1: {len(first_pass_results)}")
 
-    # --- Pass 2: Filter Pass 1 results by an Additional Color (if available) or by Primary Design/Specific Category ---
-    pass2_input_results = first_pass_results
-    used_filter_term_pass2 = ""
-    filter_source_pass2 = ""
-
-    # First, try to extract an additional color from the caption
-    additional_color = extract_additional_color(initial_caption)
-    if additional_color:
-        used_filter_term_pass2 = additional_color
-        filter_source_pass2 = "Additional Color"
-        print(f"\nPass 2: Using additional color '{used_filter_term_pass2}' for filtering.")
-    elif design:
-        # If design is generic, try to pick a specific category from the categories list.
-        if design_for_filter in generic_designs:
-            print(f"\nPass 2: Primary design '{design_for_filter}' is generic. Looking for specific category...")
-            specific_category = next((cat for cat in categories if cat not in generic_designs and cat != design_for_filter), None)
-            if specific_category:
-                used_filter_term_pass2 = specific_category
-                filter_source_pass2 = "Specific Category"
-                print(f"Pass 2: Using '{used_filter_term_pass2}' (from Categories) for filtering.")
-            else:
-                used_filter_term_pass2 = design_for_filter
-                filter_source_pass2 = "Generic Design (Fallback)"
-                print(f"Pass 2: No specific category found. Falling back to generic design '{used_filter_term_pass2}' for filtering.")
-        else:
-            used_filter_term_pass2 = design_for_filter
-            filter_source_pass2 = "Primary Design"
-            print(f"\nPass 2: Using primary design '{used_filter_term_pass2}' for filtering.")
+    # Filter terms are fixed before fetching so every pass can be evaluated as items arrive
+    used_filter_term_pass2, filter_source_pass2 = select_pass2_filter_term(initial_caption, design_for_filter, categories, generic_designs, log)
+    if initial_caption:
+        log("\nPass 3: Selecting a refinement term from the caption...")
+        local_term_pass3, local_source_pass3 = select_pass3_filter_term(initial_caption, categories, generic_designs, used_filter_term_pass2, log)
     else:
-        print("\nPass 2: No design keyword or additional color provided; skipping Pass 2 filtering.")
-        used_filter_term_pass2 = ""
-
-    if used_filter_term_pass2:
-        print(f"Pass 2: Filtering {len(pass2_input_results)} items based on {filter_source_pass2} '{used_filter_term_pass2}'...")
-        second_pass_results = [
-            item for item in pass2_input_results
-            if item.get("jew_title") and used_filter_term_pass2 in item["jew_title"].lower()
-        ]
-        print(f"  Results after Pass 2 filter: {len(second_pass_results)}")
-    else:
-        second_pass_results = pass2_input_results
+        log("\nSkipping Pass 3 refinement (no caption).")
+        local_term_pass3, local_source_pass3 = "", ""
+
+    # --- Query plan: which term goes to the API as `title` ---
+    # Pushed-down steps keep the material as a client-side title filter; the final step is
+    # always the plain material query, so relaxing all the way reproduces the unplanned search.
+    price_sort = sort in PRICE_SORTS
+    accept_item, item_key = make_price_rules(catalog_index, min_price, max_price, sort)
+    if min_price is None and max_price is None:
+        accept_item = None
+    if not price_sort:
+        item_key = None
+    plan = query_planner.plan(search_types, first_pass_title_term, [used_filter_term_pass2, local_term_pass3], desired_limit,
+                              full_scan=price_sort, record_stats=not speculative)
+    return {
+        "initial_caption": initial_caption, "desired_limit": desired_limit, "sort": sort,
+        "min_price": min_price, "max_price": max_price,
+        "jew_type": jew_type, "design": design, "material": material, "material_search_term": material_search_term,
+        "categories": categories, "search_types": search_types, "search_style": search_style,
+        "used_filter_term_pass2": used_filter_term_pass2, "filter_source_pass2": filter_source_pass2,
+        "local_term_pass3": local_term_pass3, "local_source_pass3": local_source_pass3, "pass3": {},
+        "price_sort": price_sort, "accept_item": accept_item, "item_key": item_key, "plan": plan,
+        "limit_per_call": 500, "max_total_results_fetch": 5000,
+    }, None
+
+def pass3_needs_llm(search):
+    """True when the Pass 3 term is still open and only the LLM fallback can provide it."""
+    return not search["pass3"] and bool(search["initial_caption"]) and not search["local_term_pass3"]
+
+def record_pass3_term(search, term, source):
+    """Fix the Pass 3 term of a search (at most once). Returns (term, active)."""
+    pass3 = search["pass3"]
+    if not pass3:
+        pass3.update(term=term, source=source, active=bool(term) and term != search["used_filter_term_pass2"])
+        if term and not pass3["active"]:
+            print(f"  Pass 3 filter term '{term}' is identical to Pass 2 filter term; skipping Pass 3 filtering.")
+    return pass3["term"], pass3["active"]
+
+def describe_plan_step(search, step_index):
+    """(step, is_material_step, title_term, required_terms) of a plan step, logging it."""
+    plan = search["plan"]
+    step = plan[step_index]
+    is_material_step = step_index == len(plan) - 1
+    title_term = step["title"].capitalize()
+    print(f"\nPass 1 plan step {step_index + 1}/{len(plan)}: title='{title_term}'" +
+          ("" if is_material_step else f", client-side terms={[search['material_search_term']]}"))
+    return step, is_material_step, title_term, [] if is_material_step else [search["material_search_term"]]
+
+def step_facets(search, title_term, required_terms):
+    """FacetCounter for one plan step's Pass 1 query: its types, styles, API title term, client-side terms and price range."""
+    return FacetCounter(catalog_index, search["search_types"], [title_term] + required_terms,
+                        search["min_price"], search["max_price"], search["search_style"])
+
+def first_page_bodies(search):
+    """Search bodies of the first Pass 1 pages the search will request (first plan step, one per type)."""
+    step = search["plan"][0]
+    page_limit = min(step["first_page_limit"] or search["limit_per_call"], search["max_total_results_fetch"])
+    return [_pass1_search_body(search_type, step["title"].capitalize(), search["search_style"], 0, page_limit)
+            for search_type in search["search_types"]]
+
+def next_plan_step(search, step_index, title_term, outcome):
+    """Index of the step to relax to after a step came up short."""
+    # A tighter query that comes up short (or fails) is relaxed; errors go straight to the material query
+    print(f"Plan step with title '{title_term}' found too few results; relaxing the query.")
+    query_planner.record_relaxation()
+    return len(search["plan"]) - 1 if outcome["api_error"] else step_index + 1
+
+def search_similar_products(json_prompt, initial_caption, desired_limit=10, min_price=None, max_price=None, sort=None):
+    """
+    Searches the Brilliance Hub API based on extracted JSON criteria using a multi-pass approach.
+    If the jewelry type is 'Pendants', searches both 'Pendants' and 'Necklaces'.
+    Attempts to return a specific number of results (desired_limit) by backfilling from less specific passes.
+    Pass 1 pages are streamed in and every pass is evaluated incrementally; fetching stops as soon
+    as the highest-priority pass has desired_limit items, so "total_found_by_primary_source"
+    counts the items fetched up to that point. query_planner may first send a more selective
+    filter term as the API `title`, relaxing back to the material query when it finds too few.
+    min_price / max_price restrict every pass to that price range; sort="price_asc" or
+    "price_desc" picks the cheapest (dearest) items of each pass and orders the results by price;
+    a price sort reads every Pass 1 candidate (up to max_total_results_fetch, 5000) instead of
+    stopping early, so it costs up to 10 API pages per searched type.
+    "facets" counts type / material / style values over every Pass 1 candidate of the final plan
+    step, found in the local catalog index when it is built (items it does not know are counted
+    as they are read); without the index, over the candidates read before the early stop.
+    When more ranked candidates were read than returned, the first RESULT_CURSOR_MAX_CANDIDATES
+    of them are kept in result_cursors and "next_cursor" pages through them (see
+    /find_similar_jewelry/more); the early stop is unchanged, so these are only the items
+    already fetched.
+    """
+    search, error_result = prepare_search(json_prompt, initial_caption, desired_limit, min_price, max_price, sort)
+    if error_result:
+        return error_result
+    return execute_search(search)
 
+def select_pass3_llm_term_for(search):
+    """select_pass3_llm_term with the criteria of a prepared search. Returns (term, source)."""
+    return select_pass3_llm_term(search["initial_caption"], search["design"], search["material"], search["material_search_term"],
+                                 search["jew_type"], search["categories"], search["used_filter_term_pass2"])
 
-    # --- Pass 3: Refined Filter Using a New Filter Term (avoiding Pass 2's term) ---
-    # If Pass 2 returned no results, use Pass 1 results.
-    if not second_pass_results:
+def execute_search(search, pass3_llm_term=None, on_candidates=None):
+    """
+    Runs a prepared search (see prepare_search) and returns its response. pass3_llm_term, if
+    given, is called instead of select_pass3_llm_term when the LLM fallback is needed and
+    returns (term, source); pipeline.py uses it to start that call before Pass 1.
+    on_candidates(payloads) is called at most once per search with early Pass 1 items (see
+    stream_pass1_step), e.g. to show them while the search is still running.
+    """
+    desired_limit = search["desired_limit"]
+    candidates_sent = []
+
+    def send_candidates(payloads):
+        if not candidates_sent:
+            candidates_sent.append(True)
+            on_candidates(payloads)
+
+    def resolve_pass3_term():
+        # The LLM fallback runs at most once per search, and only once Pass 1 has an item
+        term, source = search["local_term_pass3"], search["local_source_pass3"]
+        if pass3_needs_llm(search):
+            term, source = pass3_llm_term() if pass3_llm_term is not None else select_pass3_llm_term_for(search)
+        return record_pass3_term(search, term, source)
+
+    step_index = 0
+    while True:
+        step, is_material_step, title_term, required_terms = describe_plan_step(search, step_index)
+        outcome = stream_pass1_step(search["search_types"], title_term, required_terms, search["search_style"],
+                                    step["first_page_limit"], search["used_filter_term_pass2"], resolve_pass3_term,
+                                    desired_limit, search["limit_per_call"], search["max_total_results_fetch"],
+                                    search["accept_item"], search["item_key"], RESULT_CURSOR_MAX_CANDIDATES,
+                                    send_candidates if on_candidates is not None else None,
+                                    step_facets(search, title_term, required_terms))
+        if is_material_step or outcome["filled"]:
+            break
+        step_index = next_plan_step(search, step_index, title_term, outcome)
+    return combine_search_results(search, outcome)
+
+def combine_search_results(search, outcome):
+    """Final response of a search from the outcome of its last Pass 1 step."""
+    desired_limit = search["desired_limit"]
+    used_filter_term_pass2 = search["used_filter_term_pass2"]
+    filter_source_pass2 = search["filter_source_pass2"]
+    item_key = search["item_key"]
+    price_sort = search["price_sort"]
+    sort = search["sort"]
+    third_pass_filter_term = search["pass3"].get("term", "")
+    filter_source_pass3 = search["pass3"].get("source", "")
+    pass3_active = search["pass3"].get("active", False)
+    api_error_pass1 = outcome["api_error"]
+    first_pass_count = outcome["pass1_count"]
+    print(f"Total unique results collected from Pass 1: {first_pass_count} ({outcome['pages_fetched']} pages)")
+
+    # --- Resolve Pass 2 / Pass 3 results ---
+    # Each pass contributes, in order, its items not already taken from a higher pass, and at
+    # most desired_limit of them (RESULT_CURSOR_MAX_CANDIDATES for the later pages); so only
+    # those bounded tiers were kept while streaming.
+    tiers = outcome["tiers"]
+    second_pass_count = outcome["pass2_count"] if used_filter_term_pass2 else first_pass_count
+    if used_filter_term_pass2:
+        print(f"Pass 2 ({filter_source_pass2} '{used_filter_term_pass2}'): {second_pass_count} results")
+    if not second_pass_count:
         print("No results found in Pass 2; using Pass 1 results for Pass 3 filtering.")
-        pass3_input_results = first_pass_results
-    else:
-        pass3_input_results = second_pass_results
-
-    third_pass_filter_term = ""
-    filter_source_pass3 = ""
-    if pass3_input_results and initial_caption:
-        print(f"\nPass 3: Refining {len(pass3_input_results)} items using specific features...")
-
-        # 1. Check for a non-standard color in the caption
-        color_keyword = extract_additional_color(initial_caption)
-        if color_keyword and color_keyword != used_filter_term_pass2:
-            third_pass_filter_term = color_keyword
-            filter_source_pass3 = "Non-standard Color"
-            print(f"  Using {filter_source_pass3} keyword for filtering: '{third_pass_filter_term}'")
-
-        # 2. If no valid color found, check for inscription
-        if not third_pass_filter_term:
-            inscription_keyword = extract_inscription_from_caption(initial_caption)
-            if inscription_keyword and inscription_keyword != used_filter_term_pass2:
-                third_pass_filter_term = inscription_keyword
-                filter_source_pass3 = "Inscription"
-                print(f"  Using {filter_source_pass3} keyword for filtering: '{third_pass_filter_term}'")
-
-        # 3. If still nothing, check Secondary Category (skipping term used in Pass 2)
-        if not third_pass_filter_term:
-            print("  No color or inscription found/valid. Checking secondary category...")
-            secondary_categories = [cat for cat in categories if cat != used_filter_term_pass2 and cat not in generic_designs]
-            if secondary_categories:
-                third_pass_filter_term = secondary_categories[0]
-                filter_source_pass3 = "Secondary Category"
-                print(f"  Using {filter_source_pass3} keyword for filtering: '{third_pass_filter_term}'")
-            else:
-                print("  No suitable secondary category found.")
-
-        # 4. Fallback to LLM if still no filter term
-        if not third_pass_filter_term:
-            print("  No specific filter term found. Trying LLM fallback...")
-            used_keywords = set([c.lower() for c in categories if c] +
-                                [d.lower() for d in design.split() if d] +
-                                [material.lower(), jew_type.lower(), material_search_term.lower()] +
-                                [used_filter_term_pass2])
-            common_words_for_ai = {
-                "a", "an", "the", "this", "that", "these", "those", "and", "or", "but", "of", "with", "for", "on", "at", "its",
-                "to", "from", "by", "as", "it", "is", "are", "was", "were", "be", "been", "has", "have", "had", "no",
-                "in", "out", "up", "down", "image", "photo", "picture", "view", "background", "surface", "display",
-                "features", "shaped", "style", "design", "pattern", "piece", "item", "accessory", "jewelry", "wearable",
-                "made", "set", "against", "shown", "engraved", "center"
-            }
-            full_exclusion_set = used_keywords.union(common_words_for_ai)
-            llm_keyword = get_additional_keywords_with_llm(initial_caption, full_exclusion_set)
-            if llm_keyword and llm_keyword != used_filter_term_pass2:
-                third_pass_filter_term = llm_keyword
-                filter_source_pass3 = "AI Fallback"
-                print(f"  Using {filter_source_pass3} keyword for filtering: '{third_pass_filter_term}'")
-
-        # Final check: if the term for Pass 3 is identical to Pass 2's term, skip Pass 3 filtering.
-        if third_pass_filter_term == used_filter_term_pass2:
-            print(f"  Pass 3 filter term '{third_pass_filter_term}' is identical to Pass 2 filter term; skipping Pass 3 filtering.")
-            third_pass_results = pass3_input_results
-        else:
-            if third_pass_filter_term:
-                print(f"  Applying Pass 3 filter ({filter_source_pass3}): '{third_pass_filter_term}'")
-                temp_results = [
-                    item for item in pass3_input_results
-                    if item.get("jew_title") and third_pass_filter_term in item["jew_title"].lower()
-                ]
-                third_pass_results = temp_results
-                print(f"  Results after Pass 3 ({filter_source_pass3}) filter: {len(third_pass_results)}")
-            else:
-                print("  No specific filter term found for Pass 3. Skipping filter.")
-                third_pass_results = pass3_input_results
+        third_pass_count = tiers.counts["pass3_from_pass1"]
+        third_pass_results = tiers.items("pass3_from_pass1")
+        second_pass_results = []
+        first_pass_results = tiers.items("pass1_not_pass3")
     else:
-         print("\nSkipping Pass 3 refinement (No previous results or no caption).")
-         third_pass_results = pass3_input_results
+        third_pass_count = tiers.counts["pass3_from_pass2"]
+        third_pass_results = tiers.items("pass3_from_pass2")
+        second_pass_results = tiers.items("pass2_not_pass3")
+        first_pass_results = tiers.items("pass1_not_pass2")
+    if pass3_active:
+        print(f"  Results after Pass 3 ({filter_source_pass3}) filter '{third_pass_filter_term}': {third_pass_count}")
 
     # --- Final Results Combination and Selection ---
     print("\n--- Combining and Selecting Final Results ---")
@@ -582,40 +943,55 @@ def search_similar_products(json_prompt, initial_caption, desired_limit=10):
     def add_unique(items_list, limit):
         count_added = 0
         for item in items_list:
-            item_id = item.get("id")
+            item_id = item.id
             if item_id and item_id not in added_ids and len(combined_results) < limit:
                 combined_results.append(item)
                 added_ids.add(item_id)
                 count_added += 1
         return count_added
 
-    if third_pass_results:
-        print(f"Adding up to {desired_limit - len(combined_results)} from Pass 3 ({len(third_pass_results)} available)...")
+    if third_pass_count:
+        print(f"Adding up to {desired_limit - len(combined_results)} from Pass 3 ({third_pass_count} available)...")
         add_unique(third_pass_results, desired_limit)
         source_pass_name = "Third Pass"
-        total_found_before_limit_primary = len(third_pass_results)
-    if len(combined_results) < desired_limit and second_pass_results:
-        print(f"Adding up to {desired_limit - len(combined_results)} from Pass 2 ({len(second_pass_results)} available)...")
+        total_found_before_limit_primary = third_pass_count
+    if len(combined_results) < desired_limit and second_pass_count:
+        print(f"Adding up to {desired_limit - len(combined_results)} from Pass 2 ({second_pass_count} available)...")
         added_count = add_unique(second_pass_results, desired_limit)
         if added_count > 0 and source_pass_name == "None":
             source_pass_name = "Second Pass"
-            total_found_before_limit_primary = len(second_pass_results)
-    if len(combined_results) < desired_limit and first_pass_results:
-        print(f"Adding up to {desired_limit - len(combined_results)} from Pass 1 ({len(first_pass_results)} available)...")
+            total_found_before_limit_primary = second_pass_count
+    if len(combined_results) < desired_limit and first_pass_count:
+        print(f"Adding up to {desired_limit - len(combined_results)} from Pass 1 ({first_pass_count} available)...")
         added_count = add_unique(first_pass_results, desired_limit)
         if added_count > 0 and source_pass_name == "None":
             source_pass_name = "First Pass"
-            total_found_before_limit_primary = len(first_pass_results)
+            total_found_before_limit_primary = first_pass_count
+
+    # --- Later pages: the same ranking continued past desired_limit ---
+    ranked_results = list(combined_results)
+    if len(combined_results) == desired_limit:
+        for items_list in (third_pass_results, second_pass_results, first_pass_results):
+            for item in items_list:
+                if len(ranked_results) >= RESULT_CURSOR_MAX_CANDIDATES:
+                    break
+                if item.id and item.id not in added_ids:
+                    ranked_results.append(item)
+                    added_ids.add(item.id)
+
+    if price_sort:
+        # Passes still decide which items are returned; the response itself is ordered by price
+        combined_results.sort(key=lambda item: item_key(item, 0))
 
     print("\n--- Final Search Summary ---")
     if combined_results:
          print(f"Returning {len(combined_results)} combined results (Desired: {desired_limit}).")
          print(f"Primary source pass contributing results: {source_pass_name} (found {total_found_before_limit_primary} items before combining).")
     else:
-         if api_error_pass1 and not first_pass_results:
+         if api_error_pass1 and not first_pass_count:
              print("Search failed due to API error in the first pass and no results were fetched.")
              return {"error": "Failed to retrieve initial search results from API.", "data": [], "total_found": 0, "source_pass": "N/A"}
-         elif not first_pass_results:
+         elif not first_pass_count:
               print("No products found matching the initial criteria in Pass 1.")
               return {"data": [], "total_found": 0, "source_pass": "None"}
          else:
@@ -626,11 +1002,22 @@ def search_similar_products(json_prompt, initial_caption, desired_limit=10):
     print(f"Number of items in final_results_data: {len(combined_results)}")
 
     final_results = {
-        "data": combined_results,
+        "data": [item.to_dict() for item in combined_results],
         "total_found": len(combined_results),
         "source_pass": source_pass_name,
-        "total_found_by_primary_source": total_found_before_limit_primary
+        "total_found_by_primary_source": total_found_before_limit_primary,
+        "facets": outcome["facets"].counts()
     }
+    if len(ranked_results) > desired_limit:
+        later_pages = ranked_results[desired_limit:]
+        if price_sort:
+            # Like the first page, every later page is ordered by price
+            later_pages = [item for start in range(0, len(later_pages), desired_limit)
+                           for item in sorted(later_pages[start:start + desired_limit], key=lambda item: item_key(item, 0))]
+        later_pages = [item.to_dict() for item in later_pages]
+        final_results["next_cursor"] = result_cursors.store(
+            later_pages, 0, desired_limit, {"source_pass": source_pass_name, "sort": sort or "relevance"})
+        final_results["total_available"] = len(ranked_results)
     return final_results
 
 # --- [Example Usage (_main_ block)] ---
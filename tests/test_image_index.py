@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_index import (ImageEmbeddingIndex, ImageEncoder, apply_catalog_changes, build_image_index,
+                         query_image_index, rerank_vectors_path)
+
+N_ITEMS = 40
+
+
+@pytest.fixture(scope="module")
+def encoder():
+    return ImageEncoder.tiny_random(seed=0, dim=16)
+
+
+def _synthetic_image_catalog(directory, n, start=0, seed=0):
+    # Random-pixel images are far apart even for an untrained encoder
+    rng = np.random.default_rng(seed)
+    items = []
+    for item_id in range(start, start + n):
+        path = os.path.join(directory, f"{item_id}.png")
+        Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)).save(path)
+        items.append({"id": str(item_id), "jew_title": f"Item {item_id}", "jew_default_img": path})
+    return items
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return _synthetic_image_catalog(str(tmp_path), N_ITEMS)
+
+
+def _assert_ranks_itself_first(index, encoder, items):
+    for item in items:
+        hits = query_image_index(index, encoder, item["jew_default_img"], k=3)
+        assert hits[0][0] == item["id"], item["id"]
+        assert hits[0][1] == pytest.approx(1.0, abs=1e-4)
+
+
+def test_build_embeds_every_item(catalog, encoder):
+    index = build_image_index(catalog + [{"id": "no-image"}], encoder)
+    assert len(index) == index.live_count() == N_ITEMS
+    assert index.vectors.shape == (N_ITEMS, 16)
+    np.testing.assert_allclose(np.linalg.norm(index.vectors, axis=1), 1.0, atol=1e-5)
+    assert index.model_name == "tiny-random"
+
+
+@pytest.mark.parametrize("ann", [None, "ivf", "hnsw"])
+def test_own_image_ranks_first(catalog, encoder, ann):
+    index = build_image_index(catalog, encoder)
+    if ann:
+        index.build_ann(ann, **({"nlist": 4, "nprobe": 4} if ann == "ivf" else {}))
+    _assert_ranks_itself_first(index, encoder, catalog)
+
+
+def test_append_delete_compact(tmp_path, catalog, encoder):
+    index = build_image_index(catalog, encoder)
+    index.build_ann("ivf", nlist=4, nprobe=4)
+    added = _synthetic_image_catalog(str(tmp_path), 5, start=N_ITEMS, seed=1)
+    summary = apply_catalog_changes(index, catalog[5:] + added, encoder)
+    assert summary == {"embedded": 5, "unchanged": N_ITEMS - 5, "removed": 5, "tombstone_ratio": round(5 / (N_ITEMS + 5), 4)}
+    assert index.live_count() == N_ITEMS
+    assert all(index.position_of(item["id"]) is None for item in catalog[:5])
+    _assert_ranks_itself_first(index, encoder, added)
+    found = {hit[0] for item in catalog[:5] for hit in query_image_index(index, encoder, item["jew_default_img"], k=N_ITEMS)}
+    assert not found & {item["id"] for item in catalog[:5]}
+
+    live = catalog[5:] + added
+    index.compact()
+    assert len(index) == index.live_count() == index.ann_rows == N_ITEMS
+    assert not index.deleted.any()
+    _assert_ranks_itself_first(index, encoder, live)
+
+
+@pytest.mark.parametrize("ann", [None, "pq"])
+def test_save_load_round_trip(tmp_path, catalog, encoder, ann):
+    index = build_image_index(catalog, encoder)
+    if ann:
+        index.build_ann(ann, m=4, rerank=N_ITEMS)
+    index.delete([catalog[0]["id"]])
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+
+    loaded = ImageEmbeddingIndex.load(path)
+    sidecar = rerank_vectors_path(path)
+    # With PQ the float vectors live in the .vectors.npy sidecar and are mapped, not read
+    assert os.path.exists(sidecar) == (ann == "pq")
+    assert isinstance(loaded.vectors, np.memmap) == (ann == "pq")
+    np.testing.assert_array_equal(np.asarray(loaded.vectors), index.vectors)
+    assert loaded.ids.tolist() == index.ids.tolist()
+    assert loaded.deleted.tolist() == index.deleted.tolist()
+    assert loaded.content_hash_for(catalog[1]["id"]) == index.content_hash_for(catalog[1]["id"])
+    assert loaded.position_of(catalog[0]["id"]) is None
+    for item in catalog[1:]:
+        query = index.vector_for(item["id"])
+        assert loaded.search(query, k=5) == index.search(query, k=5)
+
+    # Updating and re-saving a mapped index must not truncate the file it reads from
+    loaded.append(["extra"], np.asarray(index.vectors[:1]) + 0.1)
+    loaded.save(path)
+    reloaded = ImageEmbeddingIndex.load(path)
+    assert reloaded.live_count() == N_ITEMS
+    assert reloaded.search(reloaded.vector_for("extra"), k=1)[0][0] == "extra"
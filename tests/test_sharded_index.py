@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from sharded_index import (CatalogShard, ShardedCatalogIndex, build_shards, shard_of,
+                           _synthetic_catalog, _synthetic_queries)
+
+N_ITEMS = 600
+DIM = 8
+
+
+def _answer(result):
+    return result["total"], [hit[1] for hit in result["hits"]]
+
+
+def _vectors(n, dim=DIM, seed=2):
+    vectors = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _assert_matches_unsharded(paths, unsharded, queries):
+    index = ShardedCatalogIndex(paths).start()
+    try:
+        for query in queries:
+            assert _answer(index.search(query)) == _answer(unsharded.search(query)), query
+    finally:
+        index.close()
+
+
+@pytest.mark.parametrize("n_shards", [2, 3])
+def test_sharded_search_matches_unsharded(tmp_path, n_shards):
+    items = _synthetic_catalog(N_ITEMS)
+    vectors = _vectors(len(items))
+    rows_by_id = {item["id"]: row for row, item in enumerate(items)}
+    paths = build_shards(items, n_shards, str(tmp_path), lambda item_id: vectors[rows_by_id[item_id]])
+    unsharded = CatalogShard.from_items(list(enumerate(items)), vectors)
+    _assert_matches_unsharded(paths, unsharded, _synthetic_queries(60, DIM))
+
+
+def test_shard_without_embeddings_gets_zero_rows(tmp_path):
+    # Only items of shard 0 have an embedding; the other shards must still answer vector queries
+    items = _synthetic_catalog(N_ITEMS)
+    vectors = _vectors(len(items))
+    for row, item in enumerate(items):
+        if shard_of(item["id"], 3) != 0:
+            vectors[row] = 0
+    rows_by_id = {item["id"]: row for row, item in enumerate(items)}
+    paths = build_shards(items, 3, str(tmp_path),
+                         lambda item_id: vectors[rows_by_id[item_id]] if shard_of(item_id, 3) == 0 else None)
+    assert all(CatalogShard.load(path).vectors.shape[1] == DIM for path in paths)
+    unsharded = CatalogShard.from_items(list(enumerate(items)), vectors)
+    queries = [query for query in _synthetic_queries(60, DIM) if "vector" in query]
+    _assert_matches_unsharded(paths, unsharded, queries)
@@ -0,0 +1,35 @@
+# top_k.py
+import heapq
+
+
+class TopKTiers:
+    """
+    Bounded selection per priority tier: for each tier, keeps only the k items with the
+    smallest keys offered so far (a max-heap of size k), plus a count of everything offered.
+    Keys are tuples of numbers; the stream position is the usual key, which keeps the first k
+    items in arrival order. Memory is O(k) per tier however many items are streamed.
+    """
+
+    def __init__(self, tiers, k):
+        self.k = k
+        self._heaps = {tier: [] for tier in tiers}
+        self.counts = dict.fromkeys(tiers, 0)
+
+    def offer(self, tier, key, item):
+        """Offer item to tier under key. Keys must be unique within a tier."""
+        self.counts[tier] += 1
+        if self.k <= 0:
+            return
+        heap = self._heaps[tier]
+        entry = (tuple(-part for part in key), item)
+        if len(heap) < self.k:
+            heapq.heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+
+    def is_full(self, tier):
+        return len(self._heaps[tier]) >= self.k
+
+    def items(self, tier):
+        """The kept items of tier, smallest key first."""
+        return [item for _, item in sorted(self._heaps[tier], key=lambda entry: entry[0], reverse=True)]